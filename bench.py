@@ -0,0 +1,517 @@
+from __future__ import print_function
+import csound as cs
+import lilypond
+import argparse
+import importlib
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+# Benchmarks for the envelope math and score emission in csound.py, the
+# event-listener parsing in lilypond.py and the lexer in lp-lexer.py (skipped
+# without ply). Each benchmark is run --repeat times
+# and the best time is reported, along with throughput and the peak memory
+# allocated (traced separately, in one extra run).
+#
+#     python bench.py                   # everything, default sizes
+#     python bench.py slice add         # just these
+#     python bench.py --notes 200 --backend numpy > bench_output.txt
+
+
+def random_envelope(rng, breakpoints, absolute):
+    """An envelope of (level, length) pairs with the given number of points."""
+    envelope = []
+    for i in range(breakpoints):
+        if absolute:
+            level = rng.uniform(0.05, 0.95)
+        else:
+            level = rng.uniform(-0.3, 0.3)
+        if i == breakpoints - 1:
+            length = 0
+        else:
+            length = rng.uniform(0.1, 1.0)
+        envelope.append((level, length))
+    return envelope
+
+
+def make_song(sections=2, tracks=4, gestures=8, notes=16, breakpoints=8, seed=1):
+    """
+    A synthetic Song: every Section holds Tracks of Gestures of Notes, with
+    random envelopes of the given size at the Section, Track, Gesture and
+    Note levels. Returns the Song and the number of notes in it.
+    """
+    rng = random.Random(seed)
+    song_sections = []
+    note_count = 0
+    for s in range(sections):
+        parts = []
+        for t in range(tracks):
+            events = []
+            offset = 0  # in beats, whatever the time mode
+            for g in range(gestures):
+                gesture_notes = []
+                gesture_start = offset
+                for n in range(notes):
+                    duration = rng.choice((0.25, 0.5, 1.0))
+                    offset += duration
+                    articulation = rng.choice((None, cs.Articulation.staccato,
+                                               cs.Articulation.legato))
+                    dynamics = cs.Dynamics(random_envelope(rng, 3, False))
+                    gesture_notes.append(cs.Note(0, duration, dynamics, articulation,
+                                                 rng.randint(36, 84)))
+                events.append(cs.Gesture(gesture_notes, gesture_start,
+                                         dynamics=cs.Dynamics(random_envelope(rng, breakpoints, False))))
+                note_count += notes
+            track_dynamics = cs.Dynamics(random_envelope(rng, breakpoints, False))
+            parts.append(cs.Track(cs.Instrument(100 + t), None, events, dynamics=track_dynamics))
+        section_dynamics = cs.Dynamics(random_envelope(rng, breakpoints, True), True)
+        song_sections.append(cs.Section("section {0}".format(s), parts, [(0, 100)], 0,
+                                        section_dynamics))
+    return cs.Song("benchmark", "bench.py", song_sections), note_count
+
+
+def make_notes_fixture(notes=10000, seed=1):
+    """
+    The text of a synthetic event-listener .notes file for one staff: a
+    tempo, then notes (with the odd chord, tie, slur, script and rest).
+    Times and durations are in whole notes, as lilypond writes them.
+    """
+    rng = random.Random(seed)
+    lines = ["0.00000000\ttempo\t400.00000000"]
+    when = 0.0
+    slurring = False
+    tied = None
+    for i in range(notes):
+        duration = rng.choice((0.125, 0.25, 0.5))
+        if tied is not None:
+            # the continuation of a tie: the same pitch, undecorated
+            lines.append("{0:.8f}\tnote\t{1}\t{2}\t{3:.8f}\tpoint-and-click 1 {4}".format(
+                when, tied, int(1 / duration), duration, i))
+            tied = None
+            when += duration
+            continue
+        pitch = rng.randint(36, 72)
+        lines.append("{0:.8f}\tnote\t{1}\t{2}\t{3:.8f}\tpoint-and-click 1 {4}".format(
+            when, pitch, int(1 / duration), duration, i))
+        if rng.random() < 0.2:
+            pitch += 4
+            lines.append("{0:.8f}\tnote\t{1}\t{2}\t{3:.8f}\tpoint-and-click 1 {4}".format(
+                when, pitch, int(1 / duration), duration, i))
+        roll = rng.random()
+        if roll < 0.05:
+            lines.append("{0:.8f}\ttie".format(when))
+            tied = pitch
+        elif roll < 0.15:
+            lines.append("{0:.8f}\tslur\t{1}".format(when, 1 if slurring else -1))
+            slurring = not slurring
+        elif roll < 0.3:
+            lines.append("{0:.8f}\tscript\t{1}".format(when, rng.choice(("staccato", "tenuto"))))
+        when += duration
+        if tied is None and rng.random() < 0.05:
+            lines.append("{0:.8f}\trest\t4\t0.25000000".format(when))
+            when += 0.25
+    return "\n".join(lines) + "\n", notes
+
+
+def make_ly_fixture(notes=10000, seed=1, staves=4):
+    """
+    The text of a synthetic lilypond score of staves of relative music, with
+    chords, ties, slurs, scripts, tuplets, comments and markup, as a large
+    .ly input for the lexer. Returns the text and the number of notes.
+    """
+    rng = random.Random(seed)
+    lines = ['\\version "2.18.2"',
+             '\\header { title = "bench" composer = \\markup { \\bold "bench.py" } }',
+             "<<"]
+    for staff in range(staves):
+        lines.append('  \\new Staff = "S{0}" \\with {{ instrumentName = #"S{0}" }}'
+                     " \\relative c' {{".format(staff))
+        lines.append('    \\tempo "Allegro" 4 = 120 \\time 4/4 \\clef "treble"')
+        items = []
+        slurring = False
+        count = 0
+        while count < notes // staves:
+            if len(items) >= 8:
+                lines.append("    " + " ".join(items) + " |")
+                items = []
+                if rng.random() < 0.1:
+                    lines.append("    % bar {0}".format(count))
+            roll = rng.random()
+            duration = rng.choice(("", "", "4", "8", "2", "4.", "16"))
+            if roll < 0.1:
+                items.append("<{0} {1} {2}>{3}".format(
+                    rng.choice("cdefgab"), rng.choice("cdefgab"), rng.choice("cdefgab"),
+                    duration))
+                count += 3
+                continue
+            if roll < 0.15:
+                items.append("\\times 2/3 {{ {0}8 {1} {2} }}".format(
+                    rng.choice("cdefgab"), rng.choice("cdefgab"), rng.choice("cdefgab")))
+                count += 3
+                continue
+            note = rng.choice("cdefgab") + rng.choice(("", "", "is", "es")) + \
+                rng.choice(("", "", "'", ",")) + duration
+            if roll < 0.25:
+                note += rng.choice(("-.", "--", "->", "\\staccato"))
+            elif roll < 0.3:
+                note += ")" if slurring else "("
+                slurring = not slurring
+            elif roll < 0.33:
+                note += "~"
+            items.append(note)
+            count += 1
+        if slurring:
+            items.append("c)")
+        lines.append("    " + " ".join(items))
+        lines.append("  }")
+    lines.append(">>")
+    return "\n".join(lines) + "\n", notes
+
+
+def lp_lexer():
+    """The lp-lexer module, or None without ply."""
+    try:
+        return importlib.import_module("lp-lexer")
+    except ImportError:
+        return None
+
+
+def measure(run, repeat):
+    """Best wall time of run() over repeat calls, and the peak traced memory of one more."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+# Each benchmark takes the parsed options and returns (run, counts), where
+# run is a no-argument callable and counts maps a unit (e.g. "events") to
+# the number of them one call of run processes.
+
+def bench_normalize(options):
+    rng = random.Random(options.seed)
+    envelopes = [random_envelope(rng, options.breakpoints, True)
+                 for i in range(options.envelopes)]
+
+    def run():
+        for envelope in envelopes:
+            cs.Dynamics(envelope, True)
+    return run, {"envelopes": len(envelopes),
+                 "breakpoints": len(envelopes) * options.breakpoints}
+
+
+def bench_slice(options):
+    rng = random.Random(options.seed)
+    dynamics = cs.Dynamics(random_envelope(rng, options.breakpoints, True), True)
+    starts = [rng.uniform(0, 0.9) for i in range(options.envelopes)]
+    durations = [rng.uniform(0, 1 - s) for s in starts]
+
+    def run():
+        cs.clear_dynamics_caches()
+        dynamics.slice_many(starts, durations)
+    return run, {"slices": len(starts), "breakpoints": len(starts) * options.breakpoints}
+
+
+def bench_add(options):
+    rng = random.Random(options.seed)
+    pairs = [(cs.Dynamics(random_envelope(rng, options.breakpoints, False)),
+              cs.Dynamics(random_envelope(rng, options.breakpoints, True), True))
+             for i in range(options.envelopes)]
+
+    def run():
+        cs.clear_dynamics_caches()
+        for (relative, absolute) in pairs:
+            relative.add(absolute)
+    return run, {"adds": len(pairs), "breakpoints": len(pairs) * 2 * options.breakpoints}
+
+
+def bench_average_level(options):
+    rng = random.Random(options.seed)
+    envelopes = [cs.Dynamics(random_envelope(rng, options.breakpoints, True), True)
+                 for i in range(options.envelopes)]
+
+    def run():
+        for dynamics in envelopes:
+            dynamics._reductions = None  # reductions are cached per envelope
+            dynamics.average_level()
+    return run, {"envelopes": len(envelopes),
+                 "breakpoints": len(envelopes) * options.breakpoints}
+
+
+def bench_reduce(options):
+    rng = random.Random(options.seed)
+    envelopes = [cs.Dynamics(random_envelope(rng, options.breakpoints, True), True)
+                 for i in range(options.envelopes)]
+
+    def run():
+        for dynamics in envelopes:
+            dynamics._reductions = None
+        for reduction in ("average", "peak", "min", "rms"):
+            cs.reduce_dynamics(envelopes, reduction)
+        cs.reduce_dynamics(envelopes, "sampled", 16)
+    return run, {"reductions": 5 * len(envelopes),
+                 "breakpoints": len(envelopes) * options.breakpoints}
+
+
+def bench_emit(options):
+    song, note_count = make_song(options.sections, options.tracks, options.gestures,
+                                 options.notes, options.breakpoints, options.seed)
+    devnull = open(os.devnull, "w")
+
+    def run():
+        cs.clear_dynamics_caches()
+        song.emit(cs.ChunkedWriter(devnull), processes=options.processes)
+    run.cleanup = devnull.close
+    return run, {"events": note_count}
+
+
+def bench_emit_compiled(options):
+    song, note_count = make_song(options.sections, options.tracks, options.gestures,
+                                 options.notes, options.breakpoints, options.seed)
+    compiled = song.compile()
+    devnull = open(os.devnull, "w")
+
+    def run():
+        compiled.emit(cs.ChunkedWriter(devnull), processes=options.processes)
+    run.cleanup = devnull.close
+    return run, {"events": note_count}
+
+
+def bench_emit_many(options):
+    song, note_count = make_song(options.sections, options.tracks, options.gestures,
+                                 options.notes, options.breakpoints, options.seed)
+    tracks = [track for section in song.compile().sections
+              for part in section.parts for track in getattr(part, "tracks", [part])]
+    devnull = open(os.devnull, "w")
+
+    def run():
+        # each CompiledTrack written straight to the writer, without a render plan
+        out = cs.ChunkedWriter(devnull)
+        for track in tracks:
+            track.emit(track.start, track.dynamics, out)
+        out.flush()
+    run.cleanup = devnull.close
+    return run, {"events": note_count}
+
+
+def bench_emit_window(options):
+    song, note_count = make_song(options.sections, options.tracks, options.gestures,
+                                 options.notes, options.breakpoints, options.seed)
+    # the middle tenth of the longest Section, as when auditioning a few bars
+    duration = max([section.duration for section in song.sections])
+    window = (duration * 9 // 20, duration * 11 // 20)
+    window_count = len(list(song.iter_events(window)))
+    devnull = open(os.devnull, "w")
+
+    def run():
+        cs.clear_dynamics_caches()
+        song.emit(cs.ChunkedWriter(devnull), processes=options.processes, window=window)
+    run.cleanup = devnull.close
+    return run, {"events": window_count}
+
+
+def bench_compile(options):
+    song, note_count = make_song(options.sections, options.tracks, options.gestures,
+                                 options.notes, options.breakpoints, options.seed)
+
+    def run():
+        cs.clear_dynamics_caches()
+        song.compile()
+    return run, {"events": note_count}
+
+
+def bench_process_staff(options):
+    text, note_count = make_notes_fixture(options.staff_notes, options.seed)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "bench-Staff.notes")
+    with open(path, "w") as f:
+        f.write(text)
+    instrument = cs.Instrument(1)
+
+    def run():
+        with open(path) as f:
+            lilypond.process_staff(f, "bench-Staff", instrument)
+    run.cleanup = lambda: shutil.rmtree(directory)
+    return run, {"events": note_count, "lines": text.count("\n")}
+
+
+# timed inside a fresh interpreter, so interpreter startup isn't counted
+_import_code = ("import sys, time; start = time.time(); import csound; "
+                "print(time.time() - start); print('matplotlib' in sys.modules)")
+
+
+def bench_import(options):
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def run():
+        output = subprocess.check_output([sys.executable, "-c", _import_code], cwd=here).split()
+        run.seconds.append(float(output[0]))
+        run.matplotlib = run.matplotlib or output[1] == b"True"
+    run.seconds = []
+    run.matplotlib = False
+
+    def check():
+        best = min(run.seconds)
+        if run.matplotlib:
+            return "import csound imported matplotlib"
+        if best > options.import_budget:
+            return "import csound took {0:.3f} s, over the {1:.3f} s budget".format(
+                best, options.import_budget)
+    run.check = check
+    return run, {"imports": 1}
+
+
+def bench_lex(options):
+    lp = lp_lexer()
+    if lp is None:
+        return None, {}
+    text, note_count = make_ly_fixture(options.staff_notes, options.seed)
+    lexer = lp.make_lexer()
+
+    def run():
+        lp.tokenize(text, lexer)
+    return run, {"tokens": len(lp.tokenize(text, lexer)), "bytes": len(text)}
+
+
+# timed inside a fresh interpreter: importing lp-lexer, then making a lexer
+# from the precomputed tables in argument 2 (argument 1 is 1) or from the
+# rules (0)
+_lexer_code = ("import sys, time, importlib; start = time.time(); "
+               "lp = importlib.import_module('lp-lexer'); imported = time.time(); "
+               "lp.make_lexer(optimize=sys.argv[1] == '1', outputdir=sys.argv[2]); "
+               "print(imported - start); print(time.time() - imported)")
+
+
+def bench_lexer_startup(options):
+    lp = lp_lexer()
+    if lp is None:
+        return None, {}
+    here = os.path.dirname(os.path.abspath(__file__))
+    directory = tempfile.mkdtemp()
+    lp.write_tables(directory)
+
+    def run():
+        for optimize in ("1", "0"):
+            output = subprocess.check_output([sys.executable, "-c", _lexer_code, optimize,
+                                              directory], cwd=here).split()
+            run.imports.append(float(output[0]))
+            run.seconds[optimize].append(float(output[1]))
+    run.imports = []
+    run.seconds = {"1": [], "0": []}
+    run.cleanup = lambda: shutil.rmtree(directory)
+
+    def details():
+        return "  import {0:.4f} s, lexer from tables {1:.4f} s, from rules {2:.4f} s".format(
+            min(run.imports), min(run.seconds["1"]), min(run.seconds["0"]))
+
+    def check():
+        best = min(run.seconds["1"])
+        if best > options.lexer_budget:
+            return "making a lexer from tables took {0:.4f} s, over the {1:.4f} s budget".format(
+                best, options.lexer_budget)
+    run.details = details
+    run.check = check
+    return run, {"startups": 2}
+
+
+benchmarks = [
+    ("import", bench_import),
+    ("normalize", bench_normalize),
+    ("slice", bench_slice),
+    ("add", bench_add),
+    ("average_level", bench_average_level),
+    ("reduce", bench_reduce),
+    ("emit", bench_emit),
+    ("compile", bench_compile),
+    ("emit_compiled", bench_emit_compiled),
+    ("emit_many", bench_emit_many),
+    ("emit_window", bench_emit_window),
+    ("process_staff", bench_process_staff),
+    ("lex", bench_lex),
+    ("lexer_startup", bench_lexer_startup),
+]
+
+
+def report(name, elapsed, peak, counts):
+    rates = ", ".join(["{0:,.0f} {1}/s".format(count / elapsed, unit)
+                       for (unit, count) in sorted(counts.items())])
+    print("{0:<16} {1:>10.4f} s  {2:>10.1f} KiB peak  {3}".format(
+        name, elapsed, peak / 1024.0, rates))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark csound.py and lilypond.py.")
+    parser.add_argument("only", nargs="*", metavar="benchmark",
+                        help="run only these ({0})".format(", ".join([n for (n, b) in benchmarks])))
+    parser.add_argument("--sections", type=int, default=2)
+    parser.add_argument("--tracks", type=int, default=4)
+    parser.add_argument("--gestures", type=int, default=8)
+    parser.add_argument("--notes", type=int, default=16, help="notes per gesture")
+    parser.add_argument("--breakpoints", type=int, default=8, help="points per envelope")
+    parser.add_argument("--envelopes", type=int, default=2000,
+                        help="envelopes (or slices) per envelope benchmark")
+    parser.add_argument("--staff-notes", type=int, default=10000,
+                        help="notes in the synthetic .notes and .ly fixtures")
+    parser.add_argument("--backend", default="list", help="Dynamics backend (list, numpy)")
+    parser.add_argument("--time-mode", default="decimal", help="decimal, fraction or ticks")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="render Tracks in a pool of this many processes")
+    parser.add_argument("--import-budget", type=float, default=0.25, metavar="SECONDS",
+                        help="fail if import csound takes longer than this (default: 0.25)")
+    parser.add_argument("--lexer-budget", type=float, default=0.05, metavar="SECONDS",
+                        help="fail if making a lexer from its tables takes longer than this "
+                        "(default: 0.05)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    options = parser.parse_args(argv)
+
+    unknown = set(options.only) - set([n for (n, b) in benchmarks])
+    if unknown:
+        parser.error("unknown benchmark(s): {0}".format(", ".join(sorted(unknown))))
+
+    cs.set_dynamics_backend(options.backend)
+    cs.set_time_mode(options.time_mode)
+    print("# backend={0} time-mode={1} python={2}".format(
+        options.backend, options.time_mode, sys.version.split()[0]))
+    failures = []
+    for (name, benchmark) in benchmarks:
+        if options.only and name not in options.only:
+            continue
+        run, counts = benchmark(options)
+        if run is None:
+            print("{0:<16} skipped".format(name))
+            continue
+        try:
+            elapsed, peak = measure(run, options.repeat)
+        finally:
+            if hasattr(run, "cleanup"):
+                run.cleanup()
+        report(name, elapsed, peak, counts)
+        if hasattr(run, "details"):
+            print(run.details())
+        if hasattr(run, "check"):
+            failure = run.check()
+            if failure:
+                failures.append(failure)
+    for failure in failures:
+        print("FAILED:", failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
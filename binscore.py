@@ -0,0 +1,238 @@
+from __future__ import print_function
+import csound as cs
+import array
+import mmap
+import struct
+import sys
+
+
+# A fixed-width binary form of a rendered CSound score, for storing and
+# reloading big intermediate renders without formatting or parsing text. The file is the magic string followed
+# by blocks, each a 16 byte header (kind, record count, record width,
+# padding) and a payload padded to a multiple of 8 bytes:
+#
+#   EVTS  count records of width fields: width bytes giving the type of
+#         each field (below; every record of a block has the same types),
+#         padded to 8 bytes, then count * width little-endian float64s (the
+#         "i" statement parameters, instrument number first)
+#   TEXT  one piece of literal score text: the string table index in the
+#         count field (comments, t and s statements, pre-rendered text)
+#   STRS  count new string table entries, each a uint32 byte length and
+#         UTF-8 bytes; entries are numbered in order from the start of file
+#
+# Field types keep the text a field becomes exactly what format_events
+# would have written: an int, a float, or a string (a string table index
+# stored as the value). Strings that read back as the same int are ints.
+magic = b"LPCSBIN\x01"
+_header = struct.Struct("<4sIII")
+field_float, field_int, field_string = range(3)
+
+
+def _pad(n):
+    return -n % 8
+
+
+class BinaryScoreWriter(cs.ScoreWriter):
+    """
+    A ScoreWriter that writes the binary score format to a binary stream.
+    Events are collected into blocks of up to block_size records with the
+    same field types. Text written with write() or writeline() is kept
+    verbatim. Tracks rendered in parallel or loaded from a cache are
+    replayed as records (see csound.write_records), so their events are
+    stored as events too.
+    """
+
+    block_size = 4096
+
+    def __init__(self, stream):
+        super(BinaryScoreWriter, self).__init__(stream)
+        self.stream.write(magic)
+        self._strings = {}
+        self._new_strings = []
+        self._kinds = None
+        self._count = 0
+        self._values = array.array("d")
+
+    def _string(self, text):
+        index = self._strings.get(text)
+        if index is None:
+            index = self._strings[text] = len(self._strings)
+            self._new_strings.append(text)
+        return index
+
+    def _write_block(self, kind, count, width, payload):
+        self.stream.write(_header.pack(kind, count, width, 0))
+        for data in payload:
+            self.stream.write(data)
+        size = sum([len(data) for data in payload])
+        self.stream.write(b"\0" * _pad(size))
+
+    def _write_strings(self):
+        if self._new_strings:
+            payload = []
+            for text in self._new_strings:
+                data = text.encode("utf-8")
+                payload.append(struct.pack("<I", len(data)))
+                payload.append(data)
+            self._write_block(b"STRS", len(self._new_strings), 0, payload)
+            self._new_strings = []
+
+    def _write_events(self):
+        if self._count:
+            self._write_strings()
+            values = self._values
+            if sys.byteorder == "big":
+                values = array.array("d", values)
+                values.byteswap()
+            kinds = bytes(self._kinds)
+            self._write_block(b"EVTS", self._count, len(kinds),
+                              [kinds, b"\0" * _pad(len(kinds)), values.tobytes()])
+            self._values = array.array("d")
+            self._count = 0
+
+    def write(self, text):
+        self._write_events()
+        index = self._string(text)
+        self._write_strings()
+        self._write_block(b"TEXT", index, 0, [])
+
+    def _field(self, p):
+        if type(p) is float:
+            return (field_float, p)
+        if type(p) is not int:
+            text = str(p)
+            try:
+                p = int(text)
+            except ValueError:
+                return (field_string, self._string(text))
+            if str(p) != text:
+                return (field_string, self._string(text))
+        # (bools and ints too big for a float64 are kept as strings)
+        if -(1 << 53) <= p <= (1 << 53):
+            return (field_int, p)
+        return (field_string, self._string(str(p)))
+
+    def event(self, params):
+        fields = [self._field(p) for p in params]
+        kinds = [kind for (kind, value) in fields]
+        if kinds != self._kinds or self._count >= self.block_size:
+            self._write_events()
+            self._kinds = kinds
+        self._values.extend([value for (kind, value) in fields])
+        self._count += 1
+
+    def events(self, batch):
+        for params in batch:
+            self.event(params)
+
+    def flush(self):
+        self._write_events()
+        super(BinaryScoreWriter, self).flush()
+
+
+class EventBlock(object):
+    """
+    One EVTS block of a BinaryScore: count records of width fields. values
+    is a memoryview of float64s straight onto the score's buffer, one per
+    field, and kinds gives the type of each of the width fields.
+    """
+
+    def __init__(self, score, count, width, values, kinds):
+        self.score = score
+        self.count = count
+        self.width = width
+        self.values = values
+        self.kinds = kinds
+
+    def array(self):
+        """The values as a (count, width) NumPy array, without copying."""
+        np = cs._import_numpy()
+        if np is None:
+            raise ImportError("EventBlock.array requires numpy")
+        return np.frombuffer(self.values, dtype="<f8").reshape(self.count, self.width)
+
+    def iter_params(self):
+        """Each record as the parameter list it was written from."""
+        strings = self.score.strings
+        values = self.values.tolist()
+        width = self.width
+        ints = [j for (j, kind) in enumerate(self.kinds) if kind == field_int]
+        texts = [j for (j, kind) in enumerate(self.kinds) if kind == field_string]
+        for i in range(0, len(values), width):
+            params = values[i:i + width]
+            for j in ints:
+                params[j] = int(params[j])
+            for j in texts:
+                params[j] = strings[int(params[j])]
+            yield params
+
+
+class BinaryScore(object):
+    """
+    A BinaryScore reads the binary score format from any buffer: bytes, a
+    memoryview or (with open()) a memory-mapped file. Iterating it yields
+    the blocks in order: a str for each piece of literal text and an
+    EventBlock for each block of events.
+    """
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        if self.data[:len(magic)].tobytes() != magic:
+            raise ValueError("not a binary score")
+        self.strings = []
+
+    @classmethod
+    def open(cls, path):
+        with open(path, "rb") as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __iter__(self):
+        data = self.data
+        offset = len(magic)
+        self.strings = []
+        while offset < len(data):
+            (kind, count, width, _) = _header.unpack_from(data, offset)
+            offset += _header.size
+            if kind == b"STRS":
+                start = offset
+                for i in range(count):
+                    (length,) = struct.unpack_from("<I", data, offset)
+                    offset += 4
+                    self.strings.append(data[offset:offset + length].tobytes().decode("utf-8"))
+                    offset += length
+                offset += _pad(offset - start)
+            elif kind == b"TEXT":
+                yield self.strings[count]
+            elif kind == b"EVTS":
+                kinds = data[offset:offset + width].tolist()
+                offset += width + _pad(width)
+                values = data[offset:offset + 8 * count * width]
+                offset += 8 * count * width
+                if sys.byteorder == "big":
+                    values = memoryview(array.array("d", values.tobytes())).cast("B")
+                    values.obj.byteswap()
+                yield EventBlock(self, count, width, values.cast("d"), kinds)
+            else:
+                raise ValueError("unknown block {0!r} at offset {1}".format(kind, offset))
+
+    def write_text(self, out=None):
+        """Write the standard CSound text score to out (a ScoreWriter or file)."""
+        out = cs.score_writer(out)
+        for block in self:
+            if isinstance(block, EventBlock):
+                out.write(cs.format_events(block.iter_params()))
+            else:
+                out.write(block)
+        out.flush()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("usage: binscore.py SCORE.bin [SCORE.sco]", file=sys.stderr)
+        sys.exit(2)
+    score = BinaryScore.open(sys.argv[1])
+    if len(sys.argv) == 3:
+        with open(sys.argv[2], "w") as f:
+            score.write_text(cs.ChunkedWriter(f))
+    else:
+        score.write_text(cs.ChunkedWriter(sys.stdout))
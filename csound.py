@@ -1,11 +1,132 @@
 from __future__ import print_function
 
-import matplotlib.pyplot as plt
+import io
+import os
+import sys
+import hashlib
+import pickle
+import tempfile
+import collections
+import copy
+import inspect
+import multiprocessing
+import weakref
 import math
+import bisect
+import heapq
+import array
 import decimal as dec
+import fractions
+
+np = None  # numpy, once _import_numpy() has imported it
+
+
+def _import_numpy():
+    # numpy is imported the first time it's needed rather than with this
+    # module, which then imports quickly; None if it isn't installed
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+        np = numpy
+    return np
 
 decZero = dec.Decimal(0).normalize()
 
+# Musical time. Start times and durations are held in one of three
+# representations, chosen with set_time_mode() before any objects are built:
+#   "decimal"   decimal.Decimal beats (the default)
+#   "fraction"  fractions.Fraction beats
+#   "ticks"     integer ticks, ticks_per_quarter to the beat
+# Whatever the mode, constructors take their times in beats and convert them
+# with to_time() exactly once.
+# Envelope lengths (fractions of an event's duration) are Decimals in
+# "decimal" mode and Fractions otherwise. Times only become floats when a
+# score statement is written.
+_time_modes = ("decimal", "fraction", "ticks")
+_time_mode = "decimal"
+_ticks_per_quarter = 960
+
+
+def set_time_mode(mode, ticks_per_quarter=960):
+    """
+    Select the representation of musical time (see above). Returns the
+    previously selected mode.
+    """
+    global _time_mode, _ticks_per_quarter
+    if mode not in _time_modes:
+        raise ValueError("unknown time mode {0!r}".format(mode))
+    previous = _time_mode
+    _time_mode = mode
+    _ticks_per_quarter = int(ticks_per_quarter)
+    clear_dynamics_caches()
+    # the shared default envelope (every constructor's default argument)
+    # is built at import: rebuild its lengths in the new representation
+    dynZero.__init__([(dp.level, dp.duration) for dp in dynZero.envelope])
+    dynZero.intern()
+    return previous
+
+
+def _to_decimal(value):
+    if isinstance(value, dec.Decimal):
+        return value
+    if isinstance(value, fractions.Fraction):
+        return dec.Decimal(value.numerator) / dec.Decimal(value.denominator)
+    return dec.Decimal(value)
+
+
+def _to_fraction(value):
+    if isinstance(value, fractions.Fraction):
+        return value
+    if isinstance(value, float):
+        # the shortest decimal that round-trips, so 0.1 is 1/10
+        return fractions.Fraction(repr(value))
+    return fractions.Fraction(value)
+
+
+def to_time(value):
+    """Convert a start time or duration in beats to the current time representation."""
+    if value is None:
+        return None
+    if _time_mode == "decimal":
+        return _to_decimal(value)
+    elif _time_mode == "fraction":
+        return _to_fraction(value)
+    return int(round(_to_fraction(value) * _ticks_per_quarter))
+
+
+def to_ratio(value):
+    """Convert an envelope length (a fraction of a duration)."""
+    if _time_mode == "decimal":
+        return _to_decimal(value)
+    return _to_fraction(value)
+
+
+def parse_beats(text, scale=1):
+    """
+    Exactly convert a decimal string, in units of 1/scale beats, to beats
+    ready for to_time(): a Decimal in "decimal" mode, a Fraction otherwise.
+    """
+    if _time_mode == "decimal":
+        return dec.Decimal(text) * scale
+    return fractions.Fraction(text) * scale
+
+
+def time_ratio(numerator, denominator):
+    """The ratio of two times, as an envelope length."""
+    if _time_mode == "ticks":
+        return fractions.Fraction(numerator, denominator)
+    return numerator / denominator
+
+
+def time_to_float(value):
+    """Convert a time to float beats, for writing to the score."""
+    if _time_mode == "ticks":
+        return float(value) / _ticks_per_quarter
+    return float(value)
+
 
 # Library of musical representations for use with CSound.
 
@@ -20,9 +141,11 @@ decZero = dec.Decimal(0).normalize()
 
 # "Dynamic Point"
 class DP(object):
+    __slots__ = ("level", "duration")
+
     def __init__(self, level, duration):
         self.level = float(level)
-        self.duration = dec.Decimal(duration)
+        self.duration = to_ratio(duration)
 
 
 class Dynamics(object):
@@ -34,6 +157,13 @@ class Dynamics(object):
     of fdbs (therefore in the range [0, 1)). The length element is a fraction
     of the associated event's duration. Ordinarily all length elements should
     add up to 1, but they will all be normalized to this range in any case.
+
+    Dynamics are values: treat them as immutable. They compare and hash by
+    envelope, intern() returns a shared canonical instance, and the results
+    of slice() and add() are interned and memoized in bounded LRU caches.
+    Reductions of the envelope (average_level, peak_level, min_level,
+    rms_level, sampled_levels) are computed once per object and kept with
+    it; reduce_dynamics computes one for many envelopes in a batch.
     """
 
     silent = 0.0
@@ -46,45 +176,102 @@ class Dynamics(object):
     ff = 0.7
     fff = 0.8
 
+    def __new__(cls, *args, **kwargs):
+        # Plain Dynamics(...) construction is routed to the selected backend
+        # (see set_dynamics_backend); explicit subclasses are left alone.
+        if cls is Dynamics:
+            cls = _dynamics_backend
+        return super(Dynamics, cls).__new__(cls)
+
+    def __reduce__(self):
+        # Unpickle as exactly this class, without going through the backend
+        # redirect in __new__ (the receiving process may select another).
+        # Memoized fields are dropped so equal envelopes pickle the same.
+        state = dict(self.__dict__)
+        for name in ("_times", "_key", "_reductions"):
+            if name in state:
+                state[name] = None
+        return (_new_dynamics, (type(self),), state)
+
     def __init__(self, envelope=[(decZero, dec.Decimal(1.)),
             (decZero, decZero)], absolute=False):
-        self.envelope = []
-        for point in envelope:
-            dp = DP(point[0], point[1])
-            self.envelope.append(dp)
+        self.envelope = tuple([DP(point[0], point[1]) for point in envelope])
         self.absolute = absolute
+        self._times = None
+        self._key = None
+        self._reductions = None
         self.normalize()
 
     @classmethod
     def constant(cls, level, absolute=False):
-        return cls([(level, dec.Decimal(1.0)), (level, decZero)], absolute)
+        return cls([(level, dec.Decimal(1.0)), (level, decZero)], absolute).intern()
 
     @classmethod
     def accent(cls, level=0.1):
-        return cls([(level, dec.Decimal(1.0)), (level, decZero)], False)
+        return cls([(level, dec.Decimal(1.0)), (level, decZero)], False).intern()
+
+    def _value_key(self):
+        if self._key is None:
+            # with the durations' types: Decimal(0.5) == Fraction(1, 2), but
+            # Dynamics made in different time modes can't be mixed
+            self._key = (type(self), self.absolute,
+                         tuple([(dp.level, dp.duration, type(dp.duration))
+                                for dp in self.envelope]))
+        return self._key
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, Dynamics):
+            return NotImplemented
+        return self._value_key() == other._value_key()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self._value_key())
+
+    def intern(self):
+        """
+        Return the canonical Dynamics equal to this one, so that identical
+        envelopes share a single object.
+        """
+        key = self._value_key()
+        canonical = _interned_dynamics.get(key)
+        if canonical is None:
+            _interned_dynamics[key] = self
+            canonical = self
+        return canonical
 
     def normalize(self):
-        total_length = dec.Decimal(0.0)
+        total_length = to_ratio(0)
         highest_level = 0.0
         for dp in self.envelope:
-            if dp.duration < dec.Decimal(0.0):
+            if dp.duration < 0:
                 raise ValueError("negative length not allowed")
             total_length = total_length + dp.duration
             absolute_level = math.fabs(dp.level)
             if (absolute_level > highest_level):
                 highest_level = absolute_level
 
-        envelope_length = len(self.envelope)
-        for i in range(envelope_length):
-            dp_old = self.envelope[i]
+        envelope = []
+        for dp_old in self.envelope:
             if (highest_level == 0):
                 new_level = 0
             elif (highest_level > 1.0):
                 new_level = dp_old.level / highest_level
             else:
                 new_level = dp_old.level
-            new_length = dp_old.duration / dec.Decimal(total_length)
-            self.envelope[i] = DP(new_level, new_length)
+            new_length = dp_old.duration / total_length
+            envelope.append(DP(new_level, new_length))
+        self.envelope = tuple(envelope)
+        self._times = None
+        self._key = None
+        self._reductions = None
 
     def initial_level(self):
         return self.envelope[0].level
@@ -93,62 +280,136 @@ class Dynamics(object):
         return self.envelope[-1].level
 
     def average_level(self):
-        level = 0.0
-        dp_prev = self.envelope[0]
-        for dp in self.envelope[1:]:
-            segment_average = (dp_prev.level + dp.level) / 2.0
-            level += (segment_average * float(dp_prev.duration))
-            dp_prev = dp
+        return self._reduced("average")
+
+    def peak_level(self):
+        return self._reduced("peak")
+
+    def min_level(self):
+        return self._reduced("min")
 
-        return level
+    def rms_level(self):
+        return self._reduced("rms")
+
+    def sampled_levels(self, points):
+        """The levels at points evenly spaced times from start to end, as a tuple."""
+        return self._reduced(("sampled", points))
+
+    def _reduced(self, reduction):
+        if self._reductions is None:
+            self._reductions = {}
+        try:
+            return self._reductions[reduction]
+        except KeyError:
+            pass
+        value = self._reductions[reduction] = type(self)._reduce_many([self], reduction)[0]
+        return value
+
+    @classmethod
+    def _reduce_many(cls, envelopes, reduction):
+        # compute (not look up) a reduction of each of envelopes, all of cls
+        return [e._reduce(reduction) for e in envelopes]
+
+    def _reduce(self, reduction):
+        if reduction == "peak":
+            return max([dp.level for dp in self.envelope])
+        if reduction == "min":
+            return min([dp.level for dp in self.envelope])
+        if reduction == "rms":
+            # the mean square of each linear segment, weighted by its length
+            square = 0.0
+            dp_prev = self.envelope[0]
+            for dp in self.envelope[1:]:
+                (a, b) = (dp_prev.level, dp.level)
+                square += ((a * a + a * b + b * b) / 3.0) * float(dp_prev.duration)
+                dp_prev = dp
+            return math.sqrt(square)
+        if reduction == "average":
+            level = 0.0
+            dp_prev = self.envelope[0]
+            for dp in self.envelope[1:]:
+                segment_average = (dp_prev.level + dp.level) / 2.0
+                level += (segment_average * float(dp_prev.duration))
+                dp_prev = dp
+            return level
+        (_, points) = reduction
+        if points == 1:
+            return (self.initial_level(),)
+        levels = []
+        for i in range(points):
+            time = to_ratio(i) / to_ratio(points - 1)
+            levels.append(self._segment_level(self._segment_index(time), time))
+        return tuple(levels)
+
+    def breakpoint_times(self):
+        """
+        Cumulative start time of each envelope point. The index is built once
+        and cached (normalize() invalidates it) so that slicing can locate
+        segments by binary search.
+        """
+        if self._times is None:
+            times = []
+            current_time = to_ratio(0)
+            for dp in self.envelope:
+                times.append(current_time)
+                current_time = current_time + to_ratio(dp.duration)
+            self._times = times
+        return self._times
+
+    def _segment_index(self, time):
+        # index of the segment (point i to point i + 1) containing time; a
+        # time on a breakpoint belongs to the segment ending there
+        i = bisect.bisect_left(self.breakpoint_times(), time, 1) - 1
+        return min(i, len(self.envelope) - 2)
+
+    def _segment_level(self, i, time):
+        dp_a = self.envelope[i]
+        dp_b = self.envelope[i + 1]
+        if dp_a.duration == 0:
+            return dp_b.level
+        slope = (dp_b.level - dp_a.level) / float(dp_a.duration)
+        return (slope * float(time - self.breakpoint_times()[i])) + dp_a.level
 
     def slice(self, start, duration):
-        if duration > dec.Decimal(1.0) or start > dec.Decimal(1.0):
+        key = (self, start, duration)
+        result = _slice_cache.get(key)
+        if result is None:
+            result = self._slice(start, duration).intern()
+            _slice_cache.put(key, result)
+        return result
+
+    def _slice(self, start, duration):
+        if duration > 1 or start > 1:
             raise ValueError("slice parameters should be fractions")
-        if duration < dec.Decimal(0.0) or start < dec.Decimal(0.0):
+        if duration < 0 or start < 0:
             raise ValueError("negative slice parameters not allowed")
+        start = to_ratio(start)
+        duration = to_ratio(duration)
         slice_end_time = start + duration
-        if slice_end_time > dec.Decimal(1.0):
-            duration = dec.Decimal(1.0) - dec.Decimal(start)
+        if slice_end_time > 1:
+            slice_end_time = to_ratio(1)
+            duration = slice_end_time - start
 
-        # find slice
-        envelope_length = len(self.envelope)
-        slice_envelope = []
-        dp_a = self.envelope[0]
-        segment_start_time = decZero
-        segment_end_time = dp_a.duration
+        times = self.breakpoint_times()
+        first = self._segment_index(start)
+        if duration == 0:
+            level = self._segment_level(first, start)
+            return Dynamics([(level, 1), (level, 0)], self.absolute)
+        last = self._segment_index(slice_end_time)
 
         # leftmost element
-        for i in range(1, envelope_length):
-            dp_b = self.envelope[i]
-            if segment_end_time >= start:
-                break
-            dp_a = dp_b
-            segment_start_time = segment_end_time
-            segment_end_time = segment_end_time + dp_a.duration
-
-        initial_level_slope = (dp_b.level - dp_a.level) / float(dp_a.duration)
-        initial_time_offset = start - segment_start_time
-        initial_level = (initial_level_slope * float(initial_time_offset)) + dp_a.level
-        initial_duration = min((segment_end_time - start), duration)
-
-        slice_envelope.append((initial_level, initial_duration))
+        initial_level = self._segment_level(first, start)
+        initial_duration = min((times[first + 1] - start), duration)
+        slice_envelope = [(initial_level, initial_duration)]
 
         # middle elements
-        for i in range(i, envelope_length):
-            dp_b = self.envelope[i]
-            if segment_end_time >= slice_end_time:
-                break
-            slice_envelope.append((dp_b.level, dp_b.duration))
-            # print slice_envelope
-            dp_a = dp_b
-            segment_start_time = segment_end_time
-            segment_end_time = segment_end_time + dp_a.duration
+        for i in range(first + 1, last + 1):
+            dp = self.envelope[i]
+            slice_envelope.append((dp.level, dp.duration))
 
         # rightmost element
-        final_level_slope = (dp_b.level - dp_a.level) / float(dp_a.duration)
-        final_time_offset = slice_end_time - segment_start_time
-        final_level = (final_level_slope * float(final_time_offset)) + dp_a.level
+        final_level = self._segment_level(last, slice_end_time)
+        final_time_offset = slice_end_time - times[last]
 
         # update last duration
         (prev_level, prev_duration) = slice_envelope.pop()
@@ -156,148 +417,105 @@ class Dynamics(object):
         slice_envelope.append((final_level, 0))
 
         return Dynamics(slice_envelope, self.absolute)
-    
+
+    def slice_many(self, starts, durations):
+        """
+        Slice this envelope once per (start, duration) pair, e.g. for every
+        child of a Track or Gesture. Returns a list of Dynamics.
+        """
+        return [self.slice(start, duration)
+                for (start, duration) in zip(starts, durations)]
+
     def add(self, addend):
         if (self.absolute and addend.absolute):
             raise ValueError("cannot add two absolute dynamics descriptors")
-        if (addend.absolute):
-            base = addend.envelope
-            mod = self.envelope
-        else:
-            base = self.envelope
-            mod = addend.envelope
+        key = (self, addend)
+        result = _add_cache.get(key)
+        if result is None:
+            result = self._add(addend).intern()
+            _add_cache.put(key, result)
+        return result
 
-        #self.dump()
-        #addend.dump()
-        sum_env = []
+    def _add(self, addend):
+        return Dynamics.sum(self, addend)
 
+    @classmethod
+    def sum(cls, *envelopes):
         """
-        take a base segment (i.e. two points)
-        calculate its slope
-        if its first endpoint matches a mod point
-            add their levels together
-            append to the final point list
-        for any mod points within the base segment
-            calculate base level at that point
-            add to the mod level
-            append to the final point list
-        if segment's final endoint matches a mod point
-            add their levels together
-            append to the final point list
-        else
-            find the associated mod segment
-            calculate mod level at that point
-            add base and mod levels
-            append to the final point list
-
+        Add any number of envelopes in one pass. At most one of them may be
+        absolute (the result is absolute if one is). Every breakpoint of every
+        envelope appears in the result, its level being the sum of all the
+        envelopes' levels at that time, clamped to [0, 1]; where one of them
+        steps (has a zero-length segment) the result steps too, from the sum
+        of the levels before to the sum after. With more than two operands
+        the clamping happens once, after summing, rather than after each
+        pairwise add().
         """
-        dp_base_a = base[0]
-        base_segment_start = decZero
-        base_segment_end = dp_base_a.duration
-        base_point_count = len(base)
-
-        for i_base in range(1, base_point_count):
-            dp_base_b = base[i_base]
-            base_segment_slope = (dp_base_b.level - dp_base_a.level) / float(dp_base_a.duration)
-
-            dp_mod_a = mod[0]
-            mod_segment_start = 0.
-            mod_segment_end = dp_mod_a.duration
-            mod_point_count = len(mod)
-
-            for i_mod in range(1, mod_point_count):
-                dp_mod_b = mod[i_mod]
-                mod_segment_slope = (dp_mod_b.level - dp_mod_a.level) / float(dp_mod_a.duration)
-
-                if (mod_segment_start >= base_segment_end):
-                    # past the end of the base segment; go to next base segment
-                    break
-
-                if (mod_segment_start == base_segment_start):
-                    # beginning of mod segment coincides with beginning of base segment;
-                    # just add the two levels together
-                    sum_point = (dp_base_a.level + dp_mod_a.level, base_segment_start)
-                    sum_env.append(sum_point)
-
-                elif (mod_segment_start > base_segment_start):
-                    # mod segment begins inside base segment; calculate the immediate
-                    # base level and add it to the mod level
-                    base_segment_offset = mod_segment_start - base_segment_start
-                    base_segment_level = (base_segment_slope * float(base_segment_offset)) + dp_base_a.level
-                    sum_point = (base_segment_level + dp_mod_a.level, mod_segment_start)
-                    sum_env.append(sum_point)
-
-                elif (mod_segment_end > base_segment_start):
-                    # current mod segment overlaps the beginning of the base segment;
-                    # calculate the immediate mod level and add it to the base level
-                    mod_segment_offset = base_segment_start - mod_segment_start
-                    mod_segment_level = (mod_segment_slope * float(mod_segment_offset)) + dp_mod_a.level
-                    sum_point = (dp_base_a.level + mod_segment_level, base_segment_start)
-                    sum_env.append(sum_point)
-
-                else:
-                    # haven't reached base segment yet; keep iterating
-                    pass
-
-                # set up for next iteration
-                dp_mod_a = dp_mod_b
-                mod_segment_start = mod_segment_end
-                mod_segment_end = mod_segment_end + dp_mod_a.duration
-
-            # set up for next iteration
-            dp_base_a = dp_base_b
-            base_segment_start = base_segment_end
-            base_segment_end = base_segment_end + dp_base_a.duration
+        absolute = _sum_is_absolute(envelopes)
+        if any(isinstance(e, ArrayDynamics) for e in envelopes):
+            # mixed operands are promoted to the numpy backend
+            return ArrayDynamics.sum(*envelopes)
 
-        # the end of the envelopes are a special case
-        sum_point = (base[-1].level + mod[-1].level, dec.Decimal(1.0))
-        sum_env.append(sum_point)
+        """
+        merge the (sorted) breakpoint times of all the envelopes, leaving
+        out each envelope's final point
+        for each distinct time
+            advance each envelope's cursor to the segment containing it
+            calculate each envelope's level there and add them together
+            append to the final point list
+            (if an envelope steps there, first the sum of the levels
+            before the step)
+        the ends of the envelopes are a special case: add the final levels
+        """
+        all_times = [e.breakpoint_times() for e in envelopes]
+        step_times = set()
+        for (e, times) in zip(envelopes, all_times):
+            step_times.update(times[i] for i in range(1, len(times) - 1)
+                              if e.envelope[i].duration == 0)
+        cursors = [0] * len(envelopes)
+        sum_env = []
+        previous_time = None
+        for time in heapq.merge(*[times[:-1] for times in all_times]):
+            if time == previous_time:
+                continue
+            previous_time = time
+            if time in step_times:
+                sum_level = 0.0
+                for e in envelopes:
+                    sum_level += e._segment_level(e._segment_index(time), time)
+                sum_env.append((sum_level, time))
+            sum_level = 0.0
+            for k in range(len(envelopes)):
+                times = all_times[k]
+                i = cursors[k]
+                while i < len(times) - 2 and times[i + 1] <= time:
+                    i += 1
+                cursors[k] = i
+                sum_level += envelopes[k]._segment_level(i, time)
+            sum_env.append((sum_level, time))
+
+        sum_level = 0.0
+        for e in envelopes:
+            sum_level += e.final_level()
+        sum_env.append((sum_level, to_ratio(1)))
 
         # convert absolute times to durations
         dur_env = []
-        sum_point_count = len(sum_env)
         sum_point_a = sum_env[0]
-
-        for i_sum in range(1, sum_point_count):
-            sum_point_b = sum_env[i_sum]
-            sum_level = sum_point_a[0]
-            if (sum_level > 1.0):
-                sum_level = 1.0
-            elif (sum_level < 0.0):
-                sum_level = 0.0
-            dur_point = (sum_level, (sum_point_b[1] - sum_point_a[1]))
+        for sum_point_b in sum_env[1:]:
+            dur_point = (_clamp_level(sum_point_a[0]), (sum_point_b[1] - sum_point_a[1]))
             dur_env.append(dur_point)
-
             sum_point_a = sum_point_b
 
         # last point (zero duration)
-        sum_level = sum_point_a[0]
-        if (sum_level > 1.0):
-            sum_level = 1.0
-        elif (sum_level < 0.0):
-            sum_level = 0.0
-        dur_point = (sum_level, decZero)
-        dur_env.append(dur_point)
-
-        return Dynamics(dur_env, self.absolute or addend.absolute)
+        dur_env.append((_clamp_level(sum_point_a[0]), 0))
 
-    def plot(self):
-        if self.absolute:
-            axes_spec = [0., 1., 0., 1.]
-        else:
-            axes_spec = [0., 1., -1., 1.]
+        return Dynamics(dur_env, absolute)
 
-        levels = []
-        times = []
-        current_time = 0.
-        for dp in self.envelope:
-            levels.append(dp.level)
-            times.append(current_time)
-            current_time = current_time + dp.duration
-        plt.plot(times, levels)
-        plt.ylabel('level')
-        plt.axis(axes_spec)
-        plt.show()
+    def plot(self, show=True):
+        # matplotlib is only imported once something is plotted
+        import dynplot
+        dynplot.plot_dynamics(self, show)
 
     def dump(self):
         pair_env = [(dp.level, dp.duration) for dp in self.envelope]
@@ -309,6 +527,365 @@ class Dynamics(object):
         print("{0} {1}".format(abs_string, pair_env))
 
 
+class ArrayDynamics(Dynamics):
+    """
+    A Dynamics whose envelope is held in two contiguous NumPy arrays: the
+    normalized (cumulative) time of each breakpoint and the level at that
+    breakpoint. normalize, slice, add and average_level are vectorized, and
+    times are plain floats rather than Decimals.
+
+    Results agree with the list implementation to within `tolerance` in both
+    level and time at every breakpoint, steps (zero-length segments)
+    included: a level is looked up with the same one-sided rule as there
+    (see _levels_at). Only a time that rounds differently here (as a float)
+    and there (as a Decimal) onto either side of a step can find the level
+    on the other side of it.
+    """
+
+    tolerance = 1e-9
+
+    def __init__(self, envelope=[(decZero, dec.Decimal(1.)),
+            (decZero, decZero)], absolute=False):
+        if _import_numpy() is None:
+            raise ImportError("the numpy Dynamics backend requires numpy")
+        points = np.array([(float(point[0]), float(point[1])) for point in envelope],
+                          dtype=float).reshape(-1, 2)
+        durations = points[:, 1]
+        self.levels = points[:, 0]
+        self.times = np.concatenate(([0.], np.cumsum(durations[:-1])))
+        # from the same running sum, so the last length can't come out -1 ulp
+        self._span = float(self.times[-1] + durations[-1])
+        self.absolute = absolute
+        self._key = None
+        self._reductions = None
+        self.normalize()
+
+    @classmethod
+    def from_arrays(cls, times, levels, absolute=False):
+        """Build directly from normalized breakpoint times and levels."""
+        dynamics = object.__new__(cls)
+        dynamics.times = times
+        dynamics.levels = levels
+        dynamics._span = 1.0
+        dynamics.absolute = absolute
+        dynamics._key = None
+        dynamics._reductions = None
+        dynamics._freeze()
+        return dynamics
+
+    def _freeze(self):
+        self.times.flags.writeable = False
+        self.levels.flags.writeable = False
+
+    def __setstate__(self, state):
+        _import_numpy()  # unpickling the arrays imported numpy, not np
+        self.__dict__.update(state)
+        self._freeze()
+
+    def _value_key(self):
+        if self._key is None:
+            self._key = (type(self), self.absolute, self.times.tobytes(), self.levels.tobytes())
+        return self._key
+
+    @classmethod
+    def from_dynamics(cls, dynamics):
+        if isinstance(dynamics, cls):
+            return dynamics
+        return cls([(dp.level, dp.duration) for dp in dynamics.envelope],
+                   dynamics.absolute)
+
+    @property
+    def envelope(self):
+        # DP view, for code that walks the envelope of either backend
+        return [DP(level, duration)
+                for (level, duration) in zip(self.levels, self.durations())]
+
+    def durations(self):
+        return np.diff(np.append(self.times, self._span))
+
+    def normalize(self):
+        if (self.durations() < 0.).any():
+            raise ValueError("negative length not allowed")
+
+        highest_level = np.abs(self.levels).max()
+        if highest_level == 0:
+            self.levels = np.zeros_like(self.levels)
+        elif highest_level > 1.0:
+            self.levels = self.levels / highest_level
+        self.times = self.times / self._span
+        self._span = 1.0
+        self._key = None
+        self._reductions = None
+        self._freeze()
+
+    def initial_level(self):
+        return float(self.levels[0])
+
+    def final_level(self):
+        return float(self.levels[-1])
+
+    @classmethod
+    def _reduce_many(cls, envelopes, reduction):
+        # all the envelopes' breakpoints end to end, each envelope's segments
+        # running from starts[k]; the segment from an envelope's last point
+        # (into the next envelope) is given zero length
+        sizes = np.array([len(e.levels) for e in envelopes])
+        starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        levels = np.concatenate([e.levels for e in envelopes])
+        if reduction == "average":
+            # one dot product each, which keeps the averages (and so the
+            # scores written) the same as average_level always gave
+            return [float(np.dot((e.levels[:-1] + e.levels[1:]) * 0.5, np.diff(e.times)))
+                    for e in envelopes]
+        if reduction == "peak":
+            return np.maximum.reduceat(levels, starts).tolist()
+        if reduction == "min":
+            return np.minimum.reduceat(levels, starts).tolist()
+        if reduction == "rms":
+            times = np.concatenate([e.times for e in envelopes])
+            lengths = np.append(np.diff(times), 0.)
+            lengths[starts[1:] - 1] = 0.
+            a = levels
+            b = np.append(levels[1:], 0.)
+            squares = np.add.reduceat((a * a + a * b + b * b) / 3.0 * lengths, starts)
+            return np.sqrt(squares).tolist()
+        (_, points) = reduction
+        if points == 1:
+            return [(float(e.levels[0]),) for e in envelopes]
+        times = np.linspace(0., 1., points)
+        return [tuple(e.level_at(times).tolist()) for e in envelopes]
+
+    def level_at(self, times):
+        return self._levels_at(times, "left")
+
+    def _levels_at(self, times, side):
+        # the level at each of times found as the list backend finds it: a
+        # time on a breakpoint is in the segment ending there (side "left",
+        # as _segment_index) or starting there (side "right", as sum), and
+        # a zero-length segment has the level after it (as _segment_level)
+        times = np.asarray(times, dtype=float)
+        if len(self.times) < 2:
+            return np.full_like(times, self.levels[0])
+        i = np.searchsorted(self.times, times, side=side) - 1
+        np.clip(i, 0, len(self.times) - 2, out=i)
+        lengths = self.times[i + 1] - self.times[i]
+        steps = lengths == 0
+        slopes = (self.levels[i + 1] - self.levels[i]) / np.where(steps, 1., lengths)
+        levels = slopes * (times - self.times[i]) + self.levels[i]
+        return np.where(steps, self.levels[i + 1], levels)
+
+    def breakpoint_times(self):
+        return self.times
+
+    def _slice(self, start, duration):
+        return self._slice_many([start], [duration])[0]
+
+    def slice_many(self, starts, durations):
+        starts = list(starts)
+        durations = list(durations)
+        slices = [_slice_cache.get((self, s, d)) for (s, d) in zip(starts, durations)]
+        missing = [i for (i, result) in enumerate(slices) if result is None]
+        if missing:
+            computed = self._slice_many([starts[i] for i in missing],
+                                        [durations[i] for i in missing])
+            for (i, result) in zip(missing, computed):
+                slices[i] = result.intern()
+                _slice_cache.put((self, starts[i], durations[i]), slices[i])
+        return slices
+
+    def _slice_many(self, starts, durations):
+        starts = np.asarray(starts, dtype=float)
+        durations = np.asarray(durations, dtype=float)
+        if (durations > 1.0).any() or (starts > 1.0).any():
+            raise ValueError("slice parameters should be fractions")
+        if (durations < 0.0).any() or (starts < 0.0).any():
+            raise ValueError("negative slice parameters not allowed")
+        ends = np.minimum(starts + durations, 1.0)
+
+        # interior breakpoints of each slice are times[lo:hi]: the ends of
+        # the segments containing its start up to the one containing its
+        # end, a boundary on a breakpoint being in the segment ending there
+        last = max(len(self.times) - 2, 0)
+        lows = np.clip(np.searchsorted(self.times, starts, side='left') - 1, 0, last) + 1
+        highs = np.clip(np.searchsorted(self.times, ends, side='left') - 1, 0, last) + 1
+        start_levels = self._levels_at(starts, "left")
+        end_levels = self._levels_at(ends, "left")
+
+        slices = []
+        for (start, end, lo, hi, start_level, end_level) in zip(
+                starts, ends, lows, highs, start_levels, end_levels):
+            if end <= start:
+                times = np.array([0., 1.])
+                levels = np.array([start_level, start_level])
+            else:
+                times = np.concatenate(([start], self.times[lo:hi], [end]))
+                times = (times - start) / (end - start)
+                levels = np.concatenate(([start_level], self.levels[lo:hi], [end_level]))
+            slices.append(self.from_arrays(times, levels, self.absolute))
+        return slices
+
+    def _add(self, addend):
+        return self.sum(self, addend)
+
+    @classmethod
+    def sum(cls, *envelopes):
+        absolute = _sum_is_absolute(envelopes)
+        envelopes = [cls.from_dynamics(e) for e in envelopes]
+
+        # every breakpoint of every envelope, each summed with the other
+        # envelopes' levels at that time, clamped to [0, 1]
+        times = envelopes[0].times
+        for e in envelopes[1:]:
+            times = np.union1d(times, e.times)
+        levels = np.zeros_like(times)
+        for e in envelopes:
+            levels += e._levels_at(times, "right")
+        # where an envelope steps, the sum of the levels before the step
+        # goes in just before the sum after it
+        steps = np.unique(np.concatenate([e.times[1:-1][np.diff(e.times)[1:] == 0]
+                                          for e in envelopes]))
+        if len(steps):
+            before = np.zeros_like(steps)
+            for e in envelopes:
+                before += e._levels_at(steps, "left")
+            order = np.argsort(np.concatenate((steps, times)), kind="stable")
+            times = np.concatenate((steps, times))[order]
+            levels = np.concatenate((before, levels))[order]
+        np.clip(levels, 0.0, 1.0, out=levels)
+        return cls.from_arrays(times, levels, absolute)
+
+
+def _new_dynamics(cls):
+    return object.__new__(cls)
+
+
+dynamics_reductions = ("average", "peak", "min", "rms", "sampled")
+
+
+def reduce_dynamics(envelopes, reduction="average", points=None):
+    """
+    A reduction of each of envelopes, as a list: "average", "peak", "min",
+    "rms" (levels) or "sampled" (a tuple of the levels at points evenly
+    spaced times). The same as calling e.g. average_level() on each, but
+    the envelopes whose reduction isn't cached yet are reduced together,
+    in one vectorized pass for the numpy backend, and the results cached.
+    """
+    if reduction not in dynamics_reductions:
+        raise ValueError("unknown reduction {0!r}".format(reduction))
+    if reduction == "sampled":
+        if points is None or points < 1:
+            raise ValueError("sampling needs a number of points")
+        reduction = (reduction, points)
+    envelopes = list(envelopes)
+    results = [None] * len(envelopes)
+    missing = collections.OrderedDict()  # class -> {id: envelope}
+    for (i, e) in enumerate(envelopes):
+        if e._reductions is not None and reduction in e._reductions:
+            results[i] = e._reductions[reduction]
+        else:
+            missing.setdefault(type(e), collections.OrderedDict())[id(e)] = e
+    for (cls, pending) in missing.items():
+        pending = list(pending.values())
+        for (e, value) in zip(pending, cls._reduce_many(pending, reduction)):
+            if e._reductions is None:
+                e._reductions = {}
+            e._reductions[reduction] = value
+    for (i, e) in enumerate(envelopes):
+        if results[i] is None:
+            results[i] = e._reductions[reduction]
+    return results
+
+
+def _clamp_level(level):
+    if (level > 1.0):
+        return 1.0
+    elif (level < 0.0):
+        return 0.0
+    return level
+
+
+def _sum_is_absolute(envelopes):
+    absolute_count = len([e for e in envelopes if e.absolute])
+    if absolute_count > 1:
+        raise ValueError("cannot add two absolute dynamics descriptors")
+    return absolute_count == 1
+
+
+class _LRUCache(object):
+    """A mapping holding at most maxsize entries, dropping the least recently used."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            return None
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._trim()
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        self._trim()
+
+    def _trim(self):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+_interned_dynamics = weakref.WeakValueDictionary()
+_slice_cache = _LRUCache(4096)
+_add_cache = _LRUCache(4096)
+
+
+def set_dynamics_cache_size(maxsize):
+    """Bound the slice() and add() memo caches to maxsize entries each."""
+    _slice_cache.resize(maxsize)
+    _add_cache.resize(maxsize)
+
+
+def clear_dynamics_caches():
+    _interned_dynamics.clear()
+    _slice_cache.clear()
+    _add_cache.clear()
+
+
+_dynamics_backends = {
+    "list": Dynamics,
+    "numpy": ArrayDynamics,
+}
+_dynamics_backend = Dynamics
+
+
+def set_dynamics_backend(name):
+    """
+    Select the envelope representation constructed by Dynamics(...): "list"
+    (the default, a list of DP objects) or "numpy" (ArrayDynamics). Returns
+    the name of the previously selected backend.
+    """
+    global _dynamics_backend
+    if name not in _dynamics_backends:
+        raise ValueError("unknown dynamics backend {0!r}".format(name))
+    if name == "numpy" and _import_numpy() is None:
+        raise ImportError("the numpy Dynamics backend requires numpy")
+    previous = [n for (n, b) in _dynamics_backends.items() if b is _dynamics_backend][0]
+    _dynamics_backend = _dynamics_backends[name]
+    return previous
+
+
+# the default, "no change" relative envelope shared by every constructor
+dynZero = Dynamics().intern()
+
+
 class Articulation:
     """
     An Articulation is a hint to a note (or group of notes) about how to
@@ -317,6 +894,632 @@ class Articulation:
     full, staccato, legato = range(3)
 
 
+def format_events(events):
+    """Format a batch of parameter lists as CSound "i" statements."""
+    return "".join(["i {0}\n".format(" ".join(map(str, params))) for params in events])
+
+
+class ScoreWriter(object):
+    """
+    A ScoreWriter is the destination for rendered score text. It wraps any
+    file-like object with a write() method, defaulting to whatever
+    sys.stdout is at the time of writing. Every emit() method accepts one
+    (or a bare file-like object, which gets wrapped).
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def write(self, text):
+        (self.stream or sys.stdout).write(text)
+
+    def writeline(self, text=""):
+        self.write(text + "\n")
+
+    def event(self, params):
+        self.write(format_events([params]))
+
+    def events(self, batch):
+        """Write a batch of events, each a parameter list as event() takes."""
+        if batch:
+            self.write(format_events(batch))
+
+    def flush(self):
+        stream = self.stream or sys.stdout
+        if hasattr(stream, "flush"):
+            stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+
+class BufferWriter(ScoreWriter):
+    """
+    A ScoreWriter that renders into memory; getvalue() returns the text.
+    """
+
+    def __init__(self):
+        super(BufferWriter, self).__init__(io.StringIO())
+
+    def getvalue(self):
+        return self.stream.getvalue()
+
+
+class ChunkedWriter(ScoreWriter):
+    """
+    A ScoreWriter that collects output and hands it to the underlying stream
+    in writes of roughly buffer_size characters. Events are queued as
+    parameter lists and formatted a batch at a time. Remember to flush()
+    (or use it as a context manager) when rendering is finished; Song.emit
+    and Section.emit flush on their way out.
+    """
+
+    event_batch_size = 1024
+
+    def __init__(self, stream=None, buffer_size=1 << 16):
+        super(ChunkedWriter, self).__init__(stream)
+        self.buffer_size = buffer_size
+        self._chunks = []
+        self._size = 0
+        self._events = []
+
+    def _format_events(self):
+        if self._events:
+            text = format_events(self._events)
+            self._events = []
+            self._chunks.append(text)
+            self._size += len(text)
+
+    def write(self, text):
+        self._format_events()
+        self._chunks.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size:
+            self._write_chunks()
+
+    def event(self, params):
+        self._events.append(params)
+        if len(self._events) >= self.event_batch_size:
+            self._format_events()
+            if self._size >= self.buffer_size:
+                self._write_chunks()
+
+    def events(self, batch):
+        self._events.extend(batch)
+        if len(self._events) >= self.event_batch_size:
+            self._format_events()
+            if self._size >= self.buffer_size:
+                self._write_chunks()
+
+    def _write_chunks(self):
+        if self._chunks:
+            super(ChunkedWriter, self).write("".join(self._chunks))
+            self._chunks = []
+            self._size = 0
+
+    def flush(self):
+        self._format_events()
+        self._write_chunks()
+        super(ChunkedWriter, self).flush()
+
+
+def score_writer(out=None):
+    """Return out as a ScoreWriter, wrapping a file-like object if needed."""
+    if isinstance(out, ScoreWriter):
+        return out
+    return ScoreWriter(out)
+
+
+class ScoreEvent(collections.namedtuple("ScoreEvent",
+                                         "instr times dynamics pitch other portamento")):
+    """
+    A ScoreEvent is one rendered CSound "i" statement: the instrument number
+    followed by the lists of parameters produced by the Instrument's
+    time_params, dynamic_params, pitch_params and other_params hooks. It also
+    carries the portamento cookie handed on to the next note of a Gesture.
+    """
+    __slots__ = ()
+
+    @property
+    def start(self):
+        return self.times[0]
+
+    @property
+    def duration(self):
+        return self.times[1]
+
+    def params(self):
+        return [self.instr] + self.times + self.dynamics + self.pitch + self.other
+
+    @classmethod
+    def from_params(cls, params, portamento=None):
+        """
+        The ScoreEvent for an "i" statement's parameters, from wherever
+        they came; which hook produced which isn't known, so everything
+        after the times counts as other.
+        """
+        params = list(params)
+        return cls(params[0], params[1:3], [], [], params[3:], portamento)
+
+
+class EmittedNote(collections.namedtuple("EmittedNote", "statements portamento")):
+    """
+    What an Instrument overriding emit() wrote for one note, recorded as
+    score statements (ScoreEvents and lines of text; see RecordingWriter),
+    and the portamento cookie it returned.
+    """
+    __slots__ = ()
+
+
+class RecordingWriter(ScoreWriter):
+    """
+    A ScoreWriter that keeps what is written as a list of score statements
+    (see write_statements): a ScoreEvent for each event and a str for each
+    line of text, so that it can be written again to any other writer.
+    Call flush() to keep a last line not ended yet.
+    """
+
+    def __init__(self):
+        super(RecordingWriter, self).__init__()
+        self.statements = []
+        self._line = ""
+
+    def write(self, text):
+        lines = (self._line + text).split("\n")
+        self._line = lines.pop()
+        self.statements.extend(lines)
+
+    def event(self, params):
+        self.flush()
+        self.statements.append(ScoreEvent.from_params(params))
+
+    def events(self, batch):
+        for params in batch:
+            self.event(params)
+
+    def flush(self):
+        if self._line:
+            self.statements.append(self._line)
+            self._line = ""
+
+
+def _note_statements(events):
+    # the score statements of rendered notes (see Instrument.events_many):
+    # ScoreEvents as they are, and what was recorded for each EmittedNote
+    for event in events:
+        if isinstance(event, EmittedNote):
+            for statement in event.statements:
+                yield statement
+        else:
+            yield event
+
+
+def events_only(statements):
+    """Filter a stream of score statements down to its ScoreEvents."""
+    return (s for s in statements if isinstance(s, ScoreEvent))
+
+
+def write_statements(statements, out=None, batch_size=256):
+    """
+    Write a stream of score statements: ScoreEvents become "i" statements,
+    anything else is a line of literal score text. Runs of events are
+    handed to the writer batch_size at a time (see ScoreWriter.events).
+    """
+    out = score_writer(out)
+    batch = []
+    for statement in statements:
+        if isinstance(statement, ScoreEvent):
+            batch.append(statement.params())
+            if len(batch) >= batch_size:
+                out.events(batch)
+                batch = []
+        else:
+            if batch:
+                out.events(batch)
+                batch = []
+            out.writeline(statement)
+    if batch:
+        out.events(batch)
+
+
+class RenderJob(collections.namedtuple("RenderJob", "track start dynamics window")):
+    """
+    A RenderJob stands in for a Track in a render plan: the Track, the start
+    time and the parent dynamics it is to be rendered with, and the window
+    of score time to render (None for all of it; see Track.iter_events).
+    Once those are known a Track renders independently of every other, so
+    jobs can be farmed out to other processes (see write_plan).
+    """
+    __slots__ = ()
+
+    def __new__(cls, track, start, dynamics, window=None):
+        return super(RenderJob, cls).__new__(cls, track, start, dynamics, window)
+
+    def iter_statements(self):
+        return self.track.iter_statements(self.start, self.dynamics, self.window)
+
+    def render(self):
+        """
+        Render the job as records that pickle cheaply (see write_records):
+        a str for each line of score text and a list of parameter lists for
+        each run of events.
+        """
+        records = []
+        for statement in self.iter_statements():
+            if isinstance(statement, ScoreEvent):
+                if not records or not isinstance(records[-1], list):
+                    records.append([])
+                records[-1].append(statement.params())
+            else:
+                records.append(statement)
+        return records
+
+
+def write_records(records, out=None):
+    """Write what RenderJob.render returned, the events still as events."""
+    out = score_writer(out)
+    for record in records:
+        if isinstance(record, list):
+            out.events(record)
+        else:
+            out.writeline(record)
+
+
+def expand_jobs(plan):
+    """Render a plan serially into a stream of score statements."""
+    for item in plan:
+        if isinstance(item, RenderJob):
+            for statement in item.iter_statements():
+                yield statement
+        else:
+            yield item
+
+
+def _render_settings():
+    backend = [n for (n, b) in _dynamics_backends.items() if b is _dynamics_backend][0]
+    return (_time_mode, _ticks_per_quarter, backend)
+
+
+def _init_render_worker(settings):
+    (mode, ticks_per_quarter, backend) = settings
+    if (_time_mode, _ticks_per_quarter) != (mode, ticks_per_quarter):
+        set_time_mode(mode, ticks_per_quarter)
+    set_dynamics_backend(backend)
+
+
+def _render_job(job):
+    return job.render()
+
+
+def worker_pool(processes=None):
+    """
+    A multiprocessing.Pool whose workers use this process's time mode and
+    Dynamics backend, for rendering or converting score objects in parallel.
+    """
+    return multiprocessing.Pool(processes, _init_render_worker, (_render_settings(),))
+
+
+# bump to invalidate every DiskCache entry written by older code
+_cache_version = 5
+
+
+def cache_key(*parts):
+    """
+    A DiskCache key for a value computed from parts (anything picklable),
+    under the current time mode and Dynamics backend.
+    """
+    stream = io.BytesIO()
+    pickler = pickle.Pickler(stream, pickle.HIGHEST_PROTOCOL)
+    # no memo, so equal values give equal bytes however their parts are shared
+    pickler.fast = True
+    pickler.dump((_cache_version, _render_settings()) + parts)
+    return hashlib.sha256(stream.getvalue()).hexdigest()
+
+
+class DiskCache(object):
+    """
+    A DiskCache keeps pickled values in a directory, one file per key (see
+    cache_key), so that they survive from one run to the next. Nothing is
+    ever evicted; clear() empties it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def load(self, key):
+        """The value stored under key, or None."""
+        try:
+            with open(self._path(key), "rb") as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def store(self, key, value):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        # another process may be making it at the same time
+        os.makedirs(directory, exist_ok=True)
+        # write then rename, so a reader never sees half a file
+        (fd, temp_path) = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def clear(self):
+        for (dirpath, dirnames, filenames) in os.walk(self.directory):
+            for name in filenames:
+                os.remove(os.path.join(dirpath, name))
+
+
+def write_plan(plan, out=None, processes=None, cache=None):
+    """
+    Write a render plan (literal lines of score text and RenderJobs). By
+    default the jobs are rendered in turn; given a number of processes, they
+    are rendered concurrently in a process pool and written in plan order,
+    so the output is the same either way. Everything a Track holds
+    (Instruments included) must then be picklable. Jobs are shipped back
+    and cached as records of events, not text (see RenderJob.render), so
+    every writer is handed the same events as in a serial render.
+
+    Given a DiskCache, the records of each job are looked up under a key made
+    from its Track (events, Instrument and all), start and parent dynamics,
+    and only the jobs not found there are rendered (and then stored). The
+    key includes the job's window, so an excerpt is cached apart from the
+    full render.
+    """
+    out = score_writer(out)
+    if not processes and cache is None:
+        write_statements(expand_jobs(plan), out)
+        return
+    plan = list(plan)
+    jobs = [item for item in plan if isinstance(item, RenderJob)]
+    keys = {}
+    found = {}
+    if cache is not None:
+        for job in jobs:
+            keys[id(job)] = key = cache_key("track", job)
+            records = cache.load(key)
+            if records is not None:
+                found[id(job)] = records
+    missing = [job for job in jobs if id(job) not in found]
+
+    pool = worker_pool(processes) if processes and missing else None
+    try:
+        if pool is not None:
+            rendered = pool.imap(_render_job, missing)
+        else:
+            rendered = (job.render() for job in missing)
+        for item in plan:
+            if not isinstance(item, RenderJob):
+                out.writeline(item)
+            elif id(item) in found:
+                write_records(found[id(item)], out)
+            else:
+                records = next(rendered)
+                if cache is not None:
+                    cache.store(keys[id(item)], records)
+                write_records(records, out)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+class TempoMap(object):
+    """
+    A TempoMap is the tempo of a Section: (time, tempo) points, tempo in
+    beats per minute, kept sorted by time. As in a csound "t" statement the
+    tempo ramps linearly (in beats) from one point to the next, two points
+    at the same time make a sudden change, and the tempo holds before the
+    first point and after the last. With no points it is 60 (one beat a
+    second).
+
+    The time in seconds at every point is worked out once (after the points
+    change) so that converting between beats and seconds is a binary search
+    and a closed-form integral over one segment. seconds_many converts many
+    times at once, vectorized when numpy is available.
+    """
+
+    def __init__(self, points=()):
+        self.points = []
+        self.extend(points)
+
+    def add(self, when, tempo):
+        """Add one point; points given for the same time keep their order."""
+        point = (to_time(when), self._check(tempo))
+        self.points.insert(bisect.bisect_right([p[0] for p in self.points], point[0]), point)
+        self._index = None
+
+    def extend(self, points):
+        """Add many points, sorting once."""
+        self.points.extend([(to_time(when), self._check(tempo)) for (when, tempo) in points])
+        self.points.sort(key=lambda point: point[0])
+        self._index = None
+
+    def _check(self, tempo):
+        if tempo <= 0:
+            raise ValueError("tempo must be positive")
+        return tempo
+
+    def __iter__(self):
+        return iter(self.points)
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self, i):
+        return self.points[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, TempoMap):
+            return NotImplemented
+        return self.points == other.points
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return {"points": self.points}
+
+    def __setstate__(self, state):
+        self.points = state["points"]
+        self._index = None
+
+    def _build_index(self):
+        # per point: beat, tempo, seconds at the point and the slope (tempo
+        # per beat) of the segment starting there, zero for the last point
+        # and for steps
+        beats = [time_to_float(when) for (when, tempo) in self.points]
+        tempi = [float(tempo) for (when, tempo) in self.points]
+        slopes = []
+        seconds = []
+        if beats:
+            elapsed = 60.0 * beats[0] / tempi[0]
+            for i in range(len(beats)):
+                seconds.append(elapsed)
+                if i + 1 < len(beats) and beats[i + 1] > beats[i]:
+                    slope = (tempi[i + 1] - tempi[i]) / (beats[i + 1] - beats[i])
+                    elapsed += self._segment_seconds(tempi[i], slope, beats[i + 1] - beats[i])
+                else:
+                    slope = 0.0
+                slopes.append(slope)
+        self._index = (beats, tempi, seconds, slopes)
+        return self._index
+
+    @staticmethod
+    def _segment_seconds(tempo, slope, beats):
+        # the integral of 60 / (tempo + slope * b) from 0 to beats
+        if slope == 0:
+            return 60.0 * beats / tempo
+        return 60.0 / slope * math.log1p(slope * beats / tempo)
+
+    @staticmethod
+    def _segment_beats(tempo, slope, seconds):
+        # the inverse of _segment_seconds
+        if slope == 0:
+            return seconds * tempo / 60.0
+        return tempo * math.expm1(slope * seconds / 60.0) / slope
+
+    def tempo_at(self, when):
+        """The tempo at a score time (in the time representation Events use)."""
+        (beats, tempi, seconds, slopes) = self._index or self._build_index()
+        if not beats:
+            return 60.0
+        beat = time_to_float(when)
+        i = bisect.bisect_right(beats, beat) - 1
+        if i < 0:
+            return tempi[0]
+        return tempi[i] + slopes[i] * (beat - beats[i])
+
+    def seconds(self, when):
+        """The time in seconds of a score time (as for tempo_at)."""
+        (beats, tempi, seconds, slopes) = self._index or self._build_index()
+        beat = time_to_float(when)
+        if not beats:
+            return beat
+        i = bisect.bisect_right(beats, beat) - 1
+        if i < 0:
+            return 60.0 * beat / tempi[0]
+        return seconds[i] + self._segment_seconds(tempi[i], slopes[i], beat - beats[i])
+
+    def beats(self, when):
+        """The time in beats, as a float, of a time in seconds."""
+        (beats, tempi, seconds, slopes) = self._index or self._build_index()
+        if not beats:
+            return float(when)
+        i = bisect.bisect_right(seconds, when) - 1
+        if i < 0:
+            return when * tempi[0] / 60.0
+        return beats[i] + self._segment_beats(tempi[i], slopes[i], when - seconds[i])
+
+    def seconds_many(self, times):
+        """seconds() of each of times (e.g. every note's start), as a list."""
+        times = [time_to_float(when) for when in times]
+        if not self.points or _import_numpy() is None:
+            return [self.seconds(when) for when in times]
+        (beats, tempi, seconds, slopes) = [np.asarray(column, dtype=float)
+                                           for column in (self._index or self._build_index())]
+        times = np.asarray(times, dtype=float)
+        i = np.searchsorted(beats, times, side="right") - 1
+        before = i < 0
+        i = np.maximum(i, 0)
+        offsets = np.where(before, times, times - beats[i])
+        origins = np.where(before, 0., seconds[i])
+        tempo = tempi[i]
+        slope = np.where(before, 0., slopes[i])
+        ramp = slope != 0
+        safe_slope = np.where(ramp, slope, 1.)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            elapsed = np.where(ramp, 60.0 / safe_slope * np.log1p(safe_slope * offsets / tempo),
+                               60.0 * offsets / tempo)
+        return (origins + elapsed).tolist()
+
+    def statement(self):
+        """The points as a csound "t" statement."""
+        tempo_statement = "\nt"
+        for t in self.points:
+            tempo_statement = tempo_statement + " {0} {1}".format(time_to_float(t[0]), float(t[1]))
+        return tempo_statement
+
+
+class IntervalIndex(object):
+    """
+    An IntervalIndex finds which of a set of intervals, given as columns of
+    starts and durations (a negative, slurred duration counting as its
+    absolute value), overlap a time window without visiting the rest. The
+    starts are kept sorted alongside the running maximum of the ends, so a
+    query is three binary searches and a scan of just the intervals that
+    start before the window and might reach into it.
+    """
+
+    def __init__(self, starts, durations):
+        self.order = sorted(range(len(starts)), key=starts.__getitem__)
+        self.starts = [starts[i] for i in self.order]
+        self.ends = [starts[i] + abs(durations[i]) for i in self.order]
+        self.max_ends = []
+        for end in self.ends:
+            if self.max_ends and self.max_ends[-1] > end:
+                end = self.max_ends[-1]
+            self.max_ends.append(end)
+
+    def __len__(self):
+        return len(self.order)
+
+    def overlapping(self, start, end):
+        """
+        The indices, ascending, of the intervals overlapping [start, end):
+        those starting before end and ending after start, or starting at or
+        after start (so an interval of no length counts if it is in the
+        window).
+        """
+        if end <= start:
+            return []
+        first = bisect.bisect_left(self.starts, start)
+        last = bisect.bisect_left(self.starts, end)
+        # of the intervals starting before the window, those before the
+        # running maximum end passes start can't reach into it
+        earliest = bisect.bisect_right(self.max_ends, start)
+        found = [self.order[k] for k in range(earliest, first) if self.ends[k] > start]
+        found.extend(self.order[first:last])
+        found.sort()
+        return found
+
+
 class Song(object):
     """
     A Song consists of one or more Sections executed sequentially. It has no notion
@@ -329,49 +1532,126 @@ class Song(object):
         self.composer = composer
         self.sections = sections
 
-    def emit(self):
-        print(";;======================================================================")
-        print(";; {0}".format(self.name))
-        print(";; by {0}".format(self.composer))
-        print(";;======================================================================")
+    def iter_plan(self, window=None):
+        """
+        The score as a render plan: lines of literal score text (comments,
+        tempo and section statements) with a RenderJob for each Track.
+
+        Given a window, a (start, end) pair of score times in the time
+        representation Events use (see to_time), only the notes sounding in
+        [start, end) are rendered (see Track.iter_statements), so a few bars
+        of a long piece can be auditioned without rendering the rest. The
+        window is in the time of the whole score, the starts of Sections,
+        Groups and Tracks included.
+        """
+        yield ";;======================================================================"
+        yield ";; {0}".format(self.name)
+        yield ";; by {0}".format(self.composer)
+        yield ";;======================================================================"
         for section in self.sections:
-            section.emit()
+            for item in section.iter_plan(window):
+                yield item
+
+    def iter_statements(self, window=None):
+        """
+        Lazily render the whole score (or a window of it, see iter_plan), in
+        score order, as a stream of ScoreEvents interleaved with lines of
+        literal score text.
+        """
+        return expand_jobs(self.iter_plan(window))
+
+    def iter_events(self, window=None):
+        return events_only(self.iter_statements(window))
+
+    def compile(self):
+        """A copy of the Song with every Section compiled (see Track.compile)."""
+        compiled = copy.copy(self)
+        compiled.sections = [section.compile() for section in self.sections]
+        return compiled
+
+    def emit(self, out=None, processes=None, cache=None, window=None):
+        """
+        Write the score, or a window of it (see iter_plan); with processes,
+        render Tracks in parallel, and with a DiskCache, reuse Tracks
+        rendered before (see write_plan).
+        """
+        out = score_writer(out)
+        write_plan(self.iter_plan(window), out, processes, cache)
+        out.flush()
 
 
 class Section(object):
     """
     A Section is a thematically-related set of Tracks or track Groups. It has an
-    optional tempo arc and an optional dynamic arc. For now the tempi are given
-    as a list of pairs of (timepoint, tempo) that can be fed more or less directly
-    into a csound "t" score statement.
+    optional tempo arc and an optional dynamic arc. The tempi are given as
+    pairs of (timepoint, tempo), kept in a TempoMap (which assigning to tempo
+    builds), and written as a csound "t" score statement.
     """
 
-    def __init__(self, name="song section", parts=[], tempo=[], start=decZero, dynamics=Dynamics()):
+    def __init__(self, name="song section", parts=[], tempo=[], start=decZero, dynamics=dynZero):
         self.name = name
         self.parts = parts
         self.tempo = tempo
-        self.start = start
+        self.start = to_time(start)
         self.dynamics = dynamics
-        self.duration = 0.
+        self.duration = to_time(0)
         for part in self.parts:
             if part.duration > self.duration:
                 self.duration = part.duration
 
+    @property
+    def tempo(self):
+        return self._tempo
+
+    @tempo.setter
+    def tempo(self, tempo):
+        if not isinstance(tempo, TempoMap):
+            tempo = TempoMap(tempo)
+        self._tempo = tempo
+
     def addTempoPoint(self, when, tempo):
-        self.tempo.append((when, tempo))
-        self.tempo.sort(key=lambda tp: tp[0])
+        self.tempo.add(when, tempo)
 
-    def emit(self):
-        print("\n;;======================================================================")
-        print(";; {0}".format(self.name))
-        tempo_statement = "\nt"
-        for t in self.tempo:
-            tempo_statement = tempo_statement + " {0} {1}".format(float(t[0]), float(t[1]))
-        print(tempo_statement)
+    def tempo_statement(self):
+        return self.tempo.statement()
+
+    def event_seconds(self):
+        """
+        The start time in seconds (under the Section's tempo) of every note
+        of every Track, in score order, converted together.
+        """
+        starts = []
+        for part in self.compile().parts:
+            for track in getattr(part, "tracks", [part]):
+                starts.extend(track.notes.starts)
+        return self.tempo.seconds_many(starts)
+
+    def iter_plan(self, window=None):
+        yield "\n;;======================================================================"
+        yield ";; {0}".format(self.name)
+        yield self.tempo_statement()
 
         for part in self.parts:
-            part.emit(self.start, self.dynamics)
-        print("\ns")
+            for item in part.iter_plan(self.start, self.dynamics, window):
+                yield item
+        yield "\ns"
+
+    def iter_statements(self, window=None):
+        return expand_jobs(self.iter_plan(window))
+
+    def iter_events(self, window=None):
+        return events_only(self.iter_statements(window))
+
+    def compile(self):
+        """A copy of the Section with every Track compiled (see Track.compile)."""
+        compiled = copy.copy(self)
+        compiled.parts = [part.compile(self.start, self.dynamics) for part in self.parts]
+        return compiled
+
+    def emit(self, out=None, processes=None, cache=None, window=None):
+        out = score_writer(out)
+        write_plan(self.iter_plan(window), out, processes, cache)
+        out.flush()
 
 
 class Group(object):
@@ -380,93 +1660,409 @@ class Group(object):
     an effects Track that accompanies it. A group can have a shared dynamic arc.
     """
 
-    def __init__(self, name="track group", tracks=[], start=decZero, dynamics=Dynamics()):
+    def __init__(self, name="track group", tracks=[], start=decZero, dynamics=dynZero):
         self.name = name
         self.tracks = tracks
-        self.start = start
+        self.start = to_time(start)
         self.dynamics = dynamics
-        self.duration = 0.
+        self.duration = to_time(0)
         for track in self.tracks:
             if track.duration > self.duration:
                 self.duration = track.duration
 
-    def emit(self, start, dynamics=Dynamics()):
-        print("\n;;----------------------------------------------------------------------")
-        print(";; {0}".format(self.name))
+    def _calc_dynamics(self, dynamics):
         if (not self.dynamics.absolute and dynamics.absolute):
-            calc_dynamics = self.dynamics.add(dynamics)
-        else:
-            calc_dynamics = self.dynamics
+            return self.dynamics.add(dynamics)
+        return self.dynamics
+
+    def iter_plan(self, start, dynamics=dynZero, window=None):
+        yield "\n;;----------------------------------------------------------------------"
+        yield ";; {0}".format(self.name)
+        calc_dynamics = self._calc_dynamics(dynamics)
         group_start = self.start + start
         for track in self.tracks:
-            track.emit(group_start, calc_dynamics)
+            for item in track.iter_plan(group_start, calc_dynamics, window):
+                yield item
+
+    def compile(self, start, dynamics=dynZero):
+        """A copy of the Group with every Track compiled (see Track.compile)."""
+        calc_dynamics = self._calc_dynamics(dynamics)
+        compiled = copy.copy(self)
+        compiled.tracks = [track.compile(self.start + start, calc_dynamics)
+                           for track in self.tracks]
+        return compiled
+
+    def iter_statements(self, start, dynamics=dynZero, window=None):
+        return expand_jobs(self.iter_plan(start, dynamics, window))
+
+    def iter_events(self, start, dynamics=dynZero, window=None):
+        return events_only(self.iter_statements(start, dynamics, window))
+
+    def emit(self, start, dynamics=dynZero, out=None, processes=None, cache=None, window=None):
+        write_plan(self.iter_plan(start, dynamics, window), out, processes, cache)
 
 
 class Track(object):
     """
     A Track is a series of musical Events. It has a start time; duration is
     determined by the Events included. Optional dynamic arc. The track also
-    stores a reference to the Instrument used to emit CSound events.
+    stores a reference to the Instrument used to emit CSound events. The
+    events may be given as a NoteArray rather than a list.
     """
 
-    def __init__(self, instr, name=None, events=[], start=decZero, dynamics=Dynamics()):
+    # events are sliced and rendered this many at a time, so that
+    # iterating a long Track holds only a bounded number of slices
+    slice_batch_size = 256
+
+    # built on the first windowed render (see interval_index)
+    _interval_index = None
+
+    def __init__(self, instr, name=None, events=[], start=decZero, dynamics=dynZero):
         self.instr = instr
         self.events = events
-        self.start = start
+        self.start = to_time(start)
         self.dynamics = dynamics
-        self.duration = dec.Decimal(0.)
-        for event in self.events:
-            self.duration += event.duration.copy_abs()
+        if isinstance(self.events, NoteArray):
+            self.duration = self.events.duration
+        else:
+            self.duration = to_time(0)
+            for event in self.events:
+                self.duration += abs(event.duration)
         if name == None:
             self.name = "Instrument #{0}".format(self.instr.i_number)
         else:
             self.name = name
 
-    def emit(self, start, dynamics=Dynamics()):
-        print("\n;; {0}\n;;".format(self.name))
+    def __getstate__(self):
+        # the interval index is rebuilt where it is needed
+        state = self.__dict__.copy()
+        state.pop("_interval_index", None)
+        return state
+
+    @property
+    def interval_index(self):
+        """
+        An IntervalIndex of the spans the events' notes sound in (see
+        Event.extent; relative to the Track's start), built on first use and
+        again if events have been added since. Delete it after changing the
+        events otherwise.
+        """
+        index = self._interval_index
+        if index is None or len(index) != len(self.events):
+            if isinstance(self.events, NoteArray):
+                index = IntervalIndex(self.events.starts, self.events.durations)
+            else:
+                starts = []
+                durations = []
+                for event in self.events:
+                    extent = event.extent()
+                    if extent is None:
+                        # no notes: nothing to find it by
+                        extent = (event.start, event.start)
+                    starts.append(extent[0])
+                    durations.append(extent[1] - extent[0])
+                index = IntervalIndex(starts, durations)
+            self._interval_index = index
+        return index
+
+    @interval_index.deleter
+    def interval_index(self):
+        self._interval_index = None
+
+    def iter_plan(self, start, dynamics=dynZero, window=None):
+        yield RenderJob(self, start, dynamics, window)
+
+    def iter_statements(self, start, dynamics=dynZero, window=None):
+        """
+        Render the Track, compiling and rendering a batch of events at a
+        time. Given a window, a (start, end) pair of score times (in the
+        time representation Events use), only the events overlapping it are
+        visited (see interval_index) and only their notes sounding in it
+        rendered. Each is sliced its share of the dynamics of the whole
+        Track and handed the same portamento as in a full render, so the
+        excerpt is exactly the matching notes of the full render.
+        """
+        yield "\n;; {0}\n;;".format(self.name)
+        calc_dynamics = self._calc_dynamics(dynamics)
+        for indices in self._batches(start, window):
+            notes = CompiledNotes()
+            self._compile_into(notes, start, calc_dynamics, indices)
+            keep = None
+            if window is not None:
+                (notes, keep) = notes.window(*window)
+            for statement in notes.iter_events(self.instr, keep=keep):
+                yield statement
+
+    def iter_events(self, start, dynamics=dynZero, window=None):
+        return events_only(self.iter_statements(start, dynamics, window))
+
+    def _batches(self, start, window):
+        # the indices of the events to render, slice_batch_size at a time
+        size = self.slice_batch_size
+        if window is None:
+            return [range(i, min(i + size, len(self.events)))
+                    for i in range(0, len(self.events), size)]
+        track_start = self.start + start
+        indices = self.interval_index.overlapping(window[0] - track_start,
+                                                  window[1] - track_start)
+        return [indices[i:i + size] for i in range(0, len(indices), size)]
+
+    def _calc_dynamics(self, dynamics):
         if (not self.dynamics.absolute and dynamics.absolute):
-            calc_dynamics = self.dynamics.add(dynamics)
-        else:
-            calc_dynamics = self.dynamics
+            return self.dynamics.add(dynamics)
+        return self.dynamics
 
+    def _compile_into(self, notes, start, calc_dynamics, indices):
+        # compile the events at indices (ascending)
         track_start = self.start + start
+        if isinstance(self.events, NoteArray):
+            self.events.compile_into(notes, track_start, calc_dynamics, self.duration,
+                                     indices=indices)
+            return
+
         event_start = track_start
-        for event in self.events:
-            #slice_start = (event_start - track_start) / self.duration
-            slice_start = event.start / self.duration
-            slice_duration = event.duration.copy_abs() / self.duration
-            passed_dynamics = calc_dynamics.slice(slice_start, slice_duration) 
-            event.emit(self.instr, event_start, passed_dynamics)
+        events = [self.events[i] for i in indices]
+        #slice_starts = [(event_start - track_start) / self.duration ...]
+        slice_starts = [time_ratio(event.start, self.duration) for event in events]
+        slice_durations = [time_ratio(abs(event.duration), self.duration) for event in events]
+        sliced_dynamics = calc_dynamics.slice_many(slice_starts, slice_durations)
+        for (event, passed_dynamics) in zip(events, sliced_dynamics):
+            event.compile_into(notes, event_start, passed_dynamics)
             #event_start = event_start + event.duration
 
+    def compile(self, start=0, dynamics=dynZero):
+        """
+        Resolve the whole Track, for rendering at start under the parent
+        dynamics, into a CompiledTrack: every note's effective envelope is
+        worked out once, in a single top-down pass, so rendering (as often
+        as needed) is a flat loop. start is a score time, as for emit.
+        """
+        notes = CompiledNotes()
+        self._compile_into(notes, start, self._calc_dynamics(dynamics), range(len(self.events)))
+        return CompiledTrack(self.instr, self.name, notes, start, dynamics, self.duration)
+
+    def emit(self, start, dynamics=dynZero, out=None, window=None):
+        write_statements(self.iter_statements(start, dynamics, window), out)
+
+
+class CompiledNotes(object):
+    """
+    CompiledNotes are the flat form of a tree of Events: for every note it
+    sounds, in order, the absolute start and the duration (already in the
+    current time representation), the effective dynamics (the envelopes of
+    all the enclosing levels added and sliced down to the note), the
+    articulation and pitch, and whether the note is handed the portamento
+    cookie of the note before it (as the notes of a Gesture are).
+    Rendering them is one loop over the columns.
+    """
+
+    _no_articulation = -1
+
+    def __init__(self):
+        if _time_mode == "ticks":
+            self.starts = array.array("q")
+            self.durations = array.array("q")
+        else:
+            self.starts = []
+            self.durations = []
+        self.dynamics = []
+        self.articulations = array.array("b")
+        self.pitches = []
+        self.chained = array.array("b")
+
+    def __len__(self):
+        return len(self.starts)
+
+    def append(self, start, duration, dynamics, articulation, pitch, chained=False):
+        self.starts.append(start)
+        self.durations.append(duration)
+        self.dynamics.append(dynamics)
+        if articulation is None:
+            self.articulations.append(self._no_articulation)
+        else:
+            self.articulations.append(articulation)
+        self.pitches.append(pitch)
+        self.chained.append(chained)
+
+    def _batch(self, first, last):
+        # the columns of notes [first:last], as Instrument.events_many takes them
+        articulations = [None if articulation == self._no_articulation else articulation
+                         for articulation in self.articulations[first:last]]
+        return (self.starts[first:last], self.durations[first:last], self.dynamics[first:last],
+                articulations, self.pitches[first:last], self.chained[first:last])
+
+    def window(self, start, end, index=None):
+        """
+        The notes sounding in [start, end) (see IntervalIndex.overlapping;
+        index, if given, is an IntervalIndex of these notes), as new
+        CompiledNotes, and a column of flags telling them from the notes
+        chained before them: those come along, from the start of each
+        chain, so that every note is handed the same portamento as when all
+        are rendered. Pass the flags as keep to iter_events or emit.
+        """
+        if index is None:
+            index = IntervalIndex(self.starts, self.durations)
+        selected = []
+        keep = array.array("b")
+        for i in index.overlapping(start, end):
+            first = i
+            previous = selected[-1] if selected else -1
+            while first > previous + 1 and self.chained[first]:
+                first -= 1
+            selected.extend(range(first, i + 1))
+            keep.extend([False] * (i - first) + [True])
+
+        notes = CompiledNotes()
+        for name in ("starts", "durations", "dynamics", "articulations", "pitches", "chained"):
+            column = getattr(self, name)
+            getattr(notes, name).extend([column[i] for i in selected])
+        return (notes, keep)
+
+    def iter_events(self, instr, portamento=None, batch_size=256, keep=None):
+        """
+        Render every note with instr, batch_size notes at a time (see
+        Instrument.events_many), as score statements: a ScoreEvent per note,
+        or what an Instrument overriding emit() wrote for it. portamento is
+        handed to the first note, if it is chained. Given keep (see window),
+        only the flagged notes are yielded.
+        """
+        for i in range(0, len(self.starts), batch_size):
+            events = instr.events_many(*self._batch(i, i + batch_size), portamento=portamento)
+            if events:
+                portamento = events[-1].portamento
+            if keep is not None:
+                events = [event for (event, kept) in zip(events, keep[i:i + batch_size]) if kept]
+            for statement in _note_statements(events):
+                yield statement
+
+    def emit(self, instr, out=None, portamento=None, batch_size=256, keep=None):
+        """Write every note (or the ones flagged in keep) as iter_events renders it."""
+        write_statements(self.iter_events(instr, portamento, batch_size, keep), out)
+
+
+class CompiledTrack(object):
+    """
+    A CompiledTrack is a Track resolved by Track.compile for one start time
+    and parent dynamics. It can stand in for the Track in its Section or
+    Group, rendering the same statements without recomputing any envelope.
+    """
+
+    # built on the first windowed render (see interval_index)
+    _interval_index = None
+
+    def __init__(self, instr, name, notes, start, dynamics, duration):
+        self.instr = instr
+        self.name = name
+        self.notes = notes
+        self.start = start
+        self.dynamics = dynamics
+        self.duration = duration
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_interval_index", None)
+        return state
+
+    @property
+    def interval_index(self):
+        """An IntervalIndex of the notes' spans (see Track.interval_index)."""
+        index = self._interval_index
+        if index is None or len(index) != len(self.notes):
+            index = self._interval_index = IntervalIndex(self.notes.starts, self.notes.durations)
+        return index
+
+    def iter_plan(self, start, dynamics=dynZero, window=None):
+        yield RenderJob(self, start, dynamics, window)
+
+    def _window(self, window):
+        # the notes to render, and which of them to keep (see CompiledNotes.window)
+        if window is None:
+            return (self.notes, None)
+        return self.notes.window(window[0], window[1], self.interval_index)
+
+    def iter_statements(self, start, dynamics=dynZero, window=None):
+        if start != self.start or dynamics != self.dynamics:
+            raise ValueError("{0} was compiled for another start or parent dynamics".format(
+                self.name))
+        yield "\n;; {0}\n;;".format(self.name)
+        (notes, keep) = self._window(window)
+        for event in notes.iter_events(self.instr, keep=keep):
+            yield event
+
+    def iter_events(self, start, dynamics=dynZero, window=None):
+        return events_only(self.iter_statements(start, dynamics, window))
+
+    def compile(self, start=0, dynamics=dynZero):
+        if start != self.start or dynamics != self.dynamics:
+            raise ValueError("{0} was compiled for another start or parent dynamics".format(
+                self.name))
+        return self
+
+    def emit(self, start, dynamics=dynZero, out=None, window=None):
+        write_statements(self.iter_statements(start, dynamics, window), out)
+
 
 class Event(object):
     """
     An Event is the base class for a Gesture, Chord or Note.
     """
 
-    def __init__(self, start=decZero, duration=decZero, dynamics=Dynamics(), articulation=None):
-        self.start = dec.Decimal(start)
+    __slots__ = ("start", "duration", "dynamics", "articulation")
+
+    def __init__(self, start=decZero, duration=decZero, dynamics=dynZero, articulation=None):
+        self.start = to_time(start)
         self.dynamics = dynamics
         self.articulation = articulation
-        self.duration = dec.Decimal(duration)
+        self.duration = to_time(duration)
+
+    def iter_events(self, instr, start=0, dynamics=dynZero, articulation=None,
+                    portamento=None):
+        notes = CompiledNotes()
+        self.compile_into(notes, start, dynamics, articulation, True)
+        return notes.iter_events(instr, portamento)
+
+    def compile_into(self, notes, start=0, dynamics=dynZero, articulation=None, chained=False):
+        """
+        Append the notes this Event sounds to notes (CompiledNotes), given
+        the start, dynamics and articulation passed down to it; chained says
+        whether its first note is handed the previous note's portamento.
+        Returns the number of notes appended. Override me.
+        """
+        return 0
 
-    def emit(self, instr, start, dynamics):
-        # override me
+    def extent(self, start=0):
+        """
+        The (start, end) of the time this Event's notes sound in, placed
+        as compile_into places them given start, or None if it has none.
+        Override me along with compile_into.
+        """
         return None
 
+    def emit(self, instr, start=0, dynamics=dynZero, articulation=None, portamento=None,
+             out=None):
+        notes = CompiledNotes()
+        self.compile_into(notes, start, dynamics, articulation, True)
+        return instr.emit_many(*notes._batch(0, len(notes)), portamento=portamento, out=out)
+
+
+def _union_extent(extents):
+    # the extent covering every one given (None for none)
+    extents = [extent for extent in extents if extent is not None]
+    if not extents:
+        return None
+    return (min(start for (start, end) in extents), max(end for (start, end) in extents))
+
 
 class Rest(Event):
     """
     A Rest just advances the beat count. No score statements are emitted.
     """
 
+    __slots__ = ()
+
     def __init__(self, start=decZero, duration=decZero):
         super(Rest, self).__init__(start, duration)
 
-    def emit(self, instr, start, ignored_dynamics, ignored_articulation, ignored_portamento):
-        return None
-
 
 class Gesture(Event):
     """
@@ -476,22 +2072,24 @@ class Gesture(Event):
     be the duration of its consituent elements).
     """
 
+    __slots__ = ("events",)
+
     def __init__(self, events=[], start=decZero, duration=None,
-                 dynamics=Dynamics(), articulation=None):
+                 dynamics=dynZero, articulation=None):
 
         self.events = events
 
+        super(Gesture, self).__init__(start, duration or 0, dynamics, articulation)
+        # Event.__init__(self, start, _duration, dynamics, articulation)
+
         if (duration is None):
-            _duration = 0
+            # the children's durations are already converted
+            _duration = to_time(0)
             for event in self.events:
-                _duration += event.duration.copy_abs()
-        else:
-            _duration = duration
-
-        super(Gesture, self).__init__(start, _duration, dynamics, articulation)
-        # Event.__init__(self, start, _duration, dynamics, articulation)
+                _duration += abs(event.duration)
+            self.duration = _duration
 
-    def emit(self, instr, start=decZero, dynamics=Dynamics(), articulation=None):
+    def compile_into(self, notes, start=0, dynamics=dynZero, articulation=None, chained=False):
         if (self.articulation == None):
             passed_articulation = articulation
         else:
@@ -503,14 +2101,34 @@ class Gesture(Event):
             calc_dynamics = self.dynamics
 
         gesture_start = self.start + start
+        slice_starts = []
+        slice_durations = []
+        offset = to_time(0)
+        for event in self.events:
+            slice_starts.append(time_ratio(offset, self.duration))
+            slice_durations.append(time_ratio(abs(event.duration), self.duration))
+            offset = offset + event.duration
+        sliced_dynamics = calc_dynamics.slice_many(slice_starts, slice_durations)
+
         event_start = gesture_start
-        portamento = None  # at the beginning of the Gesture
+        # each event is handed the portamento of the last note of the one
+        # before; none at the beginning of the Gesture
+        count = 0
+        total = 0
+        for (event, passed_dynamics) in zip(self.events, sliced_dynamics):
+            count = event.compile_into(notes, event_start, passed_dynamics,
+                                       passed_articulation, count > 0)
+            total += count
+            event_start = event_start + event.duration
+        return total
+
+    def extent(self, start=0):
+        extents = []
+        event_start = self.start + start
         for event in self.events:
-            slice_start = (event_start - gesture_start) / self.duration
-            slice_duration = event.duration.copy_abs() / self.duration
-            passed_dynamics = calc_dynamics.slice(slice_start, slice_duration)
-            portamento = event.emit(instr, event_start, passed_dynamics, passed_articulation, portamento)
+            extents.append(event.extent(event_start))
             event_start = event_start + event.duration
+        return _union_extent(extents)
 
 
 class Chord(Event):
@@ -519,21 +2137,23 @@ class Chord(Event):
     dynamic arc, a start time, a duration, and an articulation.
     """
 
+    __slots__ = ("events",)
+
     def __init__(self, events=[], start=decZero, duration=None,
-                 dynamics=Dynamics(), articulation=None):
+                 dynamics=dynZero, articulation=None):
 
         self.events = events
+        super(Chord, self).__init__(start, duration or 0, dynamics, articulation)
+
         if duration is None:
-            _duration = 0.0
+            # the children's durations are already converted
+            _duration = to_time(0)
             for event in self.events:
-                if event.duration.copy_abs() > _duration:
-                    _duration = event.duration.copy_abs()
-        else:
-            _duration = duration
-
-        super(Chord, self).__init__(start, _duration, dynamics, articulation)
+                if abs(event.duration) > _duration:
+                    _duration = abs(event.duration)
+            self.duration = _duration
 
-    def emit(self, instr, start=decZero, dynamics=Dynamics(), articulation=None):
+    def compile_into(self, notes, start=0, dynamics=dynZero, articulation=None, chained=False):
         if self.articulation is None:
             passed_articulation = articulation
         else:
@@ -544,13 +2164,14 @@ class Chord(Event):
         else:
             calc_dynamics = self.dynamics
 
-        if self.start is None:
-            _start = start
-        else:
-            _start = self.start + start
-
+        total = 0
         for event in self.events:
-            event.emit(instr, self.start + start, calc_dynamics, passed_articulation)
+            total += event.compile_into(notes, self.start + start, calc_dynamics,
+                                        passed_articulation)
+        return total
+
+    def extent(self, start=0):
+        return _union_extent([event.extent(self.start + start) for event in self.events])
 
 
 class Note(Event):
@@ -559,13 +2180,15 @@ class Note(Event):
     and an optional frequency arc (often a simple pitch).
     """
 
+    __slots__ = ("pitch", "params")
+
     def __init__(self, start=decZero, duration=decZero,
-            dynamics=Dynamics(), articulation=None, pitch=None, params=None):
+            dynamics=dynZero, articulation=None, pitch=None, params=None):
         self.pitch = pitch
         self.params = params
         super(Note, self).__init__(start, duration, dynamics, articulation)
 
-    def emit(self, instr, start=decZero, dynamics=Dynamics(), articulation=None, portamento=None, params=None):
+    def compile_into(self, notes, start=0, dynamics=dynZero, articulation=None, chained=False):
         if self.articulation is None:
             passed_articulation = articulation
         else:
@@ -581,7 +2204,156 @@ class Note(Event):
         else:
             _start = self.start + start
 
-        return instr.emit(_start, self.duration, calc_dynamics, passed_articulation, self.pitch, portamento)
+        notes.append(_start, self.duration, calc_dynamics, passed_articulation, self.pitch,
+                     chained)
+        return 1
+
+    def extent(self, start=0):
+        if self.start is not None:
+            start = self.start + start
+        return (start, start + abs(self.duration))
+
+
+class NoteArray(object):
+    """
+    A NoteArray is a compact, columnar alternative to a Track's list of Notes:
+    parallel columns of start, duration, pitch, articulation and an index into
+    a table of the distinct Dynamics used. A Track can hold a NoteArray in
+    place of its events and renders it without building Note objects. Its
+    duration is the end of its last-ending note, unless set (e.g. to the
+    length of a staff ending in rests).
+    """
+
+    _no_articulation = -1
+
+    # set to a duration other than that of the notes (see duration)
+    _duration = None
+
+    def __init__(self):
+        if _time_mode == "ticks":
+            self.starts = array.array("q")
+            self.durations = array.array("q")
+        else:
+            self.starts = []
+            self.durations = []
+        self.pitches = []
+        self.articulations = array.array("b")
+        self.dynamics_indices = array.array("l")
+        self.dynamics_table = []
+        self._dynamics_lookup = {}
+
+    @classmethod
+    def from_events(cls, events):
+        """
+        Flatten Notes, and Chords of Notes, into a NoteArray. A Chord's
+        articulation is handed down to its notes; Chords with dynamics of
+        their own (other than the default flat envelope) can't be flattened.
+        Each note is then sliced over its own span rather than its chord's.
+        """
+        notes = cls()
+        for event in events:
+            if isinstance(event, Note):
+                notes.append_converted(event.start, event.duration, event.dynamics,
+                                       event.articulation, event.pitch)
+            elif isinstance(event, Chord):
+                if event.dynamics.absolute or any(dp.level for dp in event.dynamics.envelope):
+                    raise ValueError("cannot flatten a Chord with its own dynamics")
+                for note in event.events:
+                    if not isinstance(note, Note):
+                        raise TypeError("only Chords of Notes can be flattened")
+                    if note.articulation is None:
+                        articulation = event.articulation
+                    else:
+                        articulation = note.articulation
+                    notes.append_converted(event.start + note.start, note.duration,
+                                           note.dynamics, articulation, note.pitch)
+            elif not isinstance(event, Rest):
+                raise TypeError("cannot flatten {0} into a NoteArray".format(type(event).__name__))
+        return notes
+
+    def append(self, start, duration, dynamics=dynZero, articulation=None, pitch=None):
+        """Add a note; start and duration are in beats, as for Note."""
+        self.append_converted(to_time(start), to_time(duration), dynamics, articulation, pitch)
+
+    def append_converted(self, start, duration, dynamics, articulation, pitch):
+        # start and duration already in the current time representation
+        index = self._dynamics_lookup.get(dynamics)
+        if index is None:
+            index = len(self.dynamics_table)
+            self.dynamics_table.append(dynamics)
+            self._dynamics_lookup[dynamics] = index
+        self.starts.append(start)
+        self.durations.append(duration)
+        self.pitches.append(pitch)
+        if articulation is None:
+            self.articulations.append(self._no_articulation)
+        else:
+            self.articulations.append(articulation)
+        self.dynamics_indices.append(index)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def duration(self):
+        if self._duration is not None:
+            return self._duration
+        end = to_time(0)
+        for (start, duration) in zip(self.starts, self.durations):
+            if start + abs(duration) > end:
+                end = start + abs(duration)
+        return end
+
+    @duration.setter
+    def duration(self, duration):
+        # in the current time representation
+        self._duration = duration
+
+    def compile_into(self, notes, start, dynamics, span, first=0, last=None, indices=None):
+        """
+        Append notes [first:last], or the notes at indices (ascending), to
+        notes (CompiledNotes), slicing dynamics (the Track's envelope,
+        spread over span) for each one as Track does for its events.
+        """
+        if indices is None:
+            indices = range(len(self))[first:last]
+            starts = self.starts[first:last]
+            durations = self.durations[first:last]
+        else:
+            starts = [self.starts[i] for i in indices]
+            durations = [self.durations[i] for i in indices]
+        slice_starts = [time_ratio(s, span) for s in starts]
+        slice_durations = [time_ratio(abs(d), span) for d in durations]
+        sliced_dynamics = dynamics.slice_many(slice_starts, slice_durations)
+        for (j, i) in enumerate(indices):
+            note_dynamics = self.dynamics_table[self.dynamics_indices[i]]
+            passed_dynamics = sliced_dynamics[j]
+            if not note_dynamics.absolute and passed_dynamics.absolute:
+                calc_dynamics = note_dynamics.add(passed_dynamics)
+            else:
+                calc_dynamics = note_dynamics
+            articulation = self.articulations[i]
+            if articulation == self._no_articulation:
+                articulation = None
+            notes.append(starts[j] + start, durations[j], calc_dynamics, articulation,
+                         self.pitches[i])
+
+
+# whether each Instrument class's emit() takes out (see _emit_takes_out)
+_emit_signatures = weakref.WeakKeyDictionary()
+
+
+def _emit_takes_out(cls):
+    takes_out = _emit_signatures.get(cls)
+    if takes_out is None:
+        try:
+            parameters = inspect.signature(cls.emit).parameters.values()
+        except (TypeError, ValueError):
+            parameters = []
+        takes_out = any(parameter.name == "out" or parameter.kind == parameter.VAR_KEYWORD
+                        for parameter in parameters)
+        _emit_signatures[cls] = takes_out
+    return takes_out
 
 
 class Instrument(object):
@@ -589,34 +2361,160 @@ class Instrument(object):
     Subclass Instrument, overriding its basic emit function to correctly
     interpret start times, durations, dynamics and articulation into
     csound parameters.
+
+    Notes are parameterized one at a time by the per-note hooks
+    (time_params, dynamic_params, pitch_params and other_params), or a batch
+    at a time by their column counterparts (time_columns, dynamic_columns,
+    pitch_columns and other_columns), which see whole columns of notes and
+    return a list of parameters per note. Tracks render through the column
+    hooks (see events_many), except for a subclass that overrides a per-note
+    hook but not its column hook, or event(): that one is rendered note by
+    note as before. A subclass overriding emit() has it called for every
+    note, with a writer recording what it writes (see EmittedNote); one
+    whose emit() takes no out has what it prints recorded instead.
     """
 
+    # each per-note hook, and the column hook standing in for it
+    _column_hooks = (("time_params", "time_columns"), ("dynamic_params", "dynamic_columns"),
+                     ("pitch_params", "pitch_columns"), ("other_params", "other_columns"))
+
     def __init__(self, i_number):
         self.i_number = i_number
 
-    def emit(self, start, duration, dynamics, articulation, pitch, portamento, other_parameters = []):
-        params = [self.i_number]
-        params.extend(self.time_params(start, duration, articulation))
-        params.extend(self.dynamic_params(dynamics, articulation, portamento))
-        params.extend(self.pitch_params(pitch, articulation, portamento))
-        params.extend(self.other_params(other_parameters, articulation, portamento))
+    def event(self, start, duration, dynamics, articulation, pitch, portamento, other_parameters = []):
+        """Render one note as a ScoreEvent, without writing it anywhere."""
+        times = list(self.time_params(start, duration, articulation))
+        dynamic = list(self.dynamic_params(dynamics, articulation, portamento))
+        pitches = list(self.pitch_params(pitch, articulation, portamento))
+        other = list(self.other_params(other_parameters, articulation, portamento))
+        params = [self.i_number] + times + dynamic + pitches + other
+        return ScoreEvent(self.i_number, times, dynamic, pitches, other,
+                          self.update_portamento(params, articulation, portamento))
+
+    def emit(self, start, duration, dynamics, articulation, pitch, portamento, other_parameters = [],
+             out=None):
+        event = self.event(start, duration, dynamics, articulation, pitch, portamento,
+                           other_parameters)
+        score_writer(out).event(event.params())
+        return event.portamento
+
+    def batched(self):
+        """Whether this Instrument's notes can be rendered through the column hooks."""
+        cls = type(self)
+        if cls.event is not Instrument.event or cls.emit is not Instrument.emit:
+            return False
+        for (note_hook, column_hook) in self._column_hooks:
+            if (getattr(cls, note_hook) is not getattr(Instrument, note_hook) and
+                    getattr(cls, column_hook) is getattr(Instrument, column_hook)):
+                return False
+        return True
+
+    def events_many(self, starts, durations, dynamics, articulations, pitches, chained=None,
+                    portamento=None):
+        """
+        Render a batch of notes, given as columns (articulations None or an
+        Articulation), as a list of ScoreEvents: the same as calling event()
+        for each in turn, the portamento cookie of each note handed to the
+        next where that is chained (a column of flags; by default none is)
+        and portamento handed to the first if it is. For an Instrument
+        overriding emit(), it is an EmittedNote per note instead.
+        """
+        events = []
+        if not self.batched():
+            emitted = type(self).emit is not Instrument.emit
+            for i in range(len(starts)):
+                if chained is None or not chained[i]:
+                    portamento = None
+                if emitted:
+                    event = self._recorded_emit(starts[i], durations[i], dynamics[i],
+                                                articulations[i], pitches[i], portamento)
+                else:
+                    event = self.event(starts[i], durations[i], dynamics[i], articulations[i],
+                                       pitches[i], portamento)
+                portamento = event.portamento
+                events.append(event)
+            return events
+
+        columns = zip(self.time_columns(starts, durations, articulations),
+                      self.dynamic_columns(dynamics, articulations),
+                      self.pitch_columns(pitches, articulations),
+                      self.other_columns(len(starts), articulations))
+        for (i, (times, dynamic, pitch, other)) in enumerate(columns):
+            if chained is None or not chained[i]:
+                portamento = None
+            params = [self.i_number] + times + dynamic + pitch + other
+            portamento = self.update_portamento(params, articulations[i], portamento)
+            events.append(ScoreEvent(self.i_number, times, dynamic, pitch, other, portamento))
+        return events
+
+    def emit_many(self, starts, durations, dynamics, articulations, pitches, chained=None,
+                  portamento=None, out=None):
+        """
+        Write a batch of notes (see events_many), handing their events to
+        the writer as one batch (see ScoreWriter.events). Returns the
+        portamento cookie of the last note.
+        """
+        events = self.events_many(starts, durations, dynamics, articulations, pitches, chained,
+                                  portamento)
+        if not events:
+            return portamento
+        write_statements(_note_statements(events), out)
+        return events[-1].portamento
+
+    def _recorded_emit(self, start, duration, dynamics, articulation, pitch, portamento):
+        # one note through an overridden emit(), as an EmittedNote
+        out = RecordingWriter()
+        if _emit_takes_out(type(self)):
+            portamento = self.emit(start, duration, dynamics, articulation, pitch, portamento,
+                                   out=out)
+        else:
+            # an emit() from before ScoreWriters prints its statements
+            stdout = sys.stdout
+            sys.stdout = printed = io.StringIO()
+            try:
+                portamento = self.emit(start, duration, dynamics, articulation, pitch,
+                                       portamento)
+            finally:
+                sys.stdout = stdout
+            out.write(printed.getvalue())
+        out.flush()
+        return EmittedNote(out.statements, portamento)
+
+    def time_columns(self, starts, durations, articulations):
+        # time_params for a batch: staccato notes are shortened all at once,
+        # in the time representation, then everything converted to beats
+        durations = [duration / 2 if articulation == Articulation.staccato else duration
+                     for (duration, articulation) in zip(durations, articulations)]
+        if _time_mode == "ticks" and _import_numpy() is not None:
+            starts = (np.asarray(starts, dtype=float) / _ticks_per_quarter).tolist()
+            durations = (np.asarray(durations, dtype=float) / _ticks_per_quarter).tolist()
+        else:
+            starts = [time_to_float(start) for start in starts]
+            durations = [time_to_float(duration) for duration in durations]
+        return [[start, duration] for (start, duration) in zip(starts, durations)]
+
+    def dynamic_columns(self, dynamics, articulations):
+        # dynamic_params for a batch: the average levels, reduced together
+        return [[level] for level in reduce_dynamics(dynamics)]
 
-        event_line = "i"
-        for p in params:
-            event_line += " {0}".format(p)
-        print(event_line)
+    def pitch_columns(self, pitches, articulations):
+        return [[] if pitch is None else [pitch] for pitch in pitches]
 
-        return self.update_portamento(params, articulation, portamento)
+    def other_columns(self, count, articulations):
+        return [[] for i in range(count)]
 
     def time_params(self, start, duration, articulation):
         if (articulation == Articulation.staccato):
             # naive way to interpret staccato articulation
-            duration = dec.Decimal(0.5) * duration
-        return [float(start), float(duration)]
+            duration = duration / 2
+        return [time_to_float(start), time_to_float(duration)]
 
     def dynamic_params(self, dynamics, articulation, portamento):
-        # Only allow for one dynamics parameter in this base instrument.
-        # More complex dynamic interpretations can be implemented in a descendant class.
+        # Only allow for one dynamics parameter in this base instrument (the
+        # average level, cached with the envelope, so shared envelopes are
+        # only reduced once). More complex dynamic interpretations can be
+        # implemented in a descendant class, e.g. from peak_level(),
+        # rms_level() or sampled_levels().
         return [dynamics.average_level()]
 
     def pitch_params(self, pitch, articulation, portamento):
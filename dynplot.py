@@ -0,0 +1,28 @@
+from __future__ import print_function
+import matplotlib.pyplot as plt
+
+
+# Plotting for csound.py, kept apart so that importing csound doesn't pay
+# for importing matplotlib (and choosing a backend). Dynamics.plot imports
+# this module the first time it is called.
+
+
+def plot_dynamics(dynamics, show=True):
+    """Plot a Dynamics envelope's level against normalized time."""
+    if dynamics.absolute:
+        axes_spec = [0., 1., 0., 1.]
+    else:
+        axes_spec = [0., 1., -1., 1.]
+
+    levels = []
+    times = []
+    current_time = 0.
+    for dp in dynamics.envelope:
+        levels.append(float(dp.level))
+        times.append(current_time)
+        current_time = current_time + float(dp.duration)
+    plt.plot(times, levels)
+    plt.ylabel('level')
+    plt.axis(axes_spec)
+    if show:
+        plt.show()
@@ -1,6 +1,15 @@
 from __future__ import print_function
 import csound as cs
+import binscore
 import sys
+import os
+import argparse
+import glob
+import hashlib
+import importlib
+import json
+import multiprocessing
+import collections
 import decimal as dec
 
 
@@ -15,88 +24,496 @@ def translate_articulation(articulation=None):
         return cs.Articulation.full
 
 
-def process_staff(stf, track_name, instrument):
-    """Process a staff's worth of lilypond events into
-    csound.py objects. Parameters are the staff file to
-    process and the section object to which we'll write the
-    generated events. The staff file is generated by lilypond's
-    event-listener module. Returns a csound.Track object.
+class NotesParser(object):
+    """
+    A NotesParser turns the lines of an event-listener .notes
+    file into (time, kind, args) records, with the arguments
+    each kind of event needs already converted: (pitch,
+    duration) for a note, the direction for a slur, the name
+    for a script, the tempo for a tempo and the duration (or
+    None, if the line has none) for a rest. Times are
+    converted once per timestamp (the lines for one moment
+    come together) and durations once per distinct value.
     """
 
-    time_array = {}
-    articulation = None  # articulation events will modify this
-    dyn_envelope = []
-    crescendo = 0
-    slurring = False
-    note = None  # last processed note
-    open_ties = {}
-    tempi = []
-    for line in stf:
-        fields = line.split()
-        when = dec.Decimal(4.0) * dec.Decimal(fields[0])
-        what = fields[1]
-        if what == "note":
-            pitch = fields[2]
-            duration = dec.Decimal(4.0) * dec.Decimal(fields[4])
-            if slurring:
-                duration = -duration
-            if (pitch in open_ties):
-                note = open_ties.pop(pitch)
-                note.duration = note.duration + duration
-            else:
-                articulation = cs.Articulation.legato if slurring else None
-                note = cs.Note(when, duration, articulation=articulation, pitch=pitch)
-                #time_array.get(when, []).append(note)
-                if when in time_array:
-                    time_array.get(when).append(note)
-                else:
-                    when_array = [note]
-                    time_array[when] = when_array
-        elif what == "slur":
-            if int(fields[2]) < 0:
-                slurring = True
+    def __init__(self):
+        self._time_text = None
+        self._time = None
+        self._durations = {}
+        self.parsers = {
+            "note": self.note,
+            "slur": self.slur,
+            "tie": self.no_args,
+            "script": self.script,
+            "tempo": self.tempo,
+            "rest": self.rest,
+        }
+
+    def time(self, text):
+        if text != self._time_text:
+            self._time = cs.parse_beats(text, 4)
+            self._time_text = text
+        return self._time
+
+    def duration(self, text):
+        duration = self._durations.get(text)
+        if duration is None:
+            duration = self._durations[text] = cs.parse_beats(text, 4)
+        return duration
+
+    def note(self, fields):
+        return (fields[2], self.duration(fields[4]))
+
+    def slur(self, fields):
+        return int(fields[2])
+
+    def script(self, fields):
+        return fields[2]
+
+    def rest(self, fields):
+        if len(fields) > 3:
+            return self.duration(fields[3])
+        return None
+
+    def tempo(self, fields):
+        return dec.Decimal(fields[2]) / dec.Decimal(4)
+
+    def no_args(self, fields):
+        return None
+
+    def parse(self, fields):
+        """One record from a line's fields. Unknown kinds keep
+        all their fields as args."""
+        parser = self.parsers.get(fields[1])
+        if parser is None:
+            return (self.time(fields[0]), fields[1], fields)
+        return (self.time(fields[0]), fields[1], parser(fields))
+
+    def iter_records(self, lines):
+        for line in lines:
+            fields = line.split()
+            if fields:
+                yield self.parse(fields)
+
+
+class _StaffReader(object):
+    """The state of iter_staff as it reads a staff, with a
+    handler for each kind of record."""
+
+    def __init__(self, tempi):
+        self.pending = collections.OrderedDict()  # time -> notes starting then
+        self.articulation = None  # articulation events will modify this
+        self.slurring = False
+        self.note = None  # last processed note
+        self.open_ties = {}
+        self.tempi = tempi
+        self.end = cs.to_time(0)  # where the last note or rest so far ends
+        self.handlers = {
+            "note": self.on_note,
+            "slur": self.on_slur,
+            "tie": self.on_tie,
+            "script": self.on_script,
+            "tempo": self.on_tempo,
+            "rest": self.on_rest,
+        }
+
+    def on_note(self, when, args):
+        (pitch, duration) = args
+        if self.slurring:
+            duration = -duration
+        if (pitch in self.open_ties):
+            self.note = self.open_ties.pop(pitch)
+            self.note.duration = self.note.duration + cs.to_time(duration)
+        else:
+            self.articulation = cs.Articulation.legato if self.slurring else None
+            self.note = cs.Note(when, duration, articulation=self.articulation, pitch=pitch)
+            if when in self.pending:
+                self.pending[when].append(self.note)
             else:
-                slurring = False
-            for n in time_array[when]:
-                # toggle duration sign to represent new slur state
-                n.duration = -(n.duration)
-        elif what == "tie":
-            open_ties[note.pitch] = note
-        elif what == "script":
-            script = fields[2]
-            articulation = translate_articulation(script)
-            for n in time_array[when]:
-                n.articulation = articulation
-        elif what == "tempo":
-            tempo = dec.Decimal(fields[2]) / dec.Decimal(4)
-            tempi.append((dec.Decimal(when), dec.Decimal(tempo)))
-        elif what == "rest":
-            pass # nothing to do with respect to csound
+                self.pending[when] = [self.note]
+        self.extend(self.note.start + abs(self.note.duration))
+
+    def extend(self, end):
+        if end > self.end:
+            self.end = end
+
+    def on_slur(self, when, direction):
+        if direction < 0:
+            self.slurring = True
         else:
-            print("unknown line", fields, file=sys.stderr)
+            self.slurring = False
+        for n in self.pending.get(when, ()):
+            # toggle duration sign to represent new slur state
+            n.duration = -(n.duration)
+
+    def on_tie(self, when, args):
+        self.open_ties[self.note.pitch] = self.note
+
+    def on_script(self, when, script):
+        self.articulation = translate_articulation(script)
+        for n in self.pending.get(when, ()):
+            n.articulation = self.articulation
+
+    def on_tempo(self, when, tempo):
+        if self.tempi is not None:
+            self.tempi.append((when, tempo))
+
+    def on_rest(self, when, duration):
+        # nothing to emit, but the staff lasts until it ends
+        if duration is not None:
+            self.extend(cs.to_time(when) + cs.to_time(duration))
+
+    def on_unknown(self, when, fields):
+        print("unknown line", fields, file=sys.stderr)
+
+    def completed(self):
+        """Pop the chords, oldest first, that no open tie can
+        still extend."""
+        tied = set([id(n) for n in self.open_ties.values()])
+        while self.pending:
+            first = next(iter(self.pending))
+            if any([id(n) in tied for n in self.pending[first]]):
+                break
+            for chord in self.chords(self.pending.pop(first)):
+                yield chord
+
+    def remaining(self):
+        for when in sorted(self.pending.keys()):
+            for chord in self.chords(self.pending.pop(when)):
+                yield chord
+
+    def chords(self, notes):
+        """A Chord, at the notes' start, for each length of the
+        notes starting at one time: a Chord's dynamics are
+        sliced over its whole length and handed to every note,
+        so notes of different lengths can't share one."""
+        lengths = collections.OrderedDict()
+        for n in notes:
+            lengths.setdefault(abs(n.duration), []).append(n)
+        for group in lengths.values():
+            start = group[0].start
+            for n in group:
+                n.start = cs.to_time(0)
+            chord = cs.Chord(group)
+            chord.start = start  # already converted
+            yield chord
+
 
+def iter_staff(stf, tempi=None, streaming=True):
+    """Read a staff's worth of lilypond events (as written by
+    lilypond's event-listener module) and generate a
+    csound.Chord for each point in time at which notes start,
+    or one for each length of the notes starting then (see
+    _StaffReader.chords), in time order. stf is the staff
+    file (or any iterable of its lines). Tempo points are
+    appended to tempi, if given, as (time, tempo) pairs.
+
+    The event-listener output is in time order, and the only
+    events that modify notes already read are the slurs and
+    scripts at the same time and ties, which extend a note
+    when the next note of the same pitch arrives. So when
+    streaming, a chord is generated as soon as the time moves
+    past it and none of its notes has an open tie, and only
+    those chords still waiting are held in memory. Without
+    streaming, every chord is held until the end of the
+    staff, and the staff need not be in time order.
+    """
+
+    return _read_staff(stf, _StaffReader(tempi), streaming)
+
+
+def _read_staff(stf, reader, streaming):
+    # iter_staff, with the reader (whose end is where the staff
+    # ends, once it is all read) given
+    records = NotesParser().iter_records(stf)
+    handlers = reader.handlers
+    now = None
+    for (when, what, args) in records:
+        if streaming and when != now:
+            if now is not None and when < now:
+                raise ValueError("staff events out of time order at {0}".format(when))
+            now = when
+            for chord in reader.completed():
+                yield chord
+        handlers.get(what, reader.on_unknown)(when, args)
+
+    for chord in reader.remaining():
+        yield chord
+
+
+def staff_dynamics(dyn_envelope=()):
+    """The dynamic arc of a staff: a constant mf unless an
+    envelope has been gathered."""
     if len(dyn_envelope) == 0:
-        dynamics = cs.Dynamics.constant(cs.Dynamics.mf, absolute=True)
+        return cs.Dynamics.constant(cs.Dynamics.mf, absolute=True)
+    return cs.Dynamics(dyn_envelope, absolute=True)
+
+
+def process_staff(stf, track_name, instrument, compact=False):
+    """Process a staff's worth of lilypond events into
+    csound.py objects. Parameters are the staff file to
+    process and the section object to which we'll write the
+    generated events. The
+    staff file is generated by lilypond's event-listener
+    module. Returns a csound.Section object holding one Track.
+    With compact set, the track holds a csound.NoteArray
+    rather than a list of Chords; either way its duration is
+    the staff's, to the end of its last note or rest.
+    """
+
+    tempi = []
+    reader = _StaffReader(tempi)
+    chords = _read_staff(stf, reader, streaming=False)
+    if compact:
+        events = cs.NoteArray()
+        for chord in chords:
+            for n in chord.events:
+                events.append_converted(chord.start + n.start, n.duration, n.dynamics,
+                                        n.articulation, n.pitch)
+        events.duration = reader.end
     else:
-        dynamics = cs.Dynamics(dyn_envelope, absolute=True)
-    chords = []
-    when_keys = sorted(time_array.keys())
-    for when in when_keys:
-        when_array = time_array[when]
-        notes = []
-        for event in when_array:
-            notes.append(event)
-        chords.append(cs.Chord(notes))
-    track = cs.Track(instrument, track_name, chords)
-    section = cs.Section(track_name, [track], tempi, cs.decZero, dynamics)
+        events = list(chords)
+    track = cs.Track(instrument, track_name, events)
+    # the staff's dynamics are spread over all of it, trailing
+    # rests included, however its chords overlap
+    track.duration = reader.end
+    section = cs.Section(track_name, [track], tempi, cs.decZero, staff_dynamics())
     return section
 
 
-if __name__ == "__main__":
-    instrument = cs.Instrument(77)
-    track_name = "test-Bass"
-    daFile = track_name + ".notes"
-    with open(daFile) as f:
-        s = process_staff(f, track_name, instrument)
-    s.emit()	
+def cached_process_staff(path, track_name, instrument, cache, compact=False):
+    """process_staff for the .notes file at path, through a
+    csound.DiskCache: the Section is reused as long as the
+    file's content, the track name, the instrument and the
+    compact flag are unchanged."""
+
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    return _cached_section(digest, lambda: data.decode("utf-8").splitlines(), track_name,
+                           instrument, cache, compact)
+
+
+def _cached_section(digest, load, track_name, instrument, cache, compact):
+    key = cs.cache_key("staff", digest, track_name, instrument, compact)
+    section = cache.load(key)
+    if section is None:
+        section = process_staff(load(), track_name, instrument, compact)
+        cache.store(key, section)
+    return section
+
+
+def stream_staff(stf, track_name, instrument, out=None):
+    """Render a staff straight to score text as it is read,
+    without building the Track: each chord is written as soon
+    as iter_staff lets it go, so memory stays bounded however
+    long the staff. The output is the Section process_staff
+    would build, except that the "t" statement comes last (the
+    tempo points aren't all known until then; csound sorts a
+    section's statements before performing it anyway).
+    """
+
+    out = cs.score_writer(out)
+    tempi = []
+    section = cs.Section(track_name, [], tempi, cs.decZero, staff_dynamics())
+    track = cs.Track(instrument, track_name, [])
+    # the staff dynamics are constant, so every chord gets the
+    # whole of what the track would slice them from
+    if (not track.dynamics.absolute) and section.dynamics.absolute:
+        dynamics = track.dynamics.add(section.dynamics)
+    else:
+        dynamics = track.dynamics
+    out.writeline("\n;;======================================================================")
+    out.writeline(";; {0}".format(section.name))
+    out.writeline("\n;; {0}\n;;".format(track.name))
+    for chord in iter_staff(stf, tempi):
+        cs.write_statements(chord.iter_events(instrument, section.start + track.start, dynamics),
+                            out)
+    section.tempo = tempi
+    out.writeline(section.tempo_statement())
+    out.writeline("\ns")
+    out.flush()
+
+
+def find_staves(score, directory="."):
+    """Find the .notes files lilypond's event-listener wrote
+    for score: one <score>-<staff>.notes per staff. Returns
+    a dictionary of staff name to path."""
+    staves = {}
+    prefix = score + "-"
+    for path in glob.glob(os.path.join(directory, glob.escape(prefix) + "*.notes")):
+        staff = os.path.basename(path)[len(prefix):-len(".notes")]
+        staves[staff] = path
+    return staves
+
+
+def ly_staves(path, cache=None, include_path=()):
+    """Parse the lilypond file at path directly, without
+    running lilypond (see lp-lexer.py, which needs ply).
+    Returns an ordered dictionary of staff name to the lines
+    event-listener would have written for the staff. Included
+    files are looked for along include_path too. Given a
+    csound.DiskCache, the tokens of the file and the files it
+    includes are kept there."""
+    return importlib.import_module("lp-lexer").parse_ly(path, include_path, cache)
 
+
+def load_instruments(path):
+    """Read a staff to instrument map from a JSON file of
+    {"staff name": instrument number, ...}. Returns an
+    ordered dictionary of staff name to csound.Instrument."""
+    with open(path) as f:
+        config = json.load(f, object_pairs_hook=collections.OrderedDict)
+    return collections.OrderedDict(
+        [(staff, cs.Instrument(int(number))) for (staff, number) in config.items()])
+
+
+def _convert_staff(job):
+    # the staff is a .notes path, or the lines of a staff from ly_staves
+    (staff, track_name, instrument, cache) = job
+    if isinstance(staff, list):
+        if cache is not None:
+            digest = hashlib.sha256("\n".join(staff).encode("utf-8")).hexdigest()
+            return _cached_section(digest, lambda: staff, track_name, instrument, cache,
+                                   compact=True)
+        return process_staff(staff, track_name, instrument, compact=True)
+    if cache is not None:
+        return cached_process_staff(staff, track_name, instrument, cache, compact=True)
+    with open(staff) as f:
+        return process_staff(f, track_name, instrument, compact=True)
+
+
+def convert_score(score, instruments, directory=".", processes=None, default=None,
+                  cache=None, include_path=()):
+    """Convert every staff of score (see find_staves) and
+    assemble them into a csound.Song with one Section holding
+    a Track per staff. A score ending in .ly is a lilypond
+    file to parse directly instead (see ly_staves, which is
+    handed include_path), its tracks named after the file.
+    instruments maps staff names to csound.Instruments;
+    staves missing from it get default, or raise ValueError
+    if there is none. Tracks are in the
+    order of instruments, then of staff name. With processes
+    the staves are converted concurrently in a process pool.
+    Given a csound.DiskCache, unchanged staves are not
+    converted again (see cached_process_staff).
+    """
+
+    if score.endswith(".ly"):
+        staves = ly_staves(score, cache, include_path)
+        score = os.path.splitext(os.path.basename(score))[0]
+        if not staves:
+            raise ValueError("no staves in {0}.ly".format(score))
+    else:
+        staves = find_staves(score, directory)
+        if not staves:
+            raise ValueError("no {0}-<staff>.notes files in {1}".format(score, directory))
+    names = [name for name in instruments if name in staves]
+    names += sorted([name for name in staves if name not in instruments])
+    jobs = []
+    for name in names:
+        instrument = instruments.get(name, default)
+        if instrument is None:
+            raise ValueError("no instrument for staff {0!r}".format(name))
+        jobs.append((staves[name], "{0}-{1}".format(score, name), instrument, cache))
+
+    if processes:
+        pool = cs.worker_pool(processes)
+        try:
+            sections = pool.map(_convert_staff, jobs, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        sections = [_convert_staff(job) for job in jobs]
+
+    # each staff carries the score's tempo marks; the first
+    # staff to give a tempo for a time wins
+    tempi = {}
+    for section in sections:
+        for (when, tempo) in section.tempo:
+            tempi.setdefault(when, tempo)
+    tracks = [track for section in sections for track in section.parts]
+    section = cs.Section(score, tracks, [], cs.decZero, staff_dynamics())
+    section.tempo = tempi.items()
+    return cs.Song(score, sections=[section])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert the event-listener .notes files of a lilypond score to a csound score.")
+    parser.add_argument("score", nargs="?", default="test",
+                        help="score name: reads <score>-<staff>.notes (default: test); "
+                        "or a .ly file, parsed directly")
+    parser.add_argument("-d", "--directory", default=".", help="where the .notes files are")
+    parser.add_argument("-I", "--include", action="append", default=[], metavar="DIRECTORY",
+                        help="look for files a .ly score includes here too")
+    parser.add_argument("-c", "--config", help="JSON file mapping staff names to instrument numbers")
+    parser.add_argument("-i", "--instrument", action="append", default=[], metavar="STAFF=NUMBER",
+                        help="map a staff to an instrument number (overrides --config)")
+    parser.add_argument("--default-instrument", type=int, default=77, metavar="NUMBER",
+                        help="instrument for staves not otherwise mapped (default: 77)")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="convert staves in a pool of this many processes (default: one per CPU)")
+    parser.add_argument("-o", "--output", help="write the score here rather than to stdout")
+    parser.add_argument("-b", "--binary", action="store_true",
+                        help="write the binary score format (see binscore.py); needs --output")
+    parser.add_argument("--stats", choices=("text", "json"),
+                        help="report where the time went, on stderr (see renderstats.py); "
+                        "converts and renders in this process")
+    parser.add_argument("--cache", nargs="?", const=".lpcspy-cache", metavar="DIRECTORY",
+                        help="reuse staves and tracks converted by earlier runs, "
+                        "kept in DIRECTORY (default: .lpcspy-cache)")
+    parser.add_argument("-w", "--window", nargs=2, metavar=("START", "END"),
+                        help="write only the notes sounding from START up to END "
+                        "(in beats, in each section), e.g. to audition a few bars")
+    options = parser.parse_args(argv)
+    if options.binary and not options.output:
+        parser.error("--binary needs --output")
+    window = None
+    if options.window:
+        try:
+            window = tuple([cs.to_time(cs.parse_beats(text)) for text in options.window])
+        except (ArithmeticError, ValueError):
+            parser.error("expected beats, not {0} {1}".format(*options.window))
+
+    if options.config:
+        instruments = load_instruments(options.config)
+    else:
+        instruments = collections.OrderedDict()
+    for mapping in options.instrument:
+        (staff, sep, number) = mapping.partition("=")
+        if not sep:
+            parser.error("expected STAFF=NUMBER, not {0!r}".format(mapping))
+        instruments[staff] = cs.Instrument(int(number))
+    processes = options.processes
+    if options.stats:
+        import renderstats
+        renderstats.enable(options.stats)
+        processes = None  # work in other processes isn't seen
+    elif processes is None:
+        processes = multiprocessing.cpu_count()
+
+    cache = cs.DiskCache(options.cache) if options.cache else None
+
+    try:
+        song = convert_score(options.score, instruments, options.directory, processes,
+                             cs.Instrument(options.default_instrument), cache,
+                             options.include)
+    except ValueError as e:
+        parser.exit(1, "{0}\n".format(e))
+    if options.binary:
+        with open(options.output, "wb") as f:
+            song.emit(binscore.BinaryScoreWriter(f), cache=cache, window=window)
+    elif options.output:
+        with open(options.output, "w") as f:
+            song.emit(cs.ChunkedWriter(f), cache=cache, window=window)
+    else:
+        song.emit(cs.ChunkedWriter(sys.stdout), cache=cache, window=window)
+
+
+if __name__ == "__main__":
+    # run the importable module rather than __main__, so that it is the
+    # one other modules (renderstats) see and the one pool workers load
+    import lilypond
+    lilypond.main()
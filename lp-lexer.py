@@ -1,79 +1,100 @@
 from __future__ import print_function
-import ply.lexer as lex
+import ply.lex as lex
 from ply.lex import TOKEN
-import csound
+import argparse
 import codecs
+import collections
+import fractions
+import hashlib
+import importlib.util
+import os
 import sys
 
+
+# A lexer for LilyPond input, after the states and rules of LilyPond's own
+# lexer.ll, and a note-level parser for the subset of the language used in
+# scores like test.ly. The parser writes, for every staff, the same lines
+# lilypond's event-listener.ly writes to <score>-<staff>.notes, so that a
+# score can be converted without running lilypond at all:
+#
+#     python lp-lexer.py test.ly        # writes test-Bass.notes, ...
+#
+# or, through lilypond.py, python lilypond.py test.ly.
+#
+# The lexer is ply's; this module can't be imported with a plain import
+# statement (its name has a hyphen), so use importlib.import_module("lp-lexer").
+#
+# \include "file" is followed, relative to the including file and then along
+# an include path, and the tokens of every file read are kept in token_cache,
+# so files included by many scores are lexed once per process (and, given a
+# csound.DiskCache, once until they change).
+
 states = (
     ('chords', 'exclusive'),
     ('figures', 'exclusive'),
     ('incl', 'exclusive'),
     ('lyrics', 'exclusive'),
     ('longcomment', 'exclusive'),
-    ('maininput', 'exclusive'),
     ('markup', 'exclusive'),
     ('notes', 'exclusive'),
     ('quote', 'exclusive'),
-    ('commandquote', 'exclusive'),
     ('sourcefileline', 'exclusive'),
     ('sourcefilename', 'exclusive'),
     ('version', 'exclusive')
 )
 
-# SPECIAL category is for every letter that needs to get passed to
-# the parser rather than being redefinable by the user
+# states entered by a mode command (\notemode, \lyricmode, ...) and left at
+# the brace closing the block that follows it
+mode_states = ('notes', 'chords', 'figures', 'lyrics')
+
 tokens = (
-    "A",
-    "AA",
-    "N",
-    "ANY_CHAR",
+    "COMMAND",             # \name; the value is the name
+    "E_CHAR",              # \( \) \< \> \! ...; the value is the character
+    "E_UNSIGNED",          # \1 (a string number)
     "WORD",
-    "COMMAND",
-    "SPECIAL",
-    "SHORTHAND",
     "UNSIGNED",
-    "E_UNSIGNED",
-    "FRACTION",
-    "INT",
     "REAL",
-    "STRICTREAL",
-    "WHITE",
-    "HORIZONTALWHITE",
-    "BLACK",
-    "RESTNAME",
-    "ESCAPED",
-    "EXTENDER",
-    "HYPHEN",
-    "BOM_UTF8"
+    "FRACTION",
+    "STRING",              # "..."; the value is unquoted and unescaped
+    "SCHEME",              # #expression or $expression; the value is the text
+    "MARKUP",              # \markup ...; the value is the text
+    "INCLUDE",             # \include "file"; the value is the file name
+    "DOUBLE_ANGLE_OPEN",   # <<
+    "DOUBLE_ANGLE_CLOSE",  # >>
+    "DOUBLE_BACKSLASH",    # \\ (the voice separator)
 )
 
-t_A = r'[a-zA-Z\200-\377]'
-t_AA = t_A + r'|_'
-t_N = r'[0-9]'
-t_ANY_CHAR = r'(.|\n)'
-t_WORD = t_A + r'([-_]' + t_A + r'|' + t_A + r')*'
-t_COMMAND = r'\\' + t_WORD
-t_SHORTHAND = r'(.|\\.)'
-t_UNSIGNED = t_N + r'+'
-t_E_UNSIGNED = r'\\' + t_N + '+'
-t_FRACTION = t_N + r'+\/' + t_N + r'+'
-t_INT = r'-?' + t_UNSIGNED
-t_REAL = r'(' + t_INT + r'\.' + t_N + r'*)|(-?\.' + t_N + r'+)'
-t_STRICTREAL = t_UNSIGNED + r'\.' + t_UNSIGNED
-t_WHITE = r'[ \n\t\f\r]'
-t_HORIZONTALWHITE = r'[ \t]'
-t_BLACK = r'[^ \n\t\f\r]'
-t_RESTNAME = r'[rs]'
-t_ESCAPED = r'[nt\\''""]'
-t_EXTENDER = r'__'
-t_HYPHEN = r'--'
-t_BOM_UTF8 = codecs.BOM_UTF8
-
-
-def t_ANY_newline(t):
-    r'\n'
-    pass  # swallow and ignore carriage returns
+# SPECIAL characters are passed to the parser as they are
+literals = "{}<>()[]~|.',=-^_+!?*/:"
+
+A = r'[a-zA-Z\200-\377]'
+AA = A + r'|_'
+N = r'[0-9]'
+ANY_CHAR = r'(.|\n)'
+WORD = A + r'([-_]' + A + r'|' + A + r')*'
+COMMAND = r'\\' + WORD
+UNSIGNED = N + r'+'
+E_UNSIGNED = r'\\' + N + '+'
+FRACTION = N + r'+\/' + N + r'+'
+INT = r'-?' + UNSIGNED
+REAL = r'(' + INT + r'\.' + N + r'*)|(-?\.' + N + r'+)'
+STRICTREAL = UNSIGNED + r'\.' + UNSIGNED
+WHITE = r'[ \n\t\f\r]'
+HORIZONTALWHITE = r'[ \t]'
+BLACK = r'[^ \n\t\f\r]'
+RESTNAME = r'[rs]'
+ESCAPED = r'[nt\\''""]'
+EXTENDER = r'__'
+HYPHEN = r'--'
+BOM_UTF8 = codecs.BOM_UTF8
+
+t_ANY_ignore = ' \t\r\f'
+t_quote_longcomment_ignore = ''
+
+
+def t_INITIAL_chords_figures_incl_lyrics_markup_notes_sourcefileline_sourcefilename_version_newline(t):
+    r'\n+'
+    t.lexer.lineno += len(t.value)
 
 
 def t_INITIAL_chords_figures_incl_lyrics_markup_notes_StartMLComment(t):
@@ -82,38 +103,64 @@ def t_INITIAL_chords_figures_incl_lyrics_markup_notes_StartMLComment(t):
 
 
 def t_INITIAL_chords_figures_incl_lyrics_markup_notes_PercentNobrace(t):
-    r'%[^{\n\r][^\n\r]*[\n\r]?'
-    return t
+    r'%[^{\n\r][^\n\r]*'
+    pass  # a comment to the end of the line
 
 
 def t_INITIAL_chords_figures_incl_lyrics_markup_notes_PercentCRLF(t):
-    r'%[\n\r]?'
+    r'%'
     pass
 
 
 def t_INITIAL_chords_figures_incl_lyrics_markup_notes_Whitespace(t):
-    r'\s+'
+    r'[ \t\f\r]+'
     pass
 
 
-def t_INITIAL_chords_figures_markup_notes_StartQuote(t):
+def t_INITIAL_chords_figures_lyrics_notes_StartQuote(t):
     r'"'
     t.lexer.push_state('quote')
-    # (*lexval_) = SCM_EOL
+    t.lexer.string_start = t.lexpos
+    t.lexer.string_parts = []
+
+
+def t_quote_Escaped(t):
+    r'\\(.|\n)'
+    char = t.value[1]
+    t.lexer.lineno += char.count("\n")
+    t.lexer.string_parts.append({"n": "\n", "t": "\t"}.get(char, char))
+
+
+def t_quote_Text(t):
+    r'[^"\\]+'
+    t.lexer.lineno += t.value.count("\n")
+    t.lexer.string_parts.append(t.value)
+
+
+def t_quote_EndQuote(t):
+    r'"'
+    t.lexer.pop_state()
+    t.type = "STRING"
+    t.value = "".join(t.lexer.string_parts)
+    t.lexpos = t.lexer.string_start
+    return t
 
 
 def t_INITIAL_chords_figures_lyrics_notes_BackslashVersion(t):
     r'\\version\s*'
+    t.lexer.lineno += t.value.count("\n")
     t.lexer.push_state('version')
 
 
 def t_INITIAL_chords_figures_lyrics_notes_BackslashSourcefilename(t):
     r'\\sourcefilename\s*'
+    t.lexer.lineno += t.value.count("\n")
     t.lexer.push_state('sourcefilename')
 
 
 def t_INITIAL_chords_figures_lyrics_notes_BackslashSourcefileline(t):
     r'\\sourcefileline\s*'
+    t.lexer.lineno += t.value.count("\n")
     t.lexer.push_state('sourcefileline')
 
 
@@ -123,47 +170,47 @@ def extract_from_quotes(quoted_string):
 
 def t_version_Quote(t):
     r'\"[^""]*\"'
-    t.lexer.lpversion = extract_from_quotes(t.value())
+    t.lexer.lpversion = extract_from_quotes(t.value)
     t.lexer.pop_state()
 
 
 def t_sourcefilename_Quote(t):
     r'\"[^""]*\"'
-    t.lexer.sourcefilename = extract_from_quotes(t.value())
+    t.lexer.sourcefilename = extract_from_quotes(t.value)
     t.lexer.pop_state()
 
 
-@TOKEN(t_INT)
+@TOKEN(INT)
 def t_sourcefileline_INT(t):
-    t.lexer.sourcefileline = int(t.value())
+    t.lexer.sourcefileline = int(t.value)
     t.lexer.pop_state()
 
 
-@TOKEN(t_ANY_CHAR)
-def t_version_sourcefilename_ANY_CHAR(t):
-    print ("error: quoted string expected after \\[version,sourcefilename]", file=sys.stderr)
+@TOKEN(ANY_CHAR)
+def t_version_sourcefilename_UnexpectedChar(t):
+    print("error: quoted string expected after \\version or \\sourcefilename", file=sys.stderr)
     t.lexer.pop_state()
 
 
-@TOKEN(t_ANY_CHAR)
-def t_version_sourcefileline_ANY_CHAR(t):
-    print ("error: integer expected after \\sourcefileline", file=sys.stderr)
+@TOKEN(ANY_CHAR)
+def t_sourcefileline_UnexpectedChar(t):
+    print("error: integer expected after \\sourcefileline", file=sys.stderr)
     t.lexer.pop_state()
 
 
-def t_longcomment_NotBackslashOrPercent(t):
-    r'[^\%]*'
-    pass  # do nothing I guess?
+def t_longcomment_CommentEnd(t):
+    r'%}'
+    t.lexer.pop_state()
 
 
-def t_longcomment_PercentThenNotRightBraceOrPercent(t):
-    r'\%*[^}%]*'
-    pass  # do nothing I guess?
+def t_longcomment_NotPercent(t):
+    r'[^%]+'
+    t.lexer.lineno += t.value.count("\n")
 
 
-def t_longcomment_CommentEnd(t):
-    r'%}'
-    t.lexer.pop_state()
+def t_longcomment_Percent(t):
+    r'%'
+    pass
 
 
 def t_INITIAL_chords_lyrics_notes_figures_BackslashMaininput(t):
@@ -178,19 +225,1247 @@ def t_INITIAL_chords_lyrics_notes_figures_BackslashMaininput(t):
 
 def t_INITIAL_chords_lyrics_figures_notes_BackslashInclude(t):
     r'\\include'
-    t.lexer.push_state('include')
+    t.lexer.push_state('incl')
 
 
-def t_include_QuotedFilename(t):
+def t_incl_QuotedFilename(t):
     r'\"[^""]*\"'
-    s = extract_from_quotes(t.value())
-    # new_input(s, sources_)
     t.lexer.pop_state()
+    t.type = "INCLUDE"
+    t.value = extract_from_quotes(t.value)
+    return t
 
 
-# ...several more include-related functions I don't know how to support yet...
-
-
-def t_include_version_sourcefilename_EndQuoteMissing(t):
+def t_incl_version_sourcefilename_EndQuoteMissing(t):
     r'\"[^""]*'
     print("end quote missing", file=sys.stderr)
+    t.lexer.pop_state()
+
+
+def t_INITIAL_chords_figures_lyrics_notes_StartMarkup(t):
+    r'\\markup(list)?(?![a-zA-Z\200-\377])'
+    # the markup runs to the end of its first argument that isn't a markup
+    # command: a word, a string or a braced list
+    t.lexer.push_state('markup')
+    t.lexer.markup_start = t.lexpos
+    t.lexer.markup_depth = 0
+
+
+def _end_markup(t):
+    # close the markup at the end of t if it isn't inside braces
+    if t.lexer.markup_depth > 0:
+        return None
+    t.lexer.pop_state()
+    t.type = "MARKUP"
+    t.value = t.lexer.lexdata[t.lexer.markup_start:t.lexer.lexpos]
+    t.lexpos = t.lexer.markup_start
+    return t
+
+
+def t_markup_OpenBrace(t):
+    r'\{'
+    t.lexer.markup_depth += 1
+
+
+def t_markup_CloseBrace(t):
+    r'\}'
+    t.lexer.markup_depth -= 1
+    return _end_markup(t)
+
+
+def t_markup_String(t):
+    r'"([^"\\]|\\(.|\n))*"'
+    t.lexer.lineno += t.value.count("\n")
+    return _end_markup(t)
+
+
+def t_markup_Command(t):
+    r'\\[a-zA-Z\200-\377]([-_]?[a-zA-Z\200-\377])*'
+    pass  # a markup function, applied to what follows
+
+
+def t_markup_Scheme(t):
+    r'[\#$]'
+    t.lexer.lexpos = scan_scheme(t.lexer.lexdata, t.lexer.lexpos)
+    t.lexer.lineno += t.lexer.lexdata.count("\n", t.lexpos, t.lexer.lexpos)
+    return _end_markup(t)
+
+
+def t_markup_Word(t):
+    r'[^\s{}"\\\#$%]+'
+    return _end_markup(t)
+
+
+def t_INITIAL_chords_figures_lyrics_notes_ModeCommand(t):
+    r'\\(notemode|chordmode|chords|figuremode|figures|lyricmode|lyrics|addlyrics|lyricsto)(?![a-zA-Z\200-\377])'
+    state = {"notemode": "notes", "chordmode": "chords", "chords": "chords",
+             "figuremode": "figures", "figures": "figures"}.get(t.value[1:], "lyrics")
+    t.lexer.push_state(state)
+    t.lexer.mode_depths.append(0)
+    t.type = "COMMAND"
+    t.value = t.value[1:]
+    return t
+
+
+def t_INITIAL_chords_figures_lyrics_notes_DOUBLE_BACKSLASH(t):
+    r'\\\\'
+    return t
+
+
+def t_INITIAL_chords_figures_lyrics_notes_E_UNSIGNED(t):
+    r'\\[0-9]+'
+    t.value = int(t.value[1:])
+    return t
+
+
+def t_INITIAL_chords_figures_lyrics_notes_E_CHAR(t):
+    r'\\[^a-zA-Z\200-\377\s]'
+    t.value = t.value[1:]
+    return t
+
+
+@TOKEN(COMMAND)
+def t_INITIAL_chords_figures_lyrics_notes_COMMAND(t):
+    t.value = t.value[1:]
+    return t
+
+
+def scan_string(data, pos):
+    """The end of the string literal starting at data[pos] (a double quote)."""
+    pos += 1
+    while pos < len(data):
+        char = data[pos]
+        if char == "\\":
+            pos += 2
+            continue
+        pos += 1
+        if char == '"':
+            break
+    return pos
+
+
+def scan_scheme(data, pos):
+    """
+    The end of the Scheme expression that starts at data[pos], just after
+    its # or $: a parenthesized list, a string, #{ embedded LilyPond #} or
+    an atom, with any quote marks before it.
+    """
+    end = len(data)
+    while pos < end and data[pos] in "'`,@":
+        pos += 1
+    if pos >= end:
+        return pos
+    if data[pos] == '"':
+        return scan_string(data, pos)
+    if data[pos] == '{':
+        close = data.find('#}', pos)
+        return end if close < 0 else close + 2
+    if data[pos] == '(':
+        depth = 0
+        while pos < end:
+            char = data[pos]
+            if char == '"':
+                pos = scan_string(data, pos)
+                continue
+            if char == ';':
+                close = data.find('\n', pos)
+                pos = end if close < 0 else close
+                continue
+            if data.startswith('#\\', pos):
+                pos += 3  # a character literal
+                continue
+            if char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
+                if depth == 0:
+                    return pos + 1
+            pos += 1
+        return pos
+    while pos < end and not data[pos].isspace() and data[pos] not in '(){}<>"':
+        pos += 1
+    return pos
+
+
+def t_INITIAL_chords_figures_lyrics_notes_SCHEME(t):
+    r'[\#$]'
+    end = scan_scheme(t.lexer.lexdata, t.lexer.lexpos)
+    t.value = t.lexer.lexdata[t.lexpos:end]
+    t.lexer.lineno += t.value.count("\n")
+    t.lexer.lexpos = end
+    return t
+
+
+def t_INITIAL_chords_figures_lyrics_notes_DOUBLE_ANGLE_OPEN(t):
+    r'<<'
+    return t
+
+
+def t_INITIAL_chords_figures_lyrics_notes_DOUBLE_ANGLE_CLOSE(t):
+    r'>>'
+    return t
+
+
+def t_INITIAL_chords_figures_lyrics_notes_OpenBrace(t):
+    r'\{'
+    if t.lexer.mode_depths and t.lexer.current_state() in mode_states:
+        t.lexer.mode_depths[-1] += 1
+    t.type = "{"
+    return t
+
+
+def t_INITIAL_chords_figures_lyrics_notes_CloseBrace(t):
+    r'\}'
+    if t.lexer.mode_depths and t.lexer.current_state() in mode_states:
+        t.lexer.mode_depths[-1] -= 1
+        if t.lexer.mode_depths[-1] <= 0:
+            t.lexer.mode_depths.pop()
+            t.lexer.pop_state()
+    t.type = "}"
+    return t
+
+
+@TOKEN(FRACTION)
+def t_INITIAL_chords_notes_FRACTION(t):
+    return t
+
+
+@TOKEN(STRICTREAL)
+def t_INITIAL_chords_notes_REAL(t):
+    t.value = float(t.value)
+    return t
+
+
+@TOKEN(UNSIGNED)
+def t_INITIAL_chords_notes_UNSIGNED(t):
+    t.value = int(t.value)
+    return t
+
+
+@TOKEN(WORD)
+def t_INITIAL_chords_notes_WORD(t):
+    return t
+
+
+def t_figures_lyrics_WORD(t):
+    r'[^\s{}"\\\#$%]+'
+    return t
+
+
+def t_ANY_error(t):
+    print("error: unexpected character {0!r} at line {1}".format(t.value[0], t.lexer.lineno),
+          file=sys.stderr)
+    t.lexer.skip(1)
+
+
+def rules_signature():
+    """
+    A hash of the lexer's states, tokens and rules, which names the module
+    of precomputed tables built from them (see make_lexer).
+    """
+    digest = hashlib.sha256(repr((states, tokens, literals)).encode("utf-8"))
+    for (name, rule) in sorted(globals().items()):
+        if name.startswith("t_"):
+            if callable(rule):
+                rule = getattr(rule, "regex", rule.__doc__)
+            digest.update("{0}={1}\n".format(name, rule).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def tables_path(directory=None):
+    """
+    The path of the module of precomputed tables for the current rules in
+    directory (by default the one holding this module).
+    """
+    directory = directory or os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(directory, "lp_lextab_" + rules_signature() + ".py")
+
+
+def _read_tables(path):
+    # the tables module at path, or None if there is none ply can use
+    if not os.path.isfile(path):
+        return None
+    spec = importlib.util.spec_from_file_location(
+        os.path.splitext(os.path.basename(path))[0], path)
+    tables = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(tables)
+    if getattr(tables, "_tabversion", None) != lex.__tabversion__:
+        return None  # ply would rebuild them, and write them over these
+    return tables
+
+
+_lexers = {}  # (optimize, outputdir) -> the lexer make_lexer clones
+
+
+def make_lexer(optimize=True, outputdir=None):
+    """
+    A new lexer, in the initial state. The first call in a process builds a
+    lexer and later calls clone it, which costs next to nothing.
+
+    With optimize, the lexer is built from ply's precomputed tables (the
+    master regexes of every state) in the module lp_lextab_<signature>.py
+    in outputdir (by default the directory holding this module), and the
+    rules aren't validated. Nothing is written: the tables are made by
+    write_tables (python lp-lexer.py --write-tables), and without them
+    the lexer is built from the rules. The signature changes with the
+    rules, so tables are never stale.
+    """
+    lexer = _lexers.get((optimize, outputdir))
+    if lexer is None:
+        tables = _read_tables(tables_path(outputdir)) if optimize else None
+        if tables is not None:
+            lexer = lex.lex(optimize=1, lextab=tables, errorlog=lex.NullLogger())
+        elif optimize:
+            # no lextab (ply takes None as "lextab") reads and writes nothing
+            lexer = lex.lex(optimize=1, lextab="", errorlog=lex.NullLogger())
+        else:
+            lexer = lex.lex()
+        _lexers[(optimize, outputdir)] = lexer
+    lexer = lexer.clone()
+    reset_lexer(lexer)
+    return lexer
+
+
+def write_tables(directory=None):
+    """
+    Write the precomputed tables make_lexer loads, into directory (by
+    default the one holding this module). Returns the module's path.
+    """
+    path = tables_path(directory)
+    lexer = lex.lex()
+    lexer.writetab(os.path.splitext(os.path.basename(path))[0], os.path.dirname(path))
+    return path
+
+
+def reset_lexer(lexer):
+    lexer.begin('INITIAL')
+    lexer.lexstatestack = []
+    lexer.lineno = 1
+    lexer.lpversion = None
+    lexer.sourcefilename = None
+    lexer.sourcefileline = None
+    lexer.include_stack_ = []
+    lexer.is_main_input_ = False
+    lexer.main_input_level_ = 0
+    lexer.mode_depths = []
+
+
+class Token(object):
+    """
+    A token as the parser sees it: a ply LexToken without its lexer (so it
+    pickles small), and with the column (from 0) at which it starts.
+    """
+
+    __slots__ = ("type", "value", "lineno", "lexpos", "column")
+
+    def __init__(self, type, value, lineno, lexpos, column):
+        self.type = type
+        self.value = value
+        self.lineno = lineno
+        self.lexpos = lexpos
+        self.column = column
+
+    def __repr__(self):
+        return "Token({0}, {1!r}, {2}, {3})".format(self.type, self.value, self.lineno, self.column)
+
+
+def tokenize(text, lexer=None):
+    """The tokens of text, as a list of Tokens."""
+    if lexer is None:
+        lexer = make_lexer()
+    else:
+        reset_lexer(lexer)
+    lexer.input(text)
+    result = []
+    line_start = 0
+    scanned = 0
+    for token in iter(lexer.token, None):
+        newline = text.rfind("\n", scanned, token.lexpos)
+        if newline >= 0:
+            line_start = newline + 1
+        scanned = token.lexpos
+        result.append(Token(token.type, token.value, token.lineno, token.lexpos,
+                            token.lexpos - line_start))
+    return result
+
+
+# bump when the tokens the lexer produces change, to leave stale DiskCache
+# entries behind
+_token_version = 1
+
+
+class TokenCache(object):
+    """
+    A TokenCache keeps the tokens of the files read through it, by absolute
+    path. An entry is reused while the file's mtime and size are unchanged,
+    and otherwise while its content hash is: only new or changed files are
+    lexed. Given a csound.DiskCache, tokens are also looked up and stored
+    there by content hash, so unchanged files aren't lexed again by later
+    runs either.
+    """
+
+    def __init__(self):
+        self.entries = {}  # path -> (mtime, size, digest, tokens)
+        self.lexer = None
+        self.lexed = 0  # the number of files actually lexed
+
+    def tokens(self, path, disk=None):
+        """The tokens of the file at path, which are shared: don't modify them."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+            return entry[3]
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if entry is not None and entry[2] == digest:
+            tokens = entry[3]
+        else:
+            tokens = self._lex(data, digest, disk)
+        self.entries[path] = (stat.st_mtime_ns, stat.st_size, digest, tokens)
+        return tokens
+
+    def _lex(self, data, digest, disk):
+        key = None
+        if disk is not None:
+            import csound as cs  # only here: it takes longer to import than to lex most files
+            key = cs.cache_key("tokens", _token_version, digest)
+            tokens = disk.load(key)
+            if tokens is not None:
+                return tokens
+        if self.lexer is None:
+            self.lexer = make_lexer()
+        tokens = tokenize(data.decode("utf-8-sig"), self.lexer)
+        self.lexed += 1
+        if key is not None:
+            disk.store(key, tokens)
+        return tokens
+
+    def clear(self):
+        self.entries.clear()
+
+
+token_cache = TokenCache()
+
+# files that come with lilypond: event-listener.ly is what this module
+# stands in for, and the note name files are the old way to set a language
+lilypond_includes = {
+    "event-listener.ly": None,
+    "english.ly": "english",
+    "nederlands.ly": "nederlands",
+}
+
+
+# Note names, for \language: name -> (step, alteration in semitones)
+
+def _nederlands():
+    names = {}
+    for (step, name) in enumerate("cdefgab"):
+        names[name] = (step, 0)
+        names[name + "is"] = (step, 1)
+        names[name + "isis"] = (step, 2)
+        names[name + "es"] = (step, -1)
+        names[name + "eses"] = (step, -2)
+    names["as"] = names["aes"]
+    names["ases"] = names["aeses"]
+    names["es"] = names["ees"]
+    names["eses"] = names["eeses"]
+    return names
+
+
+def _english():
+    names = {}
+    suffixes = (("", 0), ("s", 1), ("ss", 2), ("x", 2), ("f", -1), ("ff", -2),
+                ("-sharp", 1), ("-sharpsharp", 2), ("-flat", -1), ("-flatflat", -2))
+    for (step, name) in enumerate("cdefgab"):
+        for (suffix, alteration) in suffixes:
+            names[name + suffix] = (step, alteration)
+    return names
+
+
+note_names = {
+    "nederlands": _nederlands(),
+    "english": _english(),
+}
+
+_semitones = (0, 2, 4, 5, 7, 9, 11)
+
+# post-event scripts, by shorthand and by command
+_script_shorthands = {".": "staccato", "-": "tenuto", ">": "accent", "^": "marcato",
+                      "+": "stopped", "_": "portato", "!": "staccatissimo",
+                      "|": "staccatissimo"}
+_script_commands = set([
+    "accent", "espressivo", "marcato", "portato", "staccatissimo", "staccato", "tenuto",
+    "fermata", "shortfermata", "longfermata", "verylongfermata", "prall", "mordent",
+    "prallprall", "trill", "turn", "reverseturn", "upbow", "downbow", "flageolet", "thumb",
+    "open", "halfopen", "stopped", "snappizzicato", "segno", "coda", "varcoda", "lheel",
+    "rheel", "ltoe", "rtoe"])
+# post events the .notes files don't record
+_ignored_post_commands = set([
+    "p", "pp", "ppp", "pppp", "mp", "mf", "f", "ff", "fff", "ffff", "fp", "sf", "sff", "sp",
+    "spp", "sfz", "rfz", "cresc", "decresc", "dim", "startTrillSpan", "stopTrillSpan",
+    "startTextSpan", "stopTextSpan", "glissando", "arpeggio", "laissezVibrer", "repeatTie",
+    "harmonic", "noBeam", "startGroup", "stopGroup"])
+
+_staff_contexts = set(["Staff", "RhythmicStaff", "TabStaff", "DrumStaff"])
+_text_contexts = set(["Lyrics", "ChordNames", "FiguredBass", "NoteNames"])
+
+# commands taking a single argument token that doesn't matter here
+_one_argument_commands = set(["clef", "bar", "mark", "label", "ottava", "compressMMRests"])
+# commands followed by a block that doesn't matter here
+_block_commands = set(["header", "layout", "midi", "paper", "with"])
+
+
+class ScoreParser(object):
+    """
+    A ScoreParser parses LilyPond input down to notes, enough of it to
+    write the event-listener lines of each staff: the notes, rests, ties,
+    slurs, scripts and tempo changes, timed in whole notes. It understands
+    sequential { } and simultaneous << >> music (with \\\\ voices), chords
+    < >, relative and fixed octave entry, durations with dots and
+    multipliers, \\times and \\tuplet, repeats and \\unfold, \\transpose,
+    \\new and \\context staves, music variables and \\include; layout
+    commands are skipped, and grace notes and lyric, chord name and figure
+    contexts are left out. Malformed input raises ValueError.
+    """
+
+    def __init__(self, include_path=(), disk=None):
+        self.include_path = list(include_path)
+        self.disk = disk
+        self.lexer = None
+        self.music_commands = {
+            "relative": self.relative_music,
+            "fixed": self.fixed_music,
+            "transpose": self.transpose_music,
+            "new": self.context_music,
+            "context": self.context_music,
+            "times": self.times_music,
+            "tuplet": self.tuplet_music,
+            "scaleDurations": self.scaled_music,
+            "repeat": self.repeated_music,
+            "unfold": self.unfold_music,
+            "grace": self.grace_music,
+            "acciaccatura": self.grace_music,
+            "appoggiatura": self.grace_music,
+            "slashedGrace": self.grace_music,
+            "afterGrace": self.after_grace_music,
+            "skip": self.skip_music,
+            "tempo": self.tempo,
+            "time": self.time_signature,
+            "key": self.key,
+            "partial": self.partial,
+            "set": self.property_setting,
+            "override": self.property_setting,
+            "unset": self.property_setting,
+            "revert": self.property_setting,
+            "tweak": self.tweak,
+            "omit": self.property_setting,
+            "hide": self.property_setting,
+            "accidentalStyle": self.property_setting,
+            "language": self.language,
+            "notemode": self.note_mode,
+            "lyricsto": self.text_music,
+            "lyricmode": self.text_music,
+            "lyrics": self.text_music,
+            "addlyrics": self.text_music,
+            "chordmode": self.text_music,
+            "chords": self.text_music,
+            "figuremode": self.text_music,
+            "figures": self.text_music,
+        }
+
+    def parse(self, text, directory="."):
+        """
+        Parse a whole file, given as text; it includes files relative to
+        directory. Returns an ordered dictionary of staff name to the
+        event-listener lines for the staff (without line ends). Staves
+        without a name are named by their number, from 1.
+        """
+        if self.lexer is None:
+            self.lexer = make_lexer()
+        return self.parse_tokens(self.expand_includes(tokenize(text, self.lexer),
+                                                      directory, []))
+
+    def parse_file(self, path):
+        """Parse the file at path (see parse), through token_cache."""
+        path = os.path.abspath(path)
+        tokens = token_cache.tokens(path, self.disk)
+        return self.parse_tokens(self.expand_includes(tokens, os.path.dirname(path), [path]))
+
+    def expand_includes(self, tokens, directory, stack):
+        """
+        tokens with each INCLUDE token replaced by the tokens of the file it
+        names, recursively. stack holds the paths of the files being
+        included, to catch a file that includes itself.
+        """
+        if not any([token.type == "INCLUDE" for token in tokens]):
+            return tokens
+        result = []
+        for token in tokens:
+            if token.type != "INCLUDE":
+                result.append(token)
+                continue
+            path = self.find_include(token.value, directory)
+            if path is None:
+                if token.value in lilypond_includes:
+                    language = lilypond_includes[token.value]
+                    if language is not None:
+                        result.append(Token("COMMAND", "language", token.lineno, token.lexpos,
+                                            token.column))
+                        result.append(Token("STRING", language, token.lineno, token.lexpos,
+                                            token.column))
+                else:
+                    print("warning: line {0}: cannot find included file {1!r}".format(
+                        token.lineno, token.value), file=sys.stderr)
+                continue
+            if path in stack:
+                self.error("{0} includes itself".format(token.value), token)
+            stack.append(path)
+            try:
+                result.extend(self.expand_includes(token_cache.tokens(path, self.disk),
+                                                   os.path.dirname(path), stack))
+            finally:
+                stack.pop()
+        return result
+
+    def find_include(self, name, directory):
+        # relative to the including file, then along the include path
+        for base in [directory] + self.include_path:
+            path = os.path.abspath(os.path.join(base, name))
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def parse_tokens(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.names = note_names["nederlands"]
+        self.variables = {}
+        self.staves = collections.OrderedDict()
+        self.records = []  # [staff, time, sequence, kind, fields]; staff None for all
+        self.staff = None
+        self.discard = 0
+        self.relative = None  # the (octave, step) notes are relative to
+        self.absolute_octave = -1  # the octave of an unmarked note out of \relative
+        self.transposition = 0
+        self.scale = fractions.Fraction(1)
+        self.default_duration = ("4", fractions.Fraction(1, 4))
+        self.last_chord = None
+        while self.peek() is not None:
+            self.toplevel()
+        return self.staff_lines()
+
+    # tokens
+
+    def peek(self, ahead=0):
+        if self.pos + ahead < len(self.tokens):
+            return self.tokens[self.pos + ahead]
+        return None
+
+    def peek_type(self, ahead=0):
+        token = self.peek(ahead)
+        return None if token is None else token.type
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError("unexpected end of input")
+        self.pos += 1
+        return token
+
+    def expect(self, kind):
+        token = self.next()
+        if token.type != kind:
+            self.error("expected {0}, not {1!r}".format(kind, token.value), token)
+        return token
+
+    def accept(self, kind):
+        if self.peek_type() == kind:
+            return self.next()
+        return None
+
+    def error(self, message, token=None):
+        token = token or self.peek()
+        if token is None:
+            raise ValueError(message)
+        raise ValueError("line {0}: {1}".format(token.lineno, message))
+
+    def skip_balanced(self):
+        # skip a { } or << >> block, whatever is in it
+        depth = 0
+        while True:
+            kind = self.next().type
+            if kind in ("{", "DOUBLE_ANGLE_OPEN"):
+                depth += 1
+            elif kind in ("}", "DOUBLE_ANGLE_CLOSE"):
+                depth -= 1
+            if depth <= 0:
+                return
+
+    def skip_path(self):
+        # Context.Grob.property, as for \set or \override
+        self.expect("WORD")
+        while self.peek_type() == "." and self.peek_type(1) == "WORD":
+            self.pos += 2
+
+    def skip_value(self):
+        # one value: music or a single token
+        if self.is_music(self.peek()):
+            self.dry_run()
+        else:
+            self.next()
+
+    def is_music(self, token):
+        if token is None:
+            return False
+        if token.type in ("{", "DOUBLE_ANGLE_OPEN", "<"):
+            return True
+        if token.type == "WORD":
+            return token.value in self.names or token.value in ("r", "s", "R", "q")
+        if token.type == "COMMAND":
+            return token.value in self.music_commands or token.value in self.variables
+        return False
+
+    def dry_run(self):
+        # parse one music expression for its extent, recording nothing
+        saved = (self.relative, self.absolute_octave, self.transposition, self.scale,
+                 self.default_duration, self.last_chord, self.staff)
+        self.discard += 1
+        try:
+            self.music(fractions.Fraction(0))
+        finally:
+            self.discard -= 1
+            (self.relative, self.absolute_octave, self.transposition, self.scale,
+             self.default_duration, self.last_chord, self.staff) = saved
+
+    # output
+
+    def new_staff(self, name):
+        if name is None:
+            name = str(len(self.staves) + 1)
+        if not self.discard:
+            self.staves[name] = True
+        return name
+
+    def record(self, time, kind, *fields):
+        if self.discard:
+            return
+        staff = None
+        if kind != "tempo":
+            if self.staff is None:
+                self.staff = self.new_staff(None)
+            staff = self.staff
+        self.records.append([staff, time, len(self.records), kind, fields])
+
+    def staff_lines(self):
+        lines = collections.OrderedDict([(name, []) for name in self.staves])
+        # tempo changes first at any moment, and in every staff
+        records = sorted(self.records, key=lambda r: (r[1], r[3] != "tempo", r[2]))
+        for (staff, time, sequence, kind, fields) in records:
+            line = format_line(time, kind, fields)
+            if staff is None:
+                for staff_lines in lines.values():
+                    staff_lines.append(line)
+            else:
+                lines[staff].append(line)
+        return lines
+
+    # top level
+
+    def toplevel(self):
+        token = self.peek()
+        if token.type in ("WORD", "STRING") and self.peek_type(1) == "=":
+            self.pos += 2
+            start = self.pos
+            self.skip_value()
+            self.variables[token.value] = self.tokens[start:self.pos]
+        elif token.type == "COMMAND" and token.value in ("book", "bookpart", "score"):
+            self.next()
+            self.expect("{")
+            while self.peek_type() != "}":
+                self.toplevel()
+            self.next()
+        else:
+            self.music(fractions.Fraction(0))
+
+    # music: each method takes the start time and returns the end time, in
+    # whole notes
+
+    def music(self, time):
+        token = self.next()
+        kind = token.type
+        if kind == "{":
+            while self.peek_type() != "}":
+                time = self.music(time)
+            self.next()
+            return time
+        if kind == "DOUBLE_ANGLE_OPEN":
+            return self.simultaneous(time)
+        if kind == "<":
+            return self.chord(time, token)
+        if kind == "WORD":
+            return self.note(time, token)
+        if kind == "COMMAND":
+            if token.value in self.variables:
+                return self.expand(time, token.value)
+            if token.value in self.music_commands:
+                return self.music_commands[token.value](time)
+            if token.value in _one_argument_commands:
+                self.next()
+            elif token.value in _block_commands:
+                self.skip_balanced()
+            return time  # \stemUp, \break, ...
+        return time  # bar checks, stray strings, markups, Scheme
+
+    def expand(self, time, name):
+        saved = (self.tokens, self.pos)
+        (self.tokens, self.pos) = (self.variables[name], 0)
+        try:
+            while self.peek() is not None:
+                time = self.music(time)
+        finally:
+            (self.tokens, self.pos) = saved
+        return time
+
+    def simultaneous(self, time):
+        # with \\ the parts between separators are voices, each sequential;
+        # otherwise every expression starts together
+        voices = False
+        depth = 0
+        for token in self.tokens[self.pos:]:
+            if token.type in ("{", "DOUBLE_ANGLE_OPEN"):
+                depth += 1
+            elif token.type in ("}", "DOUBLE_ANGLE_CLOSE"):
+                if depth == 0:
+                    break
+                depth -= 1
+            elif token.type == "DOUBLE_BACKSLASH" and depth == 0:
+                voices = True
+                break
+
+        end = time
+        voice_time = time
+        while self.peek_type() != "DOUBLE_ANGLE_CLOSE":
+            if self.accept("DOUBLE_BACKSLASH"):
+                end = max(end, voice_time)
+                voice_time = time
+            elif voices:
+                voice_time = self.music(voice_time)
+            else:
+                end = max(end, self.music(time))
+        self.next()
+        return max(end, voice_time)
+
+    def pitch(self, token, update=True):
+        """The MIDI pitch of the note named by token (and its octave marks)."""
+        if token.value not in self.names:
+            self.error("unknown note name {0!r}".format(token.value), token)
+        (step, alteration) = self.names[token.value]
+        octaves = 0
+        while self.peek_type() in ("'", ","):
+            octaves += 1 if self.next().type == "'" else -1
+        if self.relative is None:
+            octave = self.absolute_octave + octaves
+        else:
+            (ref_octave, ref_step) = self.relative
+            steps = ref_octave * 7 + step
+            if steps - (ref_octave * 7 + ref_step) > 3:
+                steps -= 7
+            elif steps - (ref_octave * 7 + ref_step) < -3:
+                steps += 7
+            octave = steps // 7 + octaves
+            if update:
+                self.relative = (octave, step)
+        if self.accept("="):  # an octave check
+            while self.peek_type() in ("'", ","):
+                self.next()
+        while self.peek_type() in ("!", "?"):
+            self.next()
+        return 60 + 12 * octave + _semitones[step] + alteration + self.transposition, (octave, step)
+
+    def duration(self, default=True):
+        """
+        The (text, length in whole notes) of the duration at the current
+        token, or None. With default, it becomes the default duration.
+        """
+        token = self.peek()
+        if token is None:
+            return None
+        if token.type == "UNSIGNED":
+            if token.value & (token.value - 1) or token.value == 0:
+                self.error("not a duration: {0}".format(token.value), token)
+            (text, length) = (str(token.value), fractions.Fraction(1, token.value))
+        elif token.type == "COMMAND" and token.value in ("breve", "longa", "maxima"):
+            (text, length) = ("\\" + token.value,
+                              {"breve": 2, "longa": 4, "maxima": 8}[token.value])
+            length = fractions.Fraction(length)
+        else:
+            return None
+        self.next()
+        dot = length
+        while self.accept("."):
+            dot /= 2
+            length += dot
+            text += "."
+        while self.accept("*"):
+            factor = self.next()
+            if factor.type == "FRACTION":
+                length *= fractions.Fraction(factor.value)
+                text += "*" + factor.value
+            elif factor.type == "UNSIGNED":
+                multiplier = fractions.Fraction(factor.value)
+                text += "*{0}".format(factor.value)
+                if self.accept("/"):
+                    multiplier /= self.expect("UNSIGNED").value
+                    text += "/{0}".format(self.tokens[self.pos - 1].value)
+                length *= multiplier
+            else:
+                self.error("expected a duration multiplier", factor)
+        if default:
+            self.default_duration = (text, length)
+        return (text, length)
+
+    def post_events(self):
+        """The post events after a note or chord: ("tie",), ("slur", direction) and ("script", name)."""
+        events = []
+        while True:
+            token = self.peek()
+            kind = None if token is None else token.type
+            if kind == "~":
+                events.append(("tie",))
+            elif kind == "(":
+                events.append(("slur", -1))
+            elif kind == ")":
+                events.append(("slur", 1))
+            elif kind in ("[", "]", "E_CHAR", "E_UNSIGNED"):
+                pass  # beams, phrasing slurs, hairpins, string numbers
+            elif kind in ("-", "^", "_"):
+                self.next()
+                script = self.next()
+                if script.type in _script_shorthands:
+                    events.append(("script", _script_shorthands[script.type]))
+                elif script.type == "COMMAND" and script.value in _script_commands:
+                    events.append(("script", script.value))
+                continue  # fingerings, text, markup, dynamics
+            elif kind == ":":
+                self.next()
+                self.accept("UNSIGNED")  # tremolo
+                continue
+            elif kind == "COMMAND" and token.value in _script_commands:
+                events.append(("script", token.value))
+            elif kind == "COMMAND" and token.value in _ignored_post_commands:
+                pass
+            else:
+                return events
+            self.next()
+
+    def note(self, time, token):
+        name = token.value
+        if name in ("r", "s", "R"):
+            (text, length) = self.duration() or self.default_duration
+            self.post_events()
+            if name != "s":
+                self.record(time, "rest", text, length * self.scale)
+            return time + length * self.scale
+        if name == "q":
+            if self.last_chord is None:
+                self.error("q without a chord before it", token)
+            return self.sound(time, [(pitch, note_token, []) for (pitch, note_token)
+                                     in self.last_chord])
+        (pitch, position) = self.pitch(token)
+        return self.sound(time, [(pitch, token, [])])
+
+    def chord(self, time, token):
+        notes = []
+        first = None
+        while not self.accept(">"):
+            note_token = self.expect("WORD")
+            (pitch, position) = self.pitch(note_token)
+            if first is None:
+                first = position
+            notes.append((pitch, note_token, self.post_events()))
+        if first is not None and self.relative is not None:
+            self.relative = first  # the next note is relative to the chord's first
+        self.last_chord = [(pitch, note_token) for (pitch, note_token, events) in notes]
+        return self.sound(time, notes)
+
+    def sound(self, time, notes):
+        # notes: (pitch, token, post events) sounding together for the
+        # duration and with the post events that follow
+        (text, length) = self.duration() or self.default_duration
+        length *= self.scale
+        events = self.post_events()
+        tied = ("tie",) in events
+        for (pitch, token, note_events) in notes:
+            self.record(time, "note", pitch, text, length, token.column, token.lineno)
+            for event in note_events + ([("tie",)] if tied else []):
+                self.record(time, *event)
+        for event in events:
+            if event != ("tie",):
+                self.record(time, *event)
+        return time + length
+
+    def relative_music(self, time):
+        saved = (self.relative, self.absolute_octave)
+        token = self.peek()
+        if token.type == "WORD" and token.value in self.names:
+            self.next()
+            self.relative = None
+            self.absolute_octave = -1
+            (pitch, position) = self.pitch(token)
+            self.relative = position
+        else:
+            self.relative = (-1, 3)  # f, which leaves the first note where it's written
+        try:
+            return self.music(time)
+        finally:
+            (self.relative, self.absolute_octave) = saved
+
+    def fixed_music(self, time):
+        saved = (self.relative, self.absolute_octave)
+        self.relative = None
+        self.absolute_octave = -1
+        (pitch, (octave, step)) = self.pitch(self.expect("WORD"))
+        self.absolute_octave = octave
+        try:
+            return self.music(time)
+        finally:
+            (self.relative, self.absolute_octave) = saved
+
+    def transpose_music(self, time):
+        saved = (self.relative, self.absolute_octave, self.transposition)
+        self.relative = None
+        self.absolute_octave = -1
+        self.transposition = 0
+        (source, position) = self.pitch(self.expect("WORD"))
+        (target, position) = self.pitch(self.expect("WORD"))
+        (self.relative, self.absolute_octave) = saved[:2]
+        self.transposition = saved[2] + target - source
+        try:
+            return self.music(time)
+        finally:
+            self.transposition = saved[2]
+
+    def context_music(self, time):
+        context = self.expect("WORD").value
+        name = None
+        if self.accept("="):
+            name = self.next().value
+        if self.peek_type() == "COMMAND" and self.peek().value == "with":
+            self.next()
+            if self.peek_type() == "{":
+                self.skip_balanced()
+            else:
+                self.next()
+        if context in _text_contexts:
+            return self.text_music(time)
+        if context not in _staff_contexts:
+            return self.music(time)
+        saved = self.staff
+        self.staff = self.new_staff(name)
+        try:
+            return self.music(time)
+        finally:
+            self.staff = saved
+
+    def scaled(self, time, factor):
+        saved = self.scale
+        self.scale = saved * factor
+        try:
+            return self.music(time)
+        finally:
+            self.scale = saved
+
+    def times_music(self, time):
+        return self.scaled(time, fractions.Fraction(self.expect("FRACTION").value))
+
+    def tuplet_music(self, time):
+        factor = 1 / fractions.Fraction(self.expect("FRACTION").value)
+        self.duration(default=False)  # the grouping span
+        return self.scaled(time, factor)
+
+    def scaled_music(self, time):
+        return self.scaled(time, fractions.Fraction(self.expect("FRACTION").value))
+
+    def repeated_music(self, time):
+        kind = self.expect("WORD").value
+        count = self.expect("UNSIGNED").value
+        if kind in ("unfold", "percent", "tremolo"):
+            end = self.unfold(time, count)
+        else:
+            end = self.music(time)
+        if self.peek_type() == "COMMAND" and self.peek().value == "alternative":
+            self.next()
+            self.expect("{")
+            while self.peek_type() != "}":
+                end = self.music(end)
+            self.next()
+        return end
+
+    def unfold_music(self, time):
+        # \unfold n music, the same as \repeat unfold n music
+        return self.unfold(time, self.expect("UNSIGNED").value)
+
+    def unfold(self, time, count):
+        # the music, then count - 1 copies of what it recorded, one after another
+        first = len(self.records)
+        end = self.music(time)
+        body = self.records[first:]
+        for i in range(1, count):
+            for (staff, when, sequence, what, fields) in body:
+                self.records.append([staff, when + i * (end - time), len(self.records),
+                                     what, fields])
+        return time + count * (end - time)
+
+    def grace_music(self, time):
+        self.discard += 1
+        try:
+            self.music(time)
+        finally:
+            self.discard -= 1
+        return time
+
+    def after_grace_music(self, time):
+        time = self.music(time)
+        return self.grace_music(time)
+
+    def skip_music(self, time):
+        (text, length) = self.duration() or self.default_duration
+        return time + length * self.scale
+
+    def text_music(self, time):
+        # lyrics, chord names and figures: skip to the end of their block
+        while self.peek_type() not in ("{", "DOUBLE_ANGLE_OPEN"):
+            self.next()
+        self.skip_balanced()
+        return time
+
+    def note_mode(self, time):
+        return self.music(time)
+
+    def tempo(self, time):
+        if self.peek_type() in ("STRING", "MARKUP", "SCHEME"):
+            self.next()
+        duration = self.duration(default=False)
+        if duration is not None:
+            self.expect("=")
+            count = self.expect("UNSIGNED").value
+            if self.accept("-"):
+                self.expect("UNSIGNED")  # a range: the lower bound is used
+            self.record(time, "tempo", count / duration[1])
+        return time
+
+    def time_signature(self, time):
+        while self.peek_type() == "SCHEME":
+            self.next()
+        self.next()
+        return time
+
+    def key(self, time):
+        if self.peek_type() == "WORD":
+            self.next()
+            while self.peek_type() in ("'", ",", "!", "?"):
+                self.next()
+        self.next()  # \major, \minor, \default, ...
+        return time
+
+    def partial(self, time):
+        self.duration(default=False)
+        return time
+
+    def property_setting(self, time):
+        # \set, \override and the rest: a property path, maybe a value
+        command = self.tokens[self.pos - 1].value
+        self.skip_path()
+        while self.peek_type() == "SCHEME" and command in ("override", "revert"):
+            self.next()
+        if command in ("set", "override"):
+            self.expect("=")
+            self.skip_value()
+        return time
+
+    def tweak(self, time):
+        if self.peek_type() == "WORD":
+            self.skip_path()
+        else:
+            self.next()
+        self.skip_value()
+        return time
+
+    def language(self, time):
+        token = self.expect("STRING")
+        if token.value not in note_names:
+            self.error("unsupported note name language {0!r}".format(token.value), token)
+        self.names = note_names[token.value]
+        return time
+
+
+def format_line(time, kind, fields):
+    """An event-listener .notes line."""
+    if kind == "note":
+        (pitch, text, length, column, line) = fields
+        return "{0:.8f}\tnote\t{1}\t{2}\t{3:.8f}\tpoint-and-click {4} {5}".format(
+            float(time), pitch, text, float(length), column, line)
+    if kind == "rest":
+        (text, length) = fields
+        return "{0:.8f}\trest\t{1}\t{2:.8f}".format(float(time), text, float(length))
+    if kind == "tempo":
+        return "{0:.8f}\ttempo\t{1:.8f}".format(float(time), float(fields[0]))
+    return "\t".join(["{0:.8f}".format(float(time)), kind] + [str(f) for f in fields])
+
+
+def parse_ly(path, include_path=(), disk=None):
+    """
+    The event-listener lines of each staff of the .ly file at path (see
+    ScoreParser.parse). Included files are looked for along include_path
+    too, and tokens are cached in disk, a csound.DiskCache, if given.
+    """
+    return ScoreParser(include_path, disk).parse_file(path)
+
+
+def write_notes(staves, score, directory="."):
+    """Write each staff's lines to <score>-<staff>.notes, as event-listener.ly would."""
+    paths = []
+    for (staff, lines) in staves.items():
+        path = os.path.join(directory, "{0}-{1}.notes".format(score, staff))
+        with open(path, "w") as f:
+            for line in lines:
+                f.write(line + "\n")
+        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Write the .notes files lilypond's event-listener would for a score.")
+    parser.add_argument("score", nargs="?", help="the .ly file")
+    parser.add_argument("directory", nargs="?", default=".", help="where to write them")
+    parser.add_argument("-I", "--include", action="append", default=[], metavar="DIRECTORY",
+                        help="look for included files here too")
+    parser.add_argument("--cache", nargs="?", const=".lpcspy-cache", metavar="DIRECTORY",
+                        help="keep tokens of the files read in DIRECTORY "
+                        "(default: .lpcspy-cache)")
+    parser.add_argument("--write-tables", action="store_true",
+                        help="write the lexer's precomputed tables (see make_lexer) and exit")
+    options = parser.parse_args(argv)
+    if options.write_tables:
+        print(write_tables())
+        return
+    if options.score is None:
+        parser.error("a score is needed")
+    disk = None
+    if options.cache:
+        import csound as cs
+        disk = cs.DiskCache(options.cache)
+    try:
+        staves = parse_ly(options.score, options.include, disk)
+    except (ValueError, IOError, OSError) as e:
+        parser.exit(1, "{0}: {1}\n".format(options.score, e))
+    score = os.path.splitext(os.path.basename(options.score))[0]
+    for path in write_notes(staves, score, options.directory):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
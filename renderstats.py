@@ -0,0 +1,268 @@
+from __future__ import print_function
+import csound as cs
+import lilypond
+import collections
+import json
+import sys
+import time
+
+
+# Opt-in instrumentation of the render pipeline. enable() wraps the hot
+# functions of csound.py and lilypond.py with counting, timing versions
+# and disable() puts the originals back, so there is no cost at all while
+# it is off:
+#
+#     import renderstats
+#     renderstats.enable()          # report to stderr after each emit()
+#     song.emit()
+#     renderstats.disable()
+#
+# Operations (times are inclusive, so "add" contains "add computed"):
+#   add, slice          Dynamics.add/slice calls (slice_many counts each
+#                       slice), cache hits included
+#   add computed,       the merges and slices actually computed, i.e.
+#   slice computed      cache misses
+#   event               Instrument.event: building one event's parameters
+#   event batch         Instrument.events_many: building a batch of them,
+#                       counted in events (Instruments with per-note hooks
+#                       call event for each)
+#   format              formatting events as "i" statements
+#   render              generating a Track's statements (everything but
+#                       writing them), counted in events
+#   process_staff,      lilypond parsing
+#   stream_staff
+# Each is also broken down by the Section and Track being rendered, and the
+# size (in breakpoints) of every envelope sliced or added is histogrammed.
+# Only work done in this process is seen: Tracks rendered in worker
+# processes (emit(processes=...)) are not counted.
+
+
+def envelope_size(dynamics):
+    if isinstance(dynamics, cs.ArrayDynamics):
+        return len(dynamics.levels)
+    return len(dynamics.envelope)
+
+
+class RenderStats(object):
+    """
+    RenderStats accumulate the counts and cumulative times of the
+    instrumented operations, in total and per (Section, Track) scope, and a
+    histogram of envelope sizes.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.operations = collections.OrderedDict()  # name -> [count, seconds]
+        self.scopes = collections.OrderedDict()  # (section, track) -> operations
+        self.envelope_sizes = collections.Counter()
+        self.scope = None
+        self._job_sections = {}
+
+    def record(self, name, seconds, count=1):
+        totals = self.operations.get(name)
+        if totals is None:
+            totals = self.operations[name] = [0, 0.]
+        totals[0] += count
+        totals[1] += seconds
+        if self.scope is not None:
+            operations = self.scopes.get(self.scope)
+            if operations is None:
+                operations = self.scopes[self.scope] = collections.OrderedDict()
+            totals = operations.get(name)
+            if totals is None:
+                totals = operations[name] = [0, 0.]
+            totals[0] += count
+            totals[1] += seconds
+
+    def record_sizes(self, *envelopes):
+        for dynamics in envelopes:
+            self.envelope_sizes[envelope_size(dynamics)] += 1
+
+    def as_dict(self):
+        def operations(ops):
+            return collections.OrderedDict(
+                [(name, {"count": count, "seconds": seconds})
+                 for (name, (count, seconds)) in ops.items()])
+        return collections.OrderedDict([
+            ("operations", operations(self.operations)),
+            ("scopes", [collections.OrderedDict([("section", section), ("track", track),
+                                                 ("operations", operations(ops))])
+                        for ((section, track), ops) in self.scopes.items()]),
+            ("envelope_sizes", collections.OrderedDict(
+                [(str(size), n) for (size, n) in sorted(self.envelope_sizes.items())])),
+        ])
+
+    def report_json(self, out=None):
+        out = out or sys.stderr
+        json.dump(self.as_dict(), out, indent=2)
+        out.write("\n")
+
+    def report_text(self, out=None):
+        out = out or sys.stderr
+        print(";; render statistics", file=out)
+        print("{0:<16} {1:>10} {2:>12} {3:>12}".format(
+            "operation", "count", "total s", "mean us"), file=out)
+        for (name, (count, seconds)) in self.operations.items():
+            mean = 1e6 * seconds / count if count else 0.
+            print("{0:<16} {1:>10} {2:>12.6f} {3:>12.2f}".format(name, count, seconds, mean),
+                  file=out)
+
+        if self.scopes:
+            names = [name for name in self.operations
+                     if any([name in ops for ops in self.scopes.values()])]
+            print("\nby track (count/seconds)", file=out)
+            print("{0:<32} {1}".format("section / track",
+                                       " ".join(["{0:>18}".format(n) for n in names])), file=out)
+            for ((section, track), ops) in self.scopes.items():
+                cells = []
+                for name in names:
+                    (count, seconds) = ops.get(name, (0, 0.))
+                    cells.append("{0:>18}".format("{0}/{1:.4f}".format(count, seconds)))
+                label = "{0} / {1}".format(section, track)
+                print("{0:<32} {1}".format(label[:32], " ".join(cells)), file=out)
+
+        if self.envelope_sizes:
+            print("\nenvelope sizes (breakpoints: envelopes sliced or added)", file=out)
+            for (size, n) in sorted(self.envelope_sizes.items()):
+                print("{0:>8}: {1}".format(size, n), file=out)
+
+    def report(self, style="text", out=None):
+        if style == "json":
+            self.report_json(out)
+        else:
+            self.report_text(out)
+
+
+_stats = None
+_originals = []  # (owner, attribute, original) to put back on disable()
+
+
+def current():
+    """The RenderStats being collected, or None when disabled."""
+    return _stats
+
+
+def _patch(owner, attribute, make_wrapper):
+    original = owner.__dict__[attribute]
+    _originals.append((owner, attribute, original))
+    if isinstance(original, classmethod):
+        setattr(owner, attribute, classmethod(make_wrapper(original.__func__)))
+    else:
+        setattr(owner, attribute, make_wrapper(original))
+
+
+def _timed(stats, name, count=None, sizes=False):
+    """A wrapper maker: time each call as one (or count(args)) name."""
+    def make_wrapper(function):
+        def wrapper(*args, **kwargs):
+            if sizes:
+                stats.record_sizes(*[a for a in args if isinstance(a, cs.Dynamics)])
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.record(name, time.perf_counter() - start,
+                             1 if count is None else count(args))
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return make_wrapper
+
+
+def _scoped_iter_plan(stats):
+    # remember which Section each RenderJob came from
+    def make_wrapper(iter_plan):
+        def wrapper(self, *args, **kwargs):
+            for item in iter_plan(self, *args, **kwargs):
+                if isinstance(item, cs.RenderJob):
+                    stats._job_sections[id(item)] = self.name
+                yield item
+        return wrapper
+    return make_wrapper
+
+
+_end = object()
+
+
+def _scoped_render(stats):
+    # run a Track's statement generator inside its scope, timing each step
+    def make_wrapper(iter_statements):
+        def wrapper(job):
+            scope = (stats._job_sections.get(id(job), "-"), job.track.name)
+            statements = iter_statements(job)
+            while True:
+                previous = stats.scope
+                stats.scope = scope
+                start = time.perf_counter()
+                try:
+                    statement = next(statements, _end)
+                    stats.record("render", time.perf_counter() - start,
+                                 1 if isinstance(statement, cs.ScoreEvent) else 0)
+                finally:
+                    stats.scope = previous
+                if statement is _end:
+                    return
+                yield statement
+        return wrapper
+    return make_wrapper
+
+
+def _reporting(stats, style, out):
+    def make_wrapper(emit):
+        def wrapper(*args, **kwargs):
+            try:
+                return emit(*args, **kwargs)
+            finally:
+                stats.report(style, out)
+        wrapper.__name__ = emit.__name__
+        wrapper.__doc__ = emit.__doc__
+        return wrapper
+    return make_wrapper
+
+
+def enable(report="text", out=None):
+    """
+    Start collecting RenderStats (see above) and return them. With report
+    set ("text" or "json"), they are reported to out (default stderr) at
+    the end of each Song.emit and Section.emit; with None, call report()
+    yourself.
+    """
+    global _stats
+    if _stats is not None:
+        disable()
+    stats = _stats = RenderStats()
+
+    def slices(args):
+        return len(args[1])
+
+    _patch(cs.Dynamics, "add", _timed(stats, "add"))
+    _patch(cs.Dynamics, "_add", _timed(stats, "add computed", sizes=True))
+    _patch(cs.ArrayDynamics, "_add", _timed(stats, "add computed", sizes=True))
+    _patch(cs.Dynamics, "slice", _timed(stats, "slice"))
+    _patch(cs.ArrayDynamics, "slice_many", _timed(stats, "slice", slices))
+    _patch(cs.Dynamics, "_slice", _timed(stats, "slice computed", sizes=True))
+    _patch(cs.ArrayDynamics, "_slice_many", _timed(stats, "slice computed", slices))
+    _patch(cs.Instrument, "event", _timed(stats, "event"))
+    _patch(cs.Instrument, "events_many", _timed(stats, "event batch", slices))
+    _patch(cs, "format_events", _timed(stats, "format", lambda args: len(args[0])))
+    _patch(lilypond, "process_staff", _timed(stats, "process_staff"))
+    _patch(lilypond, "stream_staff", _timed(stats, "stream_staff"))
+    _patch(cs.Section, "iter_plan", _scoped_iter_plan(stats))
+    _patch(cs.RenderJob, "iter_statements", _scoped_render(stats))
+    if report:
+        _patch(cs.Song, "emit", _reporting(stats, report, out))
+        _patch(cs.Section, "emit", _reporting(stats, report, out))
+    return stats
+
+
+def disable():
+    """Stop collecting, putting the original functions back. Returns the stats."""
+    global _stats
+    while _originals:
+        (owner, attribute, original) = _originals.pop()
+        setattr(owner, attribute, original)
+    stats = _stats
+    _stats = None
+    return stats
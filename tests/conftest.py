@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+# the modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import csound as cs
+
+
+@pytest.fixture(autouse=True)
+def default_settings():
+    # every test starts (and leaves things) with the default time mode and
+    # Dynamics backend
+    cs.set_time_mode("decimal")
+    cs.set_dynamics_backend("list")
+    yield
+    cs.set_time_mode("decimal")
+    cs.set_dynamics_backend("list")
+
+
+def list_dynamics(envelope, absolute=False):
+    """A list-backend Dynamics, whichever backend is selected."""
+    dynamics = object.__new__(cs.Dynamics)
+    dynamics.__init__(envelope, absolute)
+    return dynamics
@@ -0,0 +1,55 @@
+import io
+
+import binscore
+import csound as cs
+
+from test_render import emitted, small_song
+
+
+def binary(emitter, *args, **kwargs):
+    stream = io.BytesIO()
+    with binscore.BinaryScoreWriter(stream) as out:
+        emitter(*args, out=out, **kwargs)
+    return binscore.BinaryScore(stream.getvalue())
+
+
+def text_of(score):
+    out = cs.BufferWriter()
+    score.write_text(out)
+    return out.getvalue()
+
+
+def event_count(score):
+    return sum(block.count for block in score if isinstance(block, binscore.EventBlock))
+
+
+def test_emit_many_writes_event_blocks():
+    song = small_song()
+    section = song.sections[0]
+    track = section.parts[0]
+    notes = track.compile(section.start, section.dynamics).notes
+    columns = notes._batch(0, len(notes))
+    score = binary(track.instr.emit_many, *columns)
+    assert not [block for block in score if not isinstance(block, binscore.EventBlock)]
+    assert event_count(score) == len(notes)
+    assert text_of(score) == emitted(track.instr.emit_many, *columns)
+
+
+def test_song_round_trip():
+    song = small_song()
+    text = emitted(song.emit)
+    score = binary(song.emit)
+    assert event_count(score) == text.count("\ni ")
+    assert text_of(score) == text
+
+
+def test_cached_round_trip(tmp_path):
+    song = small_song()
+    text = emitted(song.emit)
+    cache = cs.DiskCache(str(tmp_path))
+    for i in range(2):
+        score = binary(song.emit, cache=cache)
+        assert event_count(score) == text.count("\ni ")
+        assert text_of(score) == text
+    score = binary(song.emit, processes=2)
+    assert event_count(score) == text.count("\ni ")
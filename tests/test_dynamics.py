@@ -0,0 +1,69 @@
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+import csound as cs
+from conftest import list_dynamics
+
+numpy = pytest.importorskip("numpy")
+
+reductions = ("average", "peak", "min", "rms", ("sampled", 9))
+
+
+def reduced(dynamics):
+    values = []
+    for reduction in reductions:
+        value = type(dynamics)._reduce_many([dynamics], reduction)[0]
+        values.extend(value if isinstance(value, tuple) else (value,))
+    return values
+
+
+def assert_close(a, b):
+    assert len(a) == len(b)
+    for (x, y) in zip(a, b):
+        assert abs(x - y) <= cs.ArrayDynamics.tolerance, (a, b)
+
+
+def step_envelope(rng):
+    # one, two or four unit segments among zero-length ones (steps), so
+    # every breakpoint time is exact whatever the representation
+    lengths = [1] * rng.choice([1, 2, 4]) + [0] * rng.randint(1, 3)
+    rng.shuffle(lengths)
+    levels = [0.0, 0.2, 0.3, 0.5, 0.8, 1.0]
+    return [(rng.choice(levels), length) for length in lengths] + [(rng.choice(levels), 0)]
+
+
+def test_slice_ending_on_a_step():
+    envelope = [(0.2, 1), (0.8, 0), (0.3, 1), (0.3, 0)]
+    expected = list_dynamics(envelope)._slice(0, 0.5).average_level()
+    assert expected == pytest.approx(0.5)
+    assert cs.ArrayDynamics(envelope)._slice(0, 0.5).average_level() == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("mode", ["decimal", "fraction"])
+def test_backends_agree_on_step_envelopes(mode):
+    cs.set_time_mode(mode)
+    rng = random.Random(1)
+    for trial in range(500):
+        envelope = step_envelope(rng)
+        addend = step_envelope(rng)
+        start = rng.randint(0, 8) / 8.
+        duration = rng.randint(0, 8) / 8.
+        listed = list_dynamics(envelope, True)
+        arrayed = cs.ArrayDynamics(envelope, True)
+        assert_close(reduced(listed._slice(start, duration)),
+                     reduced(arrayed._slice(start, duration)))
+        assert_close(reduced(cs.Dynamics.sum(listed, list_dynamics(addend))),
+                     reduced(cs.ArrayDynamics.sum(arrayed, cs.ArrayDynamics(addend))))
+
+
+def test_numpy_is_imported_when_needed():
+    code = ("import sys, csound, lilypond, binscore; print('numpy' in sys.modules); "
+            "csound.set_dynamics_backend('numpy'); print('numpy' in sys.modules)")
+    output = subprocess.check_output(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert output.split() == [b"False", b"True"]
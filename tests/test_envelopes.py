@@ -0,0 +1,133 @@
+import decimal as dec
+import fractions
+
+import pytest
+
+import csound as cs
+from conftest import list_dynamics
+
+# envelopes written as (level, length) pairs, the lengths a fraction of the
+# whole; a zero length is a step (or the final point)
+ramp_up_down = [(0.0, 1), (1.0, 1), (0.5, 0)]
+step_down = [(0.2, 1), (0.8, 0), (0.4, 1), (0.6, 0)]
+
+
+def assert_envelope(dynamics, expected):
+    assert [float(dp.duration) for dp in dynamics.envelope] == \
+        pytest.approx([length for (level, length) in expected])
+    assert [dp.level for dp in dynamics.envelope] == \
+        pytest.approx([level for (level, length) in expected])
+
+
+@pytest.mark.parametrize("mode", ["decimal", "fraction", "ticks"])
+@pytest.mark.parametrize("envelope, start, duration, expected", [
+    (ramp_up_down, 0.25, 0.5, [(0.5, 0.5), (1.0, 0.5), (0.75, 0)]),
+    (ramp_up_down, 0.5, 0, [(1.0, 1), (1.0, 0)]),
+    # past the end, the slice stops at the envelope's end
+    (ramp_up_down, 0.9, 0.5, [(0.6, 1), (0.5, 0)]),
+    (step_down, 0.25, 0.5, [(0.5, 0.5), (0.8, 0), (0.4, 0.5), (0.5, 0)]),
+    (step_down, 0, 0.5, [(0.2, 1), (0.8, 0)]),
+    # a time on the step has the level before it
+    (step_down, 0.5, 0.5, [(0.8, 0), (0.8, 0), (0.4, 1), (0.6, 0)]),
+    (step_down, 0.5, 0, [(0.8, 1), (0.8, 0)]),
+])
+def test_slice(mode, envelope, start, duration, expected):
+    cs.set_time_mode(mode)
+    assert_envelope(list_dynamics(envelope, True).slice(start, duration), expected)
+
+
+@pytest.mark.parametrize("mode, ratio", [("decimal", dec.Decimal),
+                                         ("fraction", fractions.Fraction)])
+def test_slice_of_mixed_lengths(mode, ratio):
+    cs.set_time_mode(mode)
+    mixed = list_dynamics([(0.0, dec.Decimal(1)), (1.0, 1.0), (0.5, fractions.Fraction(0))], True)
+    assert_envelope(mixed, [(0.0, 0.5), (1.0, 0.5), (0.5, 0)])
+    sliced = mixed.slice(dec.Decimal("0.25"), 0.5)
+    assert_envelope(sliced, [(0.5, 0.5), (1.0, 0.5), (0.75, 0)])
+    assert all(isinstance(dp.duration, ratio) for dp in mixed.envelope + sliced.envelope)
+
+
+flat = lambda level: [(level, 1), (level, 0)]
+
+
+@pytest.mark.parametrize("mode", ["decimal", "fraction"])
+@pytest.mark.parametrize("envelope, addend, expected", [
+    (ramp_up_down, flat(0.3), [(0.3, 0.5), (1.0, 0.5), (0.8, 0)]),
+    # breakpoints at thirds, which Decimal doesn't hold exactly
+    (ramp_up_down, [(0.1, 1), (0.4, 2), (0.1, 0)],
+     [(0.1, 1 / 3.), (1.0, 1 / 6.), (1.0, 0.5), (0.6, 0)]),
+    # the step is kept, each side summed with the addend
+    (step_down, [(-0.2, 3), (0.2, 1), (0.0, 0)],
+     [(0.0, 0.5), (0.8 + 0.2 / 3, 0), (0.4 + 0.2 / 3, 0.25), (0.7, 0.25), (0.6, 0)]),
+])
+def test_add(mode, envelope, addend, expected):
+    cs.set_time_mode(mode)
+    added = list_dynamics(envelope, True).add(list_dynamics(addend))
+    assert added.absolute
+    assert_envelope(added, expected)
+
+
+def test_add_relative_to_relative():
+    added = list_dynamics(flat(0.3)).add(list_dynamics(flat(0.3)))
+    assert not added.absolute
+    assert_envelope(added, [(0.6, 1), (0.6, 0)])
+    with pytest.raises(ValueError):
+        list_dynamics(flat(0.3), True).add(list_dynamics(flat(0.3), True))
+
+
+def test_sum_clamps_once():
+    envelope = list_dynamics(ramp_up_down, True)
+    (up, down) = (list_dynamics(flat(0.5)), list_dynamics(flat(-0.5)))
+    assert_envelope(cs.Dynamics.sum(envelope, up, down), [(0.0, 0.5), (1.0, 0.5), (0.5, 0)])
+    # where adding pairwise clamps the peak before taking the 0.5 off again
+    assert_envelope(envelope.add(up).add(down), [(0.0, 0.5), (0.5, 0.5), (0.5, 0)])
+    assert_envelope(cs.Dynamics.sum(list_dynamics(step_down, True), list_dynamics(flat(0.5)),
+                                    list_dynamics([(-0.2, 3), (0.2, 1), (0.0, 0)])),
+                    [(0.5, 0.5), (1.0, 0), (0.4 + 0.5 + 0.2 / 3, 0.25), (1.0, 0.25), (1.0, 0)])
+
+
+def test_backends_keep_the_same_steps():
+    pytest.importorskip("numpy")
+    ramp = [(-0.2, 3), (0.2, 1), (0.0, 0)]
+    listed = list_dynamics(step_down, True).add(list_dynamics(ramp))
+    arrayed = cs.ArrayDynamics(step_down, True).add(cs.ArrayDynamics(ramp))
+    assert arrayed.times.tolist() == pytest.approx([float(t) for t in listed.breakpoint_times()])
+    assert arrayed.levels.tolist() == pytest.approx([dp.level for dp in listed.envelope])
+
+
+@pytest.mark.parametrize("reduction, points, expected", [
+    ("average", None, [0.625, 0.5]),
+    ("peak", None, [1.0, 0.8]),
+    ("min", None, [0.0, 0.2]),
+    ("rms", None, [(2.75 / 6) ** 0.5, (1.6 / 6) ** 0.5]),
+    # the step's time has the level before it
+    ("sampled", 5, [(0.0, 0.5, 1.0, 0.75, 0.5), (0.2, 0.5, 0.8, 0.5, 0.6)]),
+    ("sampled", 1, [(0.0,), (0.2,)]),
+])
+def test_reduce_dynamics(reduction, points, expected):
+    envelopes = [list_dynamics(ramp_up_down, True), list_dynamics(step_down, True)]
+    reduced = cs.reduce_dynamics(envelopes, reduction, points)
+    assert len(reduced) == len(expected)
+    for (value, expected_value) in zip(reduced, expected):
+        assert value == pytest.approx(expected_value)
+    # each envelope's reduction is cached and the single-envelope methods agree
+    if reduction == "sampled":
+        assert [e.sampled_levels(points) for e in envelopes] == reduced
+    else:
+        assert [getattr(e, reduction + "_level")() for e in envelopes] == reduced
+
+
+def test_reduce_dynamics_of_both_backends():
+    pytest.importorskip("numpy")
+    envelopes = [list_dynamics(ramp_up_down, True), cs.ArrayDynamics(step_down, True),
+                 list_dynamics(step_down, True)]
+    assert cs.reduce_dynamics(envelopes, "rms") == \
+        pytest.approx([(2.75 / 6) ** 0.5, (1.6 / 6) ** 0.5, (1.6 / 6) ** 0.5])
+
+
+def test_reduce_dynamics_rejects_bad_reductions():
+    envelopes = [list_dynamics(ramp_up_down, True)]
+    with pytest.raises(ValueError):
+        cs.reduce_dynamics(envelopes, "median")
+    with pytest.raises(ValueError):
+        cs.reduce_dynamics(envelopes, "sampled")
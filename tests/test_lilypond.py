@@ -0,0 +1,147 @@
+import os
+
+import pytest
+
+import bench
+import csound as cs
+import lilypond
+
+from test_render import emitted
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def staff_song(section_start=0):
+    text, note_count = bench.make_notes_fixture(notes=200, seed=2)
+    section = lilypond.process_staff(text.splitlines(), "staff", cs.Instrument(1))
+    section.start = cs.to_time(section_start)
+    return cs.Song("staff", "nobody", [section])
+
+
+def event_lines(text):
+    return [line for line in text.split("\n") if line.startswith("i ")]
+
+
+def test_window_of_chords_with_absolute_notes():
+    # Chords starting at 0 whose Notes carry the absolute times
+    song = staff_song(section_start=8)
+    track = song.sections[0].parts[0]
+    for chord in track.events:
+        for note in chord.events:
+            note.start = chord.start + note.start
+        chord.start = cs.to_time(0)
+    del track.interval_index
+    full = event_lines(emitted(song.emit))
+    compiled = song.compile()
+    for (start, end) in [(8, 9), (20, 31), (100, 140), (250, 260)]:
+        window = (cs.to_time(start), cs.to_time(end))
+        lines = event_lines(emitted(song.emit, window=window))
+        assert lines
+        assert set(lines) <= set(full)
+        assert lines == event_lines(emitted(compiled.emit, window=window))
+
+
+def test_include_option(tmp_path):
+    pytest.importorskip("ply")
+    text = bench.make_ly_fixture(notes=40, seed=1, staves=2)[0]
+    (tmp_path / "parts").mkdir()
+    (tmp_path / "parts" / "music.ly").write_text(text)
+    score = tmp_path / "score.ly"
+    score.write_text('\\include "music.ly"\n')
+    output = tmp_path / "score.sco"
+    argv = [str(score), "-j", "0", "-o", str(output)]
+    with pytest.raises(SystemExit):
+        lilypond.main(argv)  # music.ly isn't found
+    lilypond.main(argv + ["-I", str(tmp_path / "parts")])
+    lines = event_lines(output.read_text())
+    lilypond.main([str(tmp_path / "parts" / "music.ly"), "-j", "0", "-o", str(output)])
+    assert lines == event_lines(output.read_text())
+    assert lines
+
+
+def test_cached_process_staff(tmp_path):
+    text = bench.make_notes_fixture(notes=200, seed=3)[0]
+    path = tmp_path / "score-staff.notes"
+    path.write_text(text)
+    expected = emitted(lilypond.process_staff(text.splitlines(), "staff", cs.Instrument(1)).emit)
+    cache = cs.DiskCache(str(tmp_path / "cache"))
+    for i in range(2):
+        section = lilypond.cached_process_staff(str(path), "staff", cs.Instrument(1), cache)
+        assert emitted(section.emit) == expected
+
+
+def staff_sources():
+    yield bench.make_notes_fixture(notes=200, seed=4)[0].splitlines()
+    # test.ly's Chords staff ties notes across chords; Bass ends on a rest
+    lexer = pytest.importorskip("lp-lexer")
+    for lines in lexer.parse_ly(os.path.join(here, "test.ly")).values():
+        yield lines
+
+
+@pytest.mark.parametrize("mode", ["decimal", "fraction", "ticks"])
+def test_compact_and_list_staves_render_the_same(mode):
+    cs.set_time_mode(mode)
+    envelope = cs.Dynamics([(0.1, 1), (0.9, 2), (0.3, 0)], True)
+    for lines in staff_sources():
+        renders = []
+        for compact in (False, True):
+            section = lilypond.process_staff(lines, "staff", cs.Instrument(1), compact=compact)
+            section.dynamics = envelope
+            renders.append(emitted(section.emit))
+        assert renders[0] == renders[1]
+        assert len(set(event_lines(renders[0]))) > 1
+
+
+def without_tempo(text):
+    # the text, and its "t" statement (and the blank line after it)
+    blocks = text.split("\n\n")
+    tempo = [block for block in blocks if block.startswith("t ")]
+    assert len(tempo) == 1
+    return ("\n\n".join([block for block in blocks if not block.startswith("t ")]),
+            blocks.index(tempo[0]) - len(blocks), tempo[0])
+
+
+def test_stream_staff_matches_process_staff():
+    for lines in staff_sources():
+        expected = emitted(lilypond.process_staff(lines, "staff", cs.Instrument(1)).emit)
+        streamed = cs.BufferWriter()
+        lilypond.stream_staff(lines, "staff", cs.Instrument(1), streamed)
+        (text, position, tempo) = without_tempo(streamed.getvalue())
+        (expected_text, _, expected_tempo) = without_tempo(expected)
+        assert text == expected_text
+        assert tempo == expected_tempo
+        # streamed, "t" comes last, just before the closing "s"
+        assert position == -2
+
+
+class CountingWriter(cs.BufferWriter):
+    # notes how much of the staff had been read at the first event
+    def __init__(self, source):
+        super(CountingWriter, self).__init__()
+        self.source = source
+        self.read_at_first_event = None
+
+    def events(self, batch):
+        if self.read_at_first_event is None:
+            self.read_at_first_event = self.source.read
+        super(CountingWriter, self).events(batch)
+
+
+class CountingLines(object):
+    def __init__(self, lines):
+        self.lines = lines
+        self.read = 0
+
+    def __iter__(self):
+        for line in self.lines:
+            self.read += 1
+            yield line
+
+
+def test_stream_staff_writes_as_it_reads():
+    lines = bench.make_notes_fixture(notes=2000, seed=5)[0].splitlines()
+    source = CountingLines(lines)
+    out = CountingWriter(source)
+    lilypond.stream_staff(source, "staff", cs.Instrument(1), out)
+    assert source.read == len(lines)
+    assert out.read_at_first_event < 20
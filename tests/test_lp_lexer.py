@@ -0,0 +1,156 @@
+import fractions
+import os
+
+import pytest
+
+lexer = pytest.importorskip("lp-lexer")
+
+F = fractions.Fraction
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def without_positions(lines):
+    # .notes lines without the point-and-click position of notes
+    return [line.split("\tpoint-and-click")[0] for line in lines]
+
+
+def parsed(text):
+    # the lines of the one staff in text
+    (lines,) = lexer.ScoreParser().parse(text).values()
+    return without_positions(lines)
+
+
+def note(time, pitch, text, length):
+    return "{0:.8f}\tnote\t{1}\t{2}\t{3:.8f}".format(float(time), pitch, text, float(length))
+
+
+def rest(time, text, length):
+    return "{0:.8f}\trest\t{1}\t{2:.8f}".format(float(time), text, float(length))
+
+
+def tie(time):
+    return "{0:.8f}\ttie".format(float(time))
+
+
+def test_dots():
+    assert parsed("{ c'4. d'8 e'2.. f'8 r2. }") == [
+        note(0, 60, "4.", F(3, 8)), note(F(3, 8), 62, "8", F(1, 8)),
+        note(F(1, 2), 64, "2..", F(7, 8)), note(F(11, 8), 65, "8", F(1, 8)),
+        rest(F(3, 2), "2.", F(3, 4))]
+
+
+def test_tuplets():
+    assert parsed("{ \\times 2/3 { c'8 d' e' } \\tuplet 3/2 { f'8 g' a' } c'4 }") == [
+        note(0, 60, "8", F(1, 12)), note(F(1, 12), 62, "8", F(1, 12)),
+        note(F(1, 6), 64, "8", F(1, 12)), note(F(1, 4), 65, "8", F(1, 12)),
+        note(F(1, 3), 67, "8", F(1, 12)), note(F(5, 12), 69, "8", F(1, 12)),
+        note(F(1, 2), 60, "4", F(1, 4))]
+
+
+def test_volta_repeat_with_alternatives():
+    # played once through, then each alternative
+    assert parsed("{ \\repeat volta 2 { c'4 d' } \\alternative { { e'2 } { f'2 } } g'1 }") == [
+        note(0, 60, "4", F(1, 4)), note(F(1, 4), 62, "4", F(1, 4)),
+        note(F(1, 2), 64, "2", F(1, 2)), note(1, 65, "2", F(1, 2)),
+        note(F(3, 2), 67, "1", 1)]
+
+
+@pytest.mark.parametrize("unfold", ["\\repeat unfold 3", "\\unfold 3"])
+def test_unfold(unfold):
+    assert parsed("{ " + unfold + " { c'4 d'8 } e'2 }") == [
+        note(0, 60, "4", F(1, 4)), note(F(1, 4), 62, "8", F(1, 8)),
+        note(F(3, 8), 60, "4", F(1, 4)), note(F(5, 8), 62, "8", F(1, 8)),
+        note(F(3, 4), 60, "4", F(1, 4)), note(1, 62, "8", F(1, 8)),
+        note(F(9, 8), 64, "2", F(1, 2))]
+
+
+def test_repeated_chords():
+    assert parsed("{ <c' e'>4 q8 q r4 }") == [
+        note(0, 60, "4", F(1, 4)), note(0, 64, "4", F(1, 4)),
+        note(F(1, 4), 60, "8", F(1, 8)), note(F(1, 4), 64, "8", F(1, 8)),
+        note(F(3, 8), 60, "8", F(1, 8)), note(F(3, 8), 64, "8", F(1, 8)),
+        rest(F(1, 2), "4", F(1, 4))]
+    with pytest.raises(ValueError):
+        parsed("{ c'4 q }")
+
+
+def test_chord_ties():
+    # a tie after a chord ties each of its notes
+    assert parsed("{ <c' e'>2~ <c' e'>2 <c'~ g'>4 <c' a'> }") == [
+        note(0, 60, "2", F(1, 2)), tie(0), note(0, 64, "2", F(1, 2)), tie(0),
+        note(F(1, 2), 60, "2", F(1, 2)), note(F(1, 2), 64, "2", F(1, 2)),
+        note(1, 60, "4", F(1, 4)), tie(1), note(1, 67, "4", F(1, 4)),
+        note(F(5, 4), 60, "4", F(1, 4)), note(F(5, 4), 69, "4", F(1, 4))]
+
+
+def test_transpose():
+    # only the music inside is transposed, relative music included
+    assert parsed("{ \\transpose c d { c'4 e' } c'4 "
+                  "\\transpose c bes, { \\relative c'' { c4 d } } }") == [
+        note(0, 62, "4", F(1, 4)), note(F(1, 4), 66, "4", F(1, 4)),
+        note(F(1, 2), 60, "4", F(1, 4)),
+        note(F(3, 4), 70, "4", F(1, 4)), note(1, 72, "4", F(1, 4))]
+
+
+def test_relative_octaves():
+    # each note the nearest to the one before (a chord: to its first note)
+    assert parsed("\\relative c' { c4 g' c, f, <c e g> <f a c> b'' c,,, }") == [
+        note(0, 60, "4", F(1, 4)), note(F(1, 4), 67, "4", F(1, 4)),
+        note(F(1, 2), 60, "4", F(1, 4)), note(F(3, 4), 53, "4", F(1, 4)),
+        note(1, 48, "4", F(1, 4)), note(1, 52, "4", F(1, 4)), note(1, 55, "4", F(1, 4)),
+        note(F(5, 4), 53, "4", F(1, 4)), note(F(5, 4), 57, "4", F(1, 4)),
+        note(F(5, 4), 60, "4", F(1, 4)),
+        note(F(3, 2), 83, "4", F(1, 4)), note(F(7, 4), 48, "4", F(1, 4))]
+
+
+def test_staves_and_tempo():
+    staves = lexer.ScoreParser().parse(
+        "\\tempo 4 = 90 << \\new Staff = up { c'2 } \\new Staff = down { c2 c } >>")
+    assert list(staves) == ["up", "down"]
+    tempo = "{0:.8f}\ttempo\t{1:.8f}".format(0, 360)
+    assert without_positions(staves["up"]) == [tempo, note(0, 60, "2", F(1, 2))]
+    assert without_positions(staves["down"]) == [
+        tempo, note(0, 48, "2", F(1, 2)), note(F(1, 2), 48, "2", F(1, 2))]
+
+
+def token_values(text, lp_lexer):
+    return [(token.type, token.value) for token in lexer.tokenize(text, lp_lexer)]
+
+
+def test_lexer_tables(tmp_path, monkeypatch):
+    with open(os.path.join(here, "test.ly")) as f:
+        text = f.read()
+    expected = token_values(text, lexer.make_lexer(optimize=False))
+    read = []  # what make_lexer found in outputdir
+    read_tables = lexer._read_tables
+
+    def spy(path):
+        read.append(read_tables(path))
+        return read[-1]
+    monkeypatch.setattr(lexer, "_read_tables", spy)
+
+    # without tables, the lexer is built from the rules and nothing written
+    (empty, tables, stale) = [tmp_path / name for name in ("empty", "tables", "stale")]
+    for directory in (empty, tables, stale):
+        directory.mkdir()
+    files = sorted(os.listdir(here))
+    assert token_values(text, lexer.make_lexer(outputdir=str(empty))) == expected
+    assert read == [None]
+    assert os.listdir(str(empty)) == [] and sorted(os.listdir(here)) == files
+
+    path = lexer.write_tables(str(tables))
+    assert path == lexer.tables_path(str(tables))
+    del read[:]
+    assert token_values(text, lexer.make_lexer(outputdir=str(tables))) == expected
+    assert [module.__file__ for module in read] == [path]
+
+    # tables from another ply version are left alone
+    stale_path = lexer.tables_path(str(stale))
+    with open(stale_path, "w") as f:
+        f.write("_tabversion = '0.0'\n")
+    del read[:]
+    assert token_values(text, lexer.make_lexer(outputdir=str(stale))) == expected
+    assert read == [None]
+    with open(stale_path) as f:
+        assert f.read() == "_tabversion = '0.0'\n"
@@ -0,0 +1,184 @@
+import pytest
+
+import bench
+import csound as cs
+
+
+def small_song(seed=3):
+    song, note_count = bench.make_song(sections=2, tracks=3, gestures=4, notes=8,
+                                       breakpoints=5, seed=seed)
+    return song
+
+
+def emitted(emitter, *args, **kwargs):
+    out = cs.BufferWriter()
+    emitter(*args, out=out, **kwargs)
+    return out.getvalue()
+
+
+def written(statements):
+    out = cs.BufferWriter()
+    cs.write_statements(statements, out)
+    return out.getvalue()
+
+
+def test_track_emit_writes_its_statements():
+    song = small_song()
+    for section in song.sections:
+        for track in section.parts:
+            text = written(track.iter_statements(section.start, section.dynamics))
+            assert text.count("\ni ") > 0
+            assert emitted(track.emit, section.start, section.dynamics) == text
+            compiled = track.compile(section.start, section.dynamics)
+            assert emitted(compiled.emit, section.start, section.dynamics) == text
+
+
+def test_compiled_song_renders_the_same():
+    song = small_song()
+    assert emitted(song.compile().emit) == emitted(song.emit)
+
+
+class CommentedInstrument(cs.Instrument):
+    # overrides emit() alone, writing a comment line before each note
+    def emit(self, start, duration, dynamics, articulation, pitch, portamento,
+             other_parameters=[], out=None):
+        out = cs.score_writer(out)
+        out.writeline("; CUSTOM {0}".format(pitch))
+        return super(CommentedInstrument, self).emit(start, duration, dynamics, articulation,
+                                                     pitch, portamento, other_parameters, out)
+
+
+def test_emit_override_is_honored():
+    song = small_song()
+    plain = emitted(song.emit)
+    for section in song.sections:
+        for track in section.parts:
+            track.instr = CommentedInstrument(track.instr.i_number)
+    text = emitted(song.emit)
+    assert text.count("; CUSTOM ") == plain.count("\ni ") > 0
+    # without the comments it is the same score
+    lines = [line for line in text.split("\n") if not line.startswith("; CUSTOM ")]
+    assert "\n".join(lines) == plain
+    assert written(song.iter_statements()) == text
+    assert emitted(song.compile().emit) == text
+
+
+class BatchCountingWriter(cs.BufferWriter):
+    def __init__(self):
+        super(BatchCountingWriter, self).__init__()
+        self.batches = []
+
+    def events(self, batch):
+        self.batches.append(len(batch))
+        super(BatchCountingWriter, self).events(batch)
+
+
+def test_emit_many_writes_one_batch():
+    song = small_song()
+    section = song.sections[0]
+    track = section.parts[0]
+    notes = track.compile(section.start, section.dynamics).notes
+    out = BatchCountingWriter()
+    track.instr.emit_many(*notes._batch(0, len(notes)), out=out)
+    assert out.batches == [len(notes)]
+    assert out.getvalue() == written(notes.iter_events(track.instr))
+
+
+def test_parallel_and_cached_renders_are_the_same(tmp_path):
+    song = small_song()
+    text = emitted(song.emit)
+    assert emitted(song.emit, processes=2) == text
+    cache = cs.DiskCache(str(tmp_path))
+    assert emitted(song.emit, cache=cache) == text  # rendered and stored
+    assert emitted(song.emit, cache=cache) == text  # all loaded
+    assert emitted(song.emit, processes=2, cache=cache) == text
+
+
+def test_interned_dynamics_follow_the_time_mode():
+    # Decimal(0.5) == Fraction(1, 2): a Dynamics interned in one mode
+    # mustn't stand in for an equal one made in another
+    kept = cs.Dynamics([(0.2, 0.5), (0.8, 0.5)], True).intern()
+    cs.set_time_mode("fraction")
+    dynamics = cs.Dynamics([(0.2, 0.5), (0.8, 0.5)], True)
+    assert dynamics.intern() is dynamics
+    assert dynamics.intern() is not kept
+    cs.Dynamics.sum(dynamics.intern(), cs.Dynamics([(0.1, 1.0), (0.3, 0.0)]))
+
+
+def test_disk_cache_store(tmp_path):
+    cache = cs.DiskCache(str(tmp_path / "cache"))
+    key = cs.cache_key("test", 1)
+    assert cache.load(key) is None
+    cache.store(key, [1, "two"])
+    cache.store(key, [3, "four"])  # replaces it in place
+    assert cache.load(key) == [3, "four"]
+    # nothing but the entry is left behind
+    assert [path.name for path in (tmp_path / "cache").rglob("*") if path.is_file()] == [key]
+    cache.clear()
+    assert cache.load(key) is None
+
+
+def rendered_fields(text):
+    # every "i" statement's fields, levels and other floats as floats
+    events = []
+    for line in text.split("\n"):
+        if line.startswith("i "):
+            events.append([float(field) if "." in field else field
+                           for field in line.split()])
+    return events
+
+
+@pytest.mark.parametrize("backend", ["list", "numpy"])
+def test_time_modes_render_the_same(backend):
+    if backend == "numpy":
+        pytest.importorskip("numpy")
+    cs.set_dynamics_backend(backend)
+    renders = {}
+    for mode in ("decimal", "fraction", "ticks"):
+        cs.set_time_mode(mode)
+        renders[mode] = rendered_fields(emitted(small_song().emit))
+    expected = renders["decimal"]
+    assert expected
+    for mode in ("fraction", "ticks"):
+        # the levels are worked out in each mode's arithmetic, so may
+        # differ in the last place
+        assert renders[mode] == [pytest.approx(fields, rel=1e-9) for fields in expected]
+
+
+class LegacyInstrument(cs.Instrument):
+    # emit() with the signature from before ScoreWriters, printing
+    def emit(self, start, duration, dynamics, articulation, pitch, portamento,
+             other_parameters=[]):
+        print("; LEGACY {0}".format(pitch))
+        return super(LegacyInstrument, self).emit(start, duration, dynamics, articulation,
+                                                  pitch, portamento, other_parameters)
+
+
+def test_legacy_emit_override_is_honored(capsys):
+    song = small_song()
+    plain = emitted(song.emit)
+    for section in song.sections:
+        for track in section.parts:
+            track.instr = LegacyInstrument(track.instr.i_number)
+    text = emitted(song.emit)
+    assert text.count("; LEGACY ") == plain.count("\ni ") > 0
+    lines = [line for line in text.split("\n") if not line.startswith("; LEGACY ")]
+    assert "\n".join(lines) == plain
+    assert emitted(song.emit, processes=2) == text
+    # nothing escaped to the real stdout
+    assert capsys.readouterr().out == ""
+
+
+@pytest.mark.parametrize("mode", ["fraction", "ticks"])
+def test_default_dynamics_follow_the_time_mode(mode):
+    # a Track left with the default envelope, under a Section envelope
+    # made in each mode: the default is shared, and used in the first
+    def render():
+        notes = [cs.Note(0, 1, pitch=60), cs.Note(1, 2, pitch=62)]
+        envelope = cs.Dynamics([(0.1, 1), (0.9, 2), (0.3, 0)], True)
+        track = cs.Track(cs.Instrument(1), "track", notes)
+        return emitted(cs.Section("section", [track], dynamics=envelope).emit)
+
+    expected = rendered_fields(render())
+    cs.set_time_mode(mode)
+    assert rendered_fields(render()) == [pytest.approx(fields, rel=1e-9) for fields in expected]
@@ -0,0 +1,106 @@
+import io
+import json
+
+import pytest
+
+import bench
+import csound as cs
+import lilypond
+import renderstats
+
+from test_lilypond import event_lines
+from test_render import emitted, small_song
+
+patched = [cs.Dynamics, cs.ArrayDynamics, cs.Instrument, cs.Section, cs.RenderJob, cs.Song]
+
+
+def attributes():
+    # everything enable() may patch
+    values = dict(((owner, name), value)
+                  for owner in patched for (name, value) in vars(owner).items())
+    for (module, name) in [(cs, "format_events"), (lilypond, "process_staff"),
+                           (lilypond, "stream_staff")]:
+        values[(module, name)] = getattr(module, name)
+    return values
+
+
+@pytest.fixture
+def stats_off():
+    # the operations computed are counted, so none may be cached; and
+    # whatever the test does, the originals must be back at the end
+    cs.clear_dynamics_caches()
+    before = attributes()
+    yield before
+    renderstats.disable()
+    assert renderstats.current() is None
+    after = attributes()
+    for (key, value) in before.items():
+        assert after[key] is value, key
+
+
+def check_counts(operations, events):
+    # operations maps names to counts
+    assert operations["render"] == operations["format"] == operations["event batch"] == events
+    assert operations["slice"] >= operations["slice computed"] > 0
+    assert operations["add"] >= operations["add computed"] > 0
+
+
+def test_song_stats(stats_off):
+    song = small_song()
+    stats = renderstats.enable(report=None)
+    assert renderstats.current() is stats
+    assert vars(cs.Dynamics)["slice"] is not stats_off[(cs.Dynamics, "slice")]
+    assert lilypond.process_staff is not stats_off[(lilypond, "process_staff")]
+    events = len(event_lines(emitted(song.emit)))
+    assert renderstats.disable() is stats
+    assert events > 0
+
+    check_counts(dict((name, count) for (name, (count, seconds)) in stats.operations.items()),
+                 events)
+    # each Track's work is counted in its own scope
+    assert list(stats.scopes) == [(section.name, track.name)
+                                  for section in song.sections for track in section.parts]
+    assert sum([ops["render"][0] for ops in stats.scopes.values()]) == events
+    # every envelope sliced (one) or added (two) is in the histogram
+    computed = stats.operations["slice computed"][0] + 2 * stats.operations["add computed"][0]
+    assert sum(stats.envelope_sizes.values()) == computed
+
+    # rendering again, with the stats off, counts nothing more
+    emitted(song.emit)
+    assert stats.operations["render"][0] == events
+
+
+def report_counts(text):
+    # the operation lines of a text report, as counts
+    lines = text.split("\n\n")[0].split("\n")
+    assert lines[:2] == [";; render statistics",
+                         "{0:<16} {1:>10} {2:>12} {3:>12}".format("operation", "count",
+                                                                  "total s", "mean us")]
+    return dict((line[:16].strip(), int(line[16:].split()[0])) for line in lines[2:])
+
+
+@pytest.mark.parametrize("style", ["text", "json"])
+def test_stats_option(stats_off, tmp_path, capsys, style):
+    text = bench.make_notes_fixture(notes=200, seed=2)[0]
+    (tmp_path / "score-staff.notes").write_text(text)
+    output = tmp_path / "score.sco"
+    lilypond.main(["score", "-d", str(tmp_path), "--stats", style, "-o", str(output)])
+    events = len(event_lines(output.read_text()))
+    assert events > 0
+
+    report = capsys.readouterr().err
+    if style == "json":
+        stats = json.loads(report)
+        operations = dict((name, totals["count"])
+                          for (name, totals) in stats["operations"].items())
+        assert [(scope["section"], scope["track"]) for scope in stats["scopes"]] == \
+            [("score", "score-staff")]
+        sizes = sum(stats["envelope_sizes"].values())
+    else:
+        operations = report_counts(report)
+        sizes = sum([int(line.split(":")[1]) for line in report.split("\n\n")[-1].split("\n")[1:]
+                     if line])
+    assert operations["process_staff"] == 1
+    check_counts(operations, events)
+    assert sizes == operations["slice computed"] + 2 * operations["add computed"]
+
@@ -0,0 +1,77 @@
+import pytest
+
+import csound as cs
+
+from test_render import emitted
+
+# a ramp up, a hold, a sudden change and a ramp down, then held; the
+# tempo holds before the first point too
+points = [(2, 60), (6, 120), (8, 120), (8, 90), (12, 30)]
+
+
+def tempo_within(a, b, beat):
+    # the tempo at beat, in the piece from point a to point b (or after a)
+    ((a_beat, a_tempo), (b_beat, b_tempo)) = (a, b)
+    if b_beat == a_beat:
+        return a_tempo
+    return a_tempo + (b_tempo - a_tempo) * (beat - a_beat) / float(b_beat - a_beat)
+
+
+def integrated_seconds(when, steps=2000):
+    # the integral of 60 / tempo from 0 to when, by Simpson's rule over each
+    # piece between points, on which the tempo is smooth
+    pieces = [((0, points[0][1]), points[0])] + list(zip(points, points[1:]))
+    pieces.append((points[-1], points[-1]))
+    total = 0.0
+    for (k, (a, b)) in enumerate(pieces):
+        start = 0.0 if k == 0 else float(a[0])
+        end = float(b[0]) if k < len(pieces) - 1 else float(when)
+        end = min(end, float(when))
+        if end <= start:
+            continue
+        h = (end - start) / steps
+        f = [60.0 / tempo_within(a, b, start + i * h) for i in range(steps + 1)]
+        total += h / 3 * (f[0] + f[-1] + 4 * sum(f[1:-1:2]) + 2 * sum(f[2:-1:2]))
+    return total
+
+
+@pytest.mark.parametrize("mode", ["decimal", "fraction", "ticks"])
+def test_seconds_integrate_the_tempo(mode):
+    cs.set_time_mode(mode)
+    tempo = cs.TempoMap(points)
+    for when in (0, 1, 2, 3.5, 6, 7, 8, 10, 12, 15):
+        assert tempo.seconds(cs.to_time(when)) == pytest.approx(integrated_seconds(when),
+                                                                rel=1e-9)
+
+
+def test_beats_invert_seconds():
+    tempo = cs.TempoMap(points)
+    for k in range(61):
+        when = k / 4.0
+        assert tempo.beats(tempo.seconds(cs.to_time(when))) == pytest.approx(when, abs=1e-9)
+    times = [cs.to_time(k / 4.0) for k in range(61)]
+    assert tempo.seconds_many(times) == pytest.approx([tempo.seconds(t) for t in times])
+
+
+def test_no_points_is_sixty():
+    tempo = cs.TempoMap()
+    assert tempo.tempo_at(cs.to_time(3)) == 60.0
+    assert tempo.seconds(cs.to_time(3)) == 3.0
+    assert tempo.beats(3.0) == 3.0
+    assert tempo.statement() == "\nt"
+
+
+def test_section_tempo_points():
+    section = cs.Section("section", [], [(4, 120)])
+    section.addTempoPoint(0, 60)
+    section.addTempoPoint(8, 90)
+    section.addTempoPoint(4, 100)  # after the other point at 4: a step
+    assert [(float(when), tempo) for (when, tempo) in section.tempo] == [
+        (0.0, 60), (4.0, 120), (4.0, 100), (8.0, 90)]
+    assert section.tempo_statement() == "\nt 0.0 60.0 4.0 120.0 4.0 100.0 8.0 90.0"
+    assert "\nt 0.0 60.0 4.0 120.0 4.0 100.0 8.0 90.0\n" in emitted(section.emit)
+    # a plain list still works, and is sorted
+    section.tempo = [(8, 90), (0, 60)]
+    assert section.tempo_statement() == "\nt 0.0 60.0 8.0 90.0"
+    with pytest.raises(ValueError):
+        section.addTempoPoint(2, 0)